@@ -0,0 +1,118 @@
+"""Benchmarks the MC and FDC wire protocol against the old pickle format.
+
+Measures the encode and decode throughput and the size of each message type,
+and how fast the streaming decoder gets through many messages that arrive in
+socket sized pieces.
+
+    python benchmarks/bench_proto.py
+"""
+
+import os
+import sys
+import time
+import pickle
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import smt_proto
+
+# Flags of the old format, a two byte flag and a pickled dictionary.
+PICKLE_FLAGS = {"GUN": b"AA", "TGT": b"BB", "STATUS": b"BB", "EOM": b"CC", "PING": b"DD"}
+
+################################
+# WORKLOADS
+################################
+
+def messages():
+    """Returns a message of every type like the ones sent during a mission."""
+
+    mission = {"ID": "TGT-0042", "GRID": "D11-2-5-7", "MOC": "FFE", "SHELL": "HE",
+               "ROUNDS": "4", "STATUS": "SENDING"}
+
+    return [("GUN", smt_proto.gun_report("1-3", "C12-4-8-1", "24", "EMPLACED", "YES", "")),
+            ("TGT", smt_proto.mission_message("1-3", mission, (837, 211.5, 1226.5, 21.8))),
+            ("STATUS", smt_proto.status_message("TGT-0042", "1-3", "SHOT")),
+            ("EOM", smt_proto.eom_message("TGT-0042", "1-3")),
+            ("PING", smt_proto.ping_message("1-3"))]
+
+def pickle_pack(kind, data):
+    return PICKLE_FLAGS[kind]+pickle.dumps(data)
+
+def pickle_unpack(data):
+    return (data[:2], pickle.loads(data[2:]))
+
+################################
+# BENCHMARKS
+################################
+
+def rate(func, args, seconds):
+    """Calls a function over and over and returns the calls per second."""
+
+    count = 0
+    clock = time.perf_counter
+    start = clock()
+    end = start+seconds
+
+    while True:
+        for _ in range(1000):
+            func(*args)
+        count += 1000
+
+        now = clock()
+        if now >= end:
+            return count/(now-start)
+
+def stream_rate(blob, chunk, n, seconds):
+    """Returns the messages per second a Decoder reads from a stream fed in chunks."""
+
+    pieces = [blob[i:i+chunk] for i in range(0, len(blob), chunk)]
+    count = 0
+    clock = time.perf_counter
+    start = clock()
+
+    while clock()-start < seconds:
+        decoder = smt_proto.Decoder()
+        for piece in pieces:
+            decoder.feed(piece)
+        count += n
+
+    return count/(clock()-start)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the wire protocol against pickle.")
+    parser.add_argument("--seconds", type=float, default=0.5,
+                        help="time spent on each benchmark (default: 0.5)")
+    parser.add_argument("--stream", type=int, default=10000,
+                        help="number of messages in the stream benchmark (default: 10000)")
+    parser.add_argument("--chunk", type=int, default=4096,
+                        help="bytes per read in the stream benchmark (default: 4096)")
+    args = parser.parse_args(argv)
+
+    print("{:<8}{:>8}{:>8}{:>14}{:>14}{:>14}{:>14}".format(
+        "TYPE", "BYTES", "PICKLE", "PACK/S", "PICKLE/S", "UNPACK/S", "UNPICKLE/S"))
+
+    for kind, data in messages():
+        packed = smt_proto.pack(kind, data)
+        pickled = pickle_pack(kind, data)
+
+        # Make sure the message survives the trip before timing it.
+        assert smt_proto.unpack(packed) == (kind, data)
+
+        print("{:<8}{:>8}{:>8}{:>14,.0f}{:>14,.0f}{:>14,.0f}{:>14,.0f}".format(
+            kind, len(packed), len(pickled),
+            rate(smt_proto.pack, (kind, data), args.seconds),
+            rate(pickle_pack, (kind, data), args.seconds),
+            rate(smt_proto.unpack, (packed,), args.seconds),
+            rate(pickle_unpack, (pickled,), args.seconds)))
+
+    msgs = messages()
+    blob = b"".join(smt_proto.pack(*msgs[i % len(msgs)]) for i in range(args.stream))
+
+    print("\nStreaming decoder: {:,.0f} messages/s from {:,} byte reads ({:.1f} MB)".format(
+        stream_rate(blob, args.chunk, args.stream, args.seconds*4), args.chunk, len(blob)/1e6))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
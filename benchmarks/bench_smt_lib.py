@@ -0,0 +1,232 @@
+"""Benchmarks for the hot paths of the main library.
+
+Measures the throughput and latency percentiles of the grid, offset and
+mortar functions on random battery and target workloads. Results can be
+written to a JSON file and compared against a stored baseline.
+
+    python benchmarks/bench_smt_lib.py --output baseline.json
+    python benchmarks/bench_smt_lib.py --compare baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import smt_lib
+
+################################
+# WORKLOADS
+################################
+
+def random_grid(rng, depth, zones=10):
+    """Returns a random grid on a map of zones x zones at a keypad depth.
+       The outer zones are left out so offsets stay on the map.
+    """
+
+    grid = chr(66+rng.randrange(zones))+str(rng.randrange(2, zones+2))
+
+    for _ in range(depth):
+        grid += "-{}".format(rng.randrange(1, 10))
+
+    return grid
+
+def random_pairs(rng, count, depth):
+    """Returns gun and target grids that are mostly within range of each other."""
+
+    guns = []
+    tgts = []
+
+    while len(guns) < count:
+        gun = random_grid(rng, depth)
+        cords = smt_lib.grid_to_vec(gun)
+
+        # Put the target somewhere around the gun.
+        di = rng.uniform(0, 360)
+        rn = rng.uniform(0, smt_lib.getMax()*1.1)
+
+        try:
+            tgt = smt_lib.vec_to_grid(smt_lib._offset(cords, di, rn), precision=depth)
+        except smt_lib.InvalidGridError:
+            continue
+
+        guns.append(gun)
+        tgts.append(tgt)
+
+    return (guns, tgts)
+
+################################
+# BENCHMARKS
+################################
+
+def quiet(func):
+    """Wraps a function so out of range targets don't stop a benchmark."""
+
+    def wrapper(*args):
+        try:
+            return func(*args)
+        except smt_lib.OutOfRangeError:
+            return None
+
+    return wrapper
+
+def benchmarks(rng, depths, size):
+    """Returns (name, setup, call, arguments) for every benchmark.
+       setup is run before each sample and isn't timed.
+    """
+
+    corr = [(rng.randrange(360), "{}{}".format(rng.choice("LR"), rng.randrange(1, 100)),
+             "{}{}".format(rng.choice("+-"), rng.randrange(1, 200))) for _ in range(size)]
+
+    for depth in depths:
+        guns, tgts = random_pairs(rng, size, depth)
+        pairs = list(zip(guns, tgts))
+        cords = [smt_lib.grid_to_vec(g) for g in guns]
+        dirs = [(g, rng.uniform(0, 360), rng.uniform(0, 100)) for g in guns]
+        fixes = [(g,)+c for g, c in zip(guns, corr)]
+        tag = "@depth{}".format(depth)
+
+        cold = smt_lib.grid_cache_clear
+        warm = lambda: None
+
+        yield ("valid_grid"+tag, warm, smt_lib.valid_grid, [(g,) for g in guns])
+        yield ("grid_to_vec"+tag, warm, smt_lib.grid_to_vec, [(g,) for g in guns])
+        yield ("grid_to_vec_cold"+tag, cold, smt_lib.grid_to_vec, [(g,) for g in guns])
+        yield ("vec_to_grid"+tag, warm, smt_lib.vec_to_grid, [(c,) for c in cords])
+        yield ("get_rn"+tag, warm, smt_lib.get_rn, pairs)
+        yield ("get_az"+tag, warm, smt_lib.get_az, pairs)
+        yield ("get_el"+tag, warm, quiet(smt_lib.get_el), pairs)
+        yield ("get_tof"+tag, warm, quiet(smt_lib.get_tof), pairs)
+        yield ("calc_data"+tag, warm, quiet(smt_lib.calc_data), pairs)
+        yield ("calc_data_cold"+tag, cold, quiet(smt_lib.calc_data), pairs)
+        yield ("aimpoint_offset"+tag, warm, smt_lib.aimpoint_offset, dirs)
+        yield ("correction_offset"+tag, warm, smt_lib.correction_offset, fixes)
+
+def percentile(data, p):
+    """Returns the p-th percentile of sorted data."""
+
+    i = (len(data)-1)*p/100
+    lo = int(i)
+    hi = min(lo+1, len(data)-1)
+
+    return data[lo]+(data[hi]-data[lo])*(i-lo)
+
+def run(setup, call, args, samples):
+    """Times a benchmark and returns its statistics in microseconds per call."""
+
+    # Warm up once so imports and tables are built.
+    setup()
+    for a in args:
+        call(*a)
+
+    times = []
+    clock = time.perf_counter_ns
+    total = 0
+
+    for _ in range(samples):
+        setup()
+        start = clock()
+        for a in args:
+            call(*a)
+        elapsed = clock()-start
+        total += elapsed
+        times.append(elapsed/len(args)/1000)
+
+    times.sort()
+    ops = samples*len(args)
+
+    return {"ops_per_sec": ops/(total/1e9),
+            "mean_us": sum(times)/len(times),
+            "p50_us": percentile(times, 50),
+            "p90_us": percentile(times, 90),
+            "p99_us": percentile(times, 99)}
+
+################################
+# REPORTING
+################################
+
+def compare(results, baseline, threshold):
+    """Prints the change against a baseline and returns the regressed benchmarks."""
+
+    regressed = []
+
+    print("\n{:<36}{:>12}{:>12}{:>10}".format("BENCHMARK", "BASE (us)", "NOW (us)", "CHANGE"))
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+
+        base = baseline[name]["p50_us"]
+        now = stats["p50_us"]
+        change = now/base-1 if base else 0
+        flag = ""
+
+        if change > threshold:
+            regressed.append(name)
+            flag = "  REGRESSION"
+
+        print("{:<36}{:>12.3f}{:>12.3f}{:>+9.1%}{}".format(name, base, now, change, flag))
+
+    return regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Squad Mortar Toolkit library.")
+    parser.add_argument("--depths", default="1,3,5",
+                        help="comma separated keypad depths of the grids (default: 1,3,5)")
+    parser.add_argument("--size", type=int, default=500,
+                        help="number of gun and target pairs per workload (default: 500)")
+    parser.add_argument("--samples", type=int, default=30,
+                        help="number of timed samples per benchmark (default: 30)")
+    parser.add_argument("--seed", type=int, default=8087,
+                        help="random seed for the workloads (default: 8087)")
+    parser.add_argument("--filter", default="",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="write the results to a JSON file")
+    parser.add_argument("--compare", help="compare the results against a JSON baseline")
+    parser.add_argument("--threshold", type=float, default=.10,
+                        help="slowdown of the median that counts as a regression (default: 0.10)")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    depths = [int(i) for i in args.depths.split(",")]
+    results = {}
+
+    print("{:<36}{:>14}{:>10}{:>10}{:>10}".format("BENCHMARK", "OPS/SEC", "P50 (us)", "P90 (us)", "P99 (us)"))
+    for name, setup, call, calls in benchmarks(rng, depths, args.size):
+        if args.filter not in name:
+            continue
+
+        stats = run(setup, call, calls, args.samples)
+        results[name] = stats
+
+        print("{:<36}{:>14,.0f}{:>10.3f}{:>10.3f}{:>10.3f}".format(name, stats["ops_per_sec"],
+                                                                 stats["p50_us"], stats["p90_us"],
+                                                                 stats["p99_us"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"smt_lib": smt_lib.__version__,
+                                "python": platform.python_version(),
+                                "platform": platform.platform(),
+                                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                "args": vars(args)},
+                       "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+        regressed = compare(results, baseline, args.threshold)
+
+        if regressed:
+            print("\n{} benchmark(s) regressed by more than {:.0%}.".format(len(regressed), args.threshold))
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""Benchmarks how long it takes to import the toolkit's modules.
+
+Each module is imported in a fresh interpreter many times, and the time of
+an empty interpreter is taken off so only the import itself is measured.
+The heavy modules each import pulled in are listed too, so an accidental
+import of NumPy or tkinter is easy to spot.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --modules smt_lib,smt_proto --repeat 50
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Modules that are slow to import and shouldn't be loaded without a need.
+HEAVY = ("numpy", "tkinter", "keyboard", "concurrent.futures", "asyncio")
+
+# Prints the heavy modules an import loaded.
+PROBE = "import sys, json; import {}; print(json.dumps([m for m in {!r} if m in sys.modules]))"
+
+################################
+# BENCHMARKS
+################################
+
+def environ():
+    """Returns the environment for the interpreters. Bytecode is always
+       written, so compiling the modules isn't timed along with the import.
+    """
+
+    env = dict(os.environ, PYTHONPATH=SRC)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+    return env
+
+def run(code, repeat):
+    """Runs code in fresh interpreters and returns the sorted times in ms."""
+
+    env = environ()
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter()-start)*1000)
+
+    return sorted(times)
+
+def heavy(module):
+    """Returns the heavy modules that importing a module loads."""
+
+    out = subprocess.run([sys.executable, "-c", PROBE.format(module, HEAVY)], env=environ(),
+                         check=True, capture_output=True, text=True).stdout
+
+    return json.loads(out)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the toolkit.")
+    parser.add_argument("--modules", default="smt_grid,smt_lib,smt_proto,smt_cli,fdc_engine,mc,fdc,smc",
+                        help="comma separated modules to import")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="number of interpreters started per module (default: 20)")
+    parser.add_argument("--output", help="write the results to a JSON file")
+    args = parser.parse_args(argv)
+
+    # Make sure every module is compiled before timing anything.
+    for module in args.modules.split(","):
+        run("import "+module, 1)
+
+    base = run("pass", args.repeat)
+    base = base[len(base)//2]
+    results = {}
+
+    print("Empty interpreter: {:.1f} ms\n".format(base))
+    print("{:<14}{:>12}{:>12}  {}".format("MODULE", "P50 (ms)", "MIN (ms)", "LOADED"))
+
+    for module in args.modules.split(","):
+        times = run("import "+module, args.repeat)
+        loaded = heavy(module)
+
+        results[module] = {"p50_ms": times[len(times)//2]-base,
+                           "min_ms": times[0]-base,
+                           "loaded": loaded}
+
+        print("{:<14}{:>12.1f}{:>12.1f}  {}".format(module, results[module]["p50_ms"],
+                                                    results[module]["min_ms"],
+                                                    ", ".join(loaded) or "-"))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"base_ms": base, "results": results}, f, indent=2)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,405 @@
+"""Load test of the FDC with simulated guns.
+
+Runs an FdcEngine with its network server on a thread and connects hundreds
+of simulated MC clients to it, all speaking the real protocol. The guns
+report in, move around now and then, and answer their missions like a crew
+would: RECEIVED straight away, SHOT once the gun is laid and COMPLETE after
+the rounds are fired and have landed. Missions are created at a steady rate
+and ended once they're complete.
+
+Reports how long missions take to reach the guns and to be received by all
+of them, how many heartbeats the FDC gets through and how long its ticks
+take. Everything runs in one process, so the clients and the FDC share a
+CPU and the numbers are a lower bound for a real FDC.
+
+    python benchmarks/loadtest.py --clients 300 --duration 30
+    python benchmarks/loadtest.py --clients 100 --legacy
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import threading
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import smt_lib
+from smt_proto import *
+from fdc_engine import FdcEngine
+from fdc_journal import Journal
+
+################################
+# LOAD TEST VARIABLES
+################################
+
+# Grid the guns are spread around.
+CENTER = "F8-5"
+
+# Meters from the center the guns are placed within.
+GUN_SPREAD = 300
+
+# Meters from the center the targets are placed between, so every gun can reach them.
+TARGET_RANGE = (400, 900)
+
+################################
+# STATISTICS
+################################
+
+def percentiles(values, points=(50, 90, 99)):
+    """Returns the percentiles and the max of a list of values, in ms."""
+
+    if not values:
+        return {}
+
+    values = sorted(values)
+    out = {"p{}".format(p): values[min(len(values)-1, int(len(values)*p/100))]*1000 for p in points}
+    out["max"] = values[-1]*1000
+
+    return out
+
+class Stats:
+    """Everything the load test measures. The FDC thread and the clients
+       each only add to their own fields, so no lock is needed.
+    """
+
+    def __init__(self):
+        # Times missions were created and first fully received, by ID.
+        self.created = {}
+        self.received = {}
+
+        # Seconds from a mission being created to each gun getting it.
+        self.dispatch = []
+
+        # Seconds each FDC tick took.
+        self.ticks = []
+
+        self.heartbeats = 0
+        self.messages = 0
+        self.completed = 0
+        self.reconnects = 0
+
+################################
+# SIMULATED GUNS
+################################
+
+def random_grid(rng, low, high):
+    """Returns a grid somewhere between low and high meters from the center."""
+
+    x, y = smt_lib.grid_to_vec(CENTER, center=True)
+    di = math.radians(rng.uniform(0, 360))
+    rn = rng.uniform(low, high)
+
+    return smt_lib.vec_to_grid((x+math.sin(di)*rn, y+math.cos(di)*rn), precision=4)
+
+class Gun:
+    """A simulated MC. Keeps a persistent connection like MC's PERSISTENT
+       option, or with legacy makes a new connection for every message like
+       MC does without it.
+    """
+
+    def __init__(self, name, args, stats, rng):
+        self.name = name
+        self.args = args
+        self.stats = stats
+        self.rng = rng
+
+        self.grid = random_grid(rng, 0, GUN_SPREAD)
+        self.status = "EMPLACED"
+        self.mission = ""
+        self.fire = None
+
+        # Messages waiting to be sent, in order.
+        self.outbox = collections.deque()
+        self.last_report = None
+        self.writer = None
+
+    def report(self):
+        return gun_report(self.name, self.grid, "24", self.status,
+                          "YES" if self.status == "EMPLACED" else "NO", self.mission)
+
+    def move(self):
+        """Moves the gun now and then. A moving gun emplaces on its next heartbeat."""
+
+        if self.status == "MOVING":
+            self.status = "EMPLACED"
+        elif not self.mission and self.rng.random() < self.args.move:
+            self.status = "MOVING"
+            self.grid = random_grid(self.rng, 0, GUN_SPREAD)
+
+    def send(self, kind, data):
+        self.outbox.append(pack(kind, data))
+
+        # A persistent connection answers straight away.
+        if self.writer and not self.args.legacy:
+            self.flush()
+
+    def flush(self):
+        while self.outbox:
+            self.writer.write(self.outbox.popleft())
+            self.stats.messages += 1
+
+    def handle(self, kind, data):
+        """Handles a message from the FDC like a crew would."""
+
+        if kind == "TGT":
+            # Guns only take one mission at a time, and ignore it being sent again.
+            if self.mission:
+                return
+
+            created = self.stats.created.get(data["ID"])
+            if created is not None:
+                self.stats.dispatch.append(time.monotonic()-created)
+
+            self.mission = data["ID"]
+            self.send("STATUS", status_message(data["ID"], self.name, "RECEIVED"))
+            self.fire = asyncio.ensure_future(self.shoot(data))
+
+        elif kind == "EOM":
+            self.send("EOM", eom_message(data["ID"], self.name, "EOM"))
+
+            if self.mission == data["ID"]:
+                if self.fire:
+                    self.fire.cancel()
+                self.mission = ""
+
+    async def shoot(self, data):
+        """Lays the gun, fires the rounds and waits for them to land."""
+
+        scale = self.args.time_scale
+
+        await asyncio.sleep(self.rng.uniform(2, 5)*scale)
+        self.send("STATUS", status_message(data["ID"], self.name, "SHOT"))
+
+        rounds = int(data["ROUNDS"] or 1)
+        await asyncio.sleep((rounds*self.rng.uniform(1.5, 3)+float(data["TOF"]))*scale)
+        self.send("STATUS", status_message(data["ID"], self.name, "COMPLETE"))
+
+    async def run(self, port, stop):
+        # Spread the clients out so they don't all report at once.
+        await asyncio.sleep(self.rng.uniform(0, self.args.interval))
+
+        while not stop.is_set():
+            try:
+                if self.args.legacy:
+                    await self.legacy(port, stop)
+                else:
+                    await self.session(port, stop)
+            except (OSError, ProtocolError):
+                pass
+
+            self.writer = None
+            if not stop.is_set():
+                self.stats.reconnects += 1
+                await asyncio.sleep(1)
+
+    async def session(self, port, stop):
+        """Keeps one connection open, sending a report when it changes and a PING otherwise."""
+
+        reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.writer.write(pack("PING", ping_message(self.name)))
+        self.last_report = None
+        read = asyncio.ensure_future(self.read(reader))
+
+        try:
+            while not stop.is_set() and not read.done():
+                self.move()
+                data = self.report()
+                self.flush()
+
+                if data != self.last_report:
+                    self.writer.write(pack("GUN", data))
+                    self.last_report = data
+                else:
+                    self.writer.write(pack("PING", ping_message(self.name)))
+
+                self.stats.heartbeats += 1
+                await self.writer.drain()
+                await asyncio.sleep(self.args.interval)
+        finally:
+            read.cancel()
+            self.writer.close()
+
+    async def read(self, reader):
+        decoder = Decoder()
+
+        while True:
+            chunk = await reader.read(4096)
+            if not chunk:
+                return
+
+            for kind, data in decoder.feed(chunk):
+                self.handle(kind, data)
+
+    async def legacy(self, port, stop):
+        """Sends one message a connection, a waiting answer before the report."""
+
+        while not stop.is_set():
+            self.move()
+            msg = self.outbox.popleft() if self.outbox else pack("GUN", self.report())
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(msg)
+            self.stats.heartbeats += 1
+            self.stats.messages += 1
+
+            decoder = Decoder()
+            while True:
+                chunk = await reader.read(4096)
+                msgs = decoder.feed(chunk) if chunk else []
+                for kind, data in msgs:
+                    self.handle(kind, data)
+                if not chunk or msgs:
+                    break
+
+            writer.close()
+            await asyncio.sleep(self.args.interval)
+
+################################
+# FDC
+################################
+
+def run_fdc(engine, args, stats, stop):
+    """Runs the engine like the FDC does, creating missions at a steady rate
+       and ending them once they're complete.
+    """
+
+    rng = random.Random(args.seed)
+    done = []
+
+    def changed(tgt, old, new):
+        if new == "RECEIVED" and tgt not in stats.received:
+            stats.received[tgt] = time.monotonic()
+        elif new == "COMPLETE":
+            done.append(tgt)
+
+    engine.on_change = changed
+
+    now = time.monotonic()
+    next_tick = now+args.tick
+    next_mission = now
+    count = 0
+
+    while not stop.is_set():
+        engine.poll(max(0.0, min(next_tick, next_mission)-time.monotonic()))
+        now = time.monotonic()
+
+        while args.rate and now >= next_mission:
+            count += 1
+            tgt = "T{}".format(count)
+            engine.create_mission(tgt, random_grid(rng, *TARGET_RANGE), str(rng.randint(1, args.max_guns)),
+                                  "FFE", "", "HE", str(rng.randint(1, 4)))
+            stats.created[tgt] = now
+            next_mission += 1/args.rate
+
+        if now >= next_tick:
+            start = time.perf_counter()
+            engine.tick()
+            stats.ticks.append(time.perf_counter()-start)
+            next_tick += args.tick
+
+        while done:
+            engine.end_mission(done.pop())
+            stats.completed += 1
+
+################################
+# MAIN
+################################
+
+async def run_clients(guns, port, duration):
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(i.run(port, stop)) for i in guns]
+
+    await asyncio.sleep(duration)
+    stop.set()
+
+    await asyncio.wait(tasks, timeout=5)
+    for i in tasks:
+        i.cancel()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the FDC with simulated guns.")
+    parser.add_argument("--clients", type=int, default=200, help="number of simulated guns (default: 200)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for (default: 30)")
+    parser.add_argument("--rate", type=float, default=2, help="missions created per second (default: 2)")
+    parser.add_argument("--max-guns", type=int, default=3, help="most guns a mission asks for (default: 3)")
+    parser.add_argument("--interval", type=float, default=2, help="seconds between gun heartbeats (default: 2)")
+    parser.add_argument("--tick", type=float, default=1, help="seconds between FDC ticks (default: 1)")
+    parser.add_argument("--move", type=float, default=0.05,
+                        help="chance an idle gun moves on each heartbeat (default: 0.05)")
+    parser.add_argument("--time-scale", type=float, default=1,
+                        help="scales how long crews take to shoot (default: 1)")
+    parser.add_argument("--legacy", action="store_true",
+                        help="make a new connection for every message instead of keeping one open")
+    parser.add_argument("--journal", help="keep a journal of the FDC's state in this directory")
+    parser.add_argument("--metrics", type=int, metavar="PORT", help="serve the FDC's metrics on this port")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: 1)")
+    parser.add_argument("--output", help="write the results to a JSON file")
+    args = parser.parse_args(argv)
+
+    stats = Stats()
+    engine = FdcEngine()
+    if args.journal:
+        Journal(args.journal).load(engine)
+    if args.metrics is not None:
+        engine.serve_metrics(port=args.metrics)
+    port = engine.serve("127.0.0.1", 0)
+
+    stop = threading.Event()
+    fdc = threading.Thread(target=run_fdc, args=(engine, args, stats, stop), name="fdc", daemon=True)
+    fdc.start()
+
+    rng = random.Random(args.seed)
+    guns = [Gun("G{}".format(n), args, stats, random.Random(rng.random())) for n in range(args.clients)]
+
+    start = time.monotonic()
+    try:
+        asyncio.run(run_clients(guns, port, args.duration))
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.monotonic()-start
+
+    stop.set()
+    fdc.join()
+    messages = engine.server.messages
+    engine.stop()
+
+    received = [stats.received[i]-stats.created[i] for i in stats.received]
+    results = {"clients": args.clients,
+               "mode": "legacy" if args.legacy else "persistent",
+               "seconds": elapsed,
+               "missions": len(stats.created),
+               "received": len(received),
+               "completed": stats.completed,
+               "waiting": sum(1 for i in engine.missions.values() if i["STATUS"] == "WAITING"),
+               "dispatch_ms": percentiles(stats.dispatch),
+               "all_received_ms": percentiles(received),
+               "heartbeats_per_s": stats.heartbeats/elapsed,
+               "messages_per_s": messages/elapsed,
+               "tick_ms": percentiles(stats.ticks),
+               "reconnects": stats.reconnects}
+
+    print("{} {} clients for {:.0f}s".format(args.clients, results["mode"], elapsed))
+    print("Missions: {missions} created, {received} received, {completed} completed, "
+          "{waiting} waiting for guns".format(**results))
+
+    for key, name in (("dispatch_ms", "Dispatch to gun"), ("all_received_ms", "All guns received"),
+                      ("tick_ms", "FDC tick")):
+        print("{:<18} ".format(name)+"  ".join("{} {:.1f}ms".format(k, v) for k, v in results[key].items()))
+
+    print("Heartbeats: {:,.0f}/s, FDC messages {:,.0f}/s, {} reconnects".format(
+        results["heartbeats_per_s"], results["messages_per_s"], results["reconnects"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,178 +1,138 @@
 import sys
-import socket
-import pickle
-import math
+import logging
 import tkinter as tk
 from tkinter import ttk, BooleanVar
 from tkinter.font import *
 
-from smt_lib import *
+from fdc_engine import FdcEngine
+from fdc_journal import Journal, JournalError
+from fdc_metrics import setup_logging
 
-class Application(tk.Frame):
+log = logging.getLogger("fdc")
 
-    # Initialization function for the program.
-    def __init__(self, master=None):
-        super().__init__(master)
-        self.master = master
-        self.pack()
+class TreeSync:
+    """Keeps a Treeview in step with a list of rows.
 
-        self.centered = BooleanVar()
-        
-        self.create_widgets()
+    Rows are kept by key, so only the rows that were added or removed and
+    the cells that changed are touched. The selection and scroll position
+    survive every refresh. With a page size, only one page of rows is shown.
+    """
 
+    def __init__(self, tree, page_size=0):
+        self.tree = tree
+        self.columns = tree["columns"]
+        self.page_size = page_size
+        self.page = 0
+        self.total = 0
 
-        # Socket placeholder.
-        self.serversocket = None
+        # Text and values of the rows being shown, by key, in order.
+        self._rows = {}
 
-        # Dictionary of guns connected to the fdc.
-        self.guns = {}
+    def _iid(self, key):
+        # An empty iid is the tree's root, so every key gets a prefix.
+        return "row:" + str(key)
 
-        # Dictionary of active missions.
-        self.mission_list = {}
+    def pages(self):
+        """Returns the number of pages of rows."""
 
-        # List of individual active missions that will be sent down to each gun.
-        self.mission_queue = []
+        if not self.page_size:
+            return 1
 
-        # List of individual end of missions that will be sent down to each gun.
-        self.eom_queue = []
+        return max(1, -(-self.total // self.page_size))
 
-        # Flags for sending pickle data between different programs within toolchain.
-        self.FLAGS = {"GUN": b"AA",
-                      "TGT": b"BB",
-                      "EOM": b"CC"}
+    def sync(self, rows):
+        """Updates the tree to show rows, a list of (key, text, values)."""
 
-        # Only run if we're on Windows.
-        if sys.platform == "win32":
-            import ctypes
-            ctypes.windll.shcore.SetProcessDpiAwareness(1) # Fixes blurry font.
+        rows = list(rows)
+        self.total = len(rows)
+
+        if self.page_size:
+            self.page = min(self.page, self.pages()-1)
+            start = self.page*self.page_size
+            rows = rows[start:start+self.page_size]
+
+        keys = [i[0] for i in rows]
+        shown = set(keys)
+
+        # Remove the rows that are gone.
+        for key in [i for i in self._rows if i not in shown]:
+            self.tree.delete(self._iid(key))
+            del self._rows[key]
+
+        # Rows that are still shown but changed places have to be moved.
+        moved = [i for i in keys if i in self._rows] != list(self._rows)
 
-    # Calc the gun data.
-    def calc(self, gun, tgt, sheaf="CONVERGED", shell="HE", number=1, total=1):
-        """Calculates a gun's firing data."""
+        new = {}
+        for n, (key, text, values) in enumerate(rows):
+            values = tuple(values)
+            old = self._rows.get(key)
+            iid = self._iid(key)
 
-        # Make sure not to shoot a sheaf if there's only one gun.
-        if total == 1:
-            sheaf = "CONVERGED"
+            if old is None:
+                self.tree.insert("", n, iid=iid, text=text, values=values)
 
-        # Calculate for a circle sheaf.
-        if sheaf == "CIRCLE":
-            new_tgt = aimpoint_offset(self.mission_list[tgt]["GRID"], (total/360)*number, getBurst(shell))
-            rn, az, el, tof = calc_data(self.guns[gun]["GRID"], new_tgt, center=self.centered)
+            elif old != (text, values):
+                if old[0] != text:
+                    self.tree.item(iid, text=text)
 
-        # Calculate for a converged sheaf.
-        elif sheaf == "CONVERGED":
-            rn, az, el, tof = calc_data(self.guns[gun]["GRID"],
-                                        self.mission_list[tgt]["GRID"], center=self.centered)
+                for column, a, b in zip(self.columns, old[1], values):
+                    if a != b:
+                        self.tree.set(iid, column, b)
 
-        # Calculate for an open sheaf.
-        elif sheaf == "OPEN":
+            if moved:
+                self.tree.move(iid, "", n)
 
+            new[key] = (text, values)
 
-            # Get the sheaf offset in meters.
-            sheaf_offset = (total*getBurst(shell)/2) - (getBurst(shell)/2) - (number*getBurst(shell))
+        self._rows = new
 
-            # Get the direction of the sheaf, right of target
-            # if positive and left of target if negative.
-            if sheaf_offset > 0:
-                sheaf_dir = 90
-            else:
-                sheaf_dir = 270
+    def turn(self, step):
+        """Moves forward or back a number of pages. Call sync afterwards."""
 
-            new_tgt = aimpoint_offset(self.mission_list[tgt]["GRID"], sheaf_dir, abs(sheaf_offset))
-            rn, az, el, tof = calc_data(self.guns[gun]["GRID"], new_tgt, center=self.centered)
+        self.page = max(0, min(self.page+step, self.pages()-1))
 
-        else:
-            print("SHEAF ERROR!")
+class Application(tk.Frame):
 
-        return (rn, az, el, tof)
+    # Initialization function for the program.
+    def __init__(self, master=None):
+        super().__init__(master)
+        self.master = master
+        self.pack()
+
+        self.centered = BooleanVar()
+        
+        self.create_widgets()
+
+
+        # Everything the FDC does happens in the engine, the window only shows it.
+        self.engine = FdcEngine(on_change=self.mission_changed)
+
+        # The engine's guns and missions, for the tables.
+        self.guns = self.engine.guns
+        self.mission_list = self.engine.missions
+
+        # Only run if we're on Windows.
+        if sys.platform == "win32":
+            import ctypes
+            ctypes.windll.shcore.SetProcessDpiAwareness(1) # Fixes blurry font.
 
     def update(self):
-        """The program's main thread for multitasking, including target clean up, gui updates, and networking."""
+        """The program's main thread for multitasking, including target clean up and gui updates."""
 
-        try:
-            (client, address) = self.serversocket.accept()
-        except:
-            client = None
-
-        if client:
-            with client:
-                newdata = None
-                data = bytes()
-                print("Connection from {}:{}".format(*address))
-                while True:
-                    try:
-                        newdata = client.recv(2048)
-                    except:
-                        newdata = None
-                    if not newdata: break
-                    data += newdata
-
-
-                # Deal with test messages.
-                if not data:
-                    pass
-
-
-                elif data[:2] == self.FLAGS["GUN"]:
-
-                    # Update gun list.
-                    data = pickle.loads(data[2:])
-                    self.guns[data["NAME"]] = data
-
-
-                    sentdata = False
-
-                    for i in range(len(self.eom_queue)):
-                        if self.eom_queue[i]["GUN"] == data["NAME"]:
-                            client.sendall(self.FLAGS["EOM"]+pickle.dumps(self.eom_queue[i]))
-                            sentdata = True
-                            break
-
-                    if not sentdata:
-                        for i in range(len(self.mission_queue)):
-                            print(self.mission_queue[i]["GUN"])
-                            print(data["NAME"])
-                            if self.mission_queue[i]["GUN"] == data["NAME"]:
-                                print(self.mission_queue[i])
-                                client.sendall(self.FLAGS["TGT"]+pickle.dumps(self.mission_queue[i]))
-                                break
-
-                elif data[:2] == self.FLAGS["TGT"]:
-                    data = pickle.loads(data[2:])
-
-                    if data["STATUS"] == "RECEIVED":
-                        for i in range(len(self.mission_queue)):
-                            if self.mission_queue[i]["GUN"] == data["GUN"] and self.mission_queue[i]["ID"] == data["ID"]:
-                                self.mission_list[data["ID"]]["GUN_STATUS"][data["GUN"]] = data["STATUS"]
-                                del self.mission_queue[i]
-                                break
-                    else:
-                        for i in self.mission_list:
-                            if data["GUN"] in self.mission_list[i]["GUN_LIST"] and self.mission_list[i]["ID"] == data["ID"]:
-                                self.mission_list[data["ID"]]["GUN_STATUS"][data["GUN"]] = data["STATUS"]
-
-
-
-                elif data[:2] == self.FLAGS["EOM"]:
-                    data = pickle.loads(data[2:])
-                    print("EOM STUFF!")
-
-                    for i in range(len(self.eom_queue)):
-                        print(self.eom_queue)
-                        if self.eom_queue[i]["GUN"] == data["GUN"] and self.eom_queue[i]["ID"] == data["ID"]:
-                            del self.eom_queue[i]
-                            break
-
-                else:
-                    print("Unknown data message!")
+        self.engine.center = self.centered.get()
+        self.engine.tick()
 
         self.update_guns()
-        self.update_status()
-        self.process_missions()
         self.update_mission_list()
 
         self.after(1000, self.update)
 
+    def poll(self):
+        """Handles the messages the network server has received since the last poll."""
+
+        self.engine.poll()
+        self.after(50, self.poll)
+
     def host(self):
         """Activated when the host button is clicked.
         This function sets up a socket server for communicating with the guns.
@@ -185,81 +145,71 @@ class Application(tk.Frame):
         h = self.ip_setting.get()
         p = int(self.port_setting.get())
 
-        self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.serversocket.setblocking(0)
-        self.serversocket.bind((h, p))
-        self.serversocket.listen(10)
+        # Load the heightmap so masked guns aren't given missions.
+        if self.map_setting.get():
+            self.engine.load_map(self.map_setting.get())
+
+        # Pick up where the FDC left off, then keep a journal of every change.
+        if self.journal_setting.get():
+            try:
+                n = Journal(self.journal_setting.get()).load(self.engine)
+            except (OSError, JournalError) as e:
+                log.error("%s", e)
+                return
+            log.info("Replayed %s changes", n)
+            self.update_guns()
+            self.update_mission_list()
+
+        # The server runs on its own thread and passes messages to the engine.
+        try:
+            self.engine.serve(h, p)
+        except OSError as e:
+            log.error("Couldn't host on %s:%s: %s", h, p, e)
+            self.engine.stop()
+            return
+
+        # Metrics are only served to this computer.
+        if self.metrics_setting.get():
+            try:
+                log.info("Metrics served on port %s", self.engine.serve_metrics(port=int(self.metrics_setting.get())))
+            except (OSError, ValueError) as e:
+                log.error("Couldn't serve metrics: %s", e)
 
         # Disable the appropriate fields.
         self.host["state"] = "disabled"
         self.ip_setting["state"] = "disabled"
         self.port_setting["state"] = "disabled"
+        self.map_setting["state"] = "disabled"
+        self.journal_setting["state"] = "disabled"
+        self.metrics_setting["state"] = "disabled"
 
-        # Check for updates every second.
+        # Check for messages often and update everything else every second.
+        self.after(50, self.poll)
         self.after(1000, self.update)
 
-    def update_status(self):
-        """Makes sure the status of each mission is accurately displayed."""
-
-        for i in self.mission_list:
-            print(self.mission_list[i]["GUN_STATUS"])
-            # Don't change the status if it's in the queue.
-            if self.mission_list[i]["GUN_STATUS"] == {}:
-                continue
-
-            if self.mission_list[i]["STATUS"] == "COMPLETE":
-                continue
-
-            s_sending = 0
-            s_received = 0
-            s_shot = 0
-            s_complete = 0
-            s_count = 0
-
-            for n in self.mission_list[i]["GUN_STATUS"]:
-                if self.mission_list[i]["GUN_STATUS"][n] == "SENDING":
-                    s_sending += 1
-                if self.mission_list[i]["GUN_STATUS"][n] == "RECEIVED":
-                    s_received += 1
-                if self.mission_list[i]["GUN_STATUS"][n] == "SHOT":
-                    s_shot += 1
-                if self.mission_list[i]["GUN_STATUS"][n] == "COMPLETE":
-                    s_complete += 1
-
-                s_count += 1
-
-            if s_complete == s_count:
-                self.mission_list[i]["STATUS"] = "COMPLETE"
-            elif s_sending:
-                self.mission_list[i]["STATUS"] = "SENDING"
-            elif s_received == s_count:
-                self.mission_list[i]["STATUS"] = "RECEIVED"
-            elif s_shot:
-                self.mission_list[i]["STATUS"] = "SHOT"
+    def close(self):
+        """Stops the server and writes out the journal before quitting."""
+
+        self.engine.stop()
+        self.master.destroy()
+
+    def mission_changed(self, tgt, old, new):
+        """Called by the tracker when a mission's status changes."""
 
+        log.info("Mission %s: %s -> %s", tgt, old, new)
 
     def update_guns(self):
-        #Update tree
-        self.tree.delete(*self.tree.get_children())
-        for i in self.guns:
-                self.tree.insert("", "end", text=self.guns[i]["NAME"], values=(self.guns[i]["GRID"],
-                                                                               self.guns[i]["AMMO"],
-                                                                               self.guns[i]["STATUS"],
-                                                                               self.guns[i]["CAPABLE"],
-                                                                               self.guns[i]["MISSION"]))
+        """Updates the rows of the gun table that changed."""
 
+        self.gun_rows.sync((i, self.guns[i]["NAME"], (self.guns[i]["GRID"],
+                                                      self.guns[i]["AMMO"],
+                                                      self.guns[i]["STATUS"],
+                                                      self.guns[i]["CAPABLE"],
+                                                      self.guns[i]["MISSION"])) for i in self.guns)
 
     def process(self):
-        self.mission_list[self.tgt_id.get()] = {"ID": self.tgt_id.get(),
-                                                "GRID": self.tgt_grid.get(),
-                                                "GUNS": self.num_guns.get(),
-                                                "MOC": self.moc.get(),
-                                                "SHEAF": self.sheaf.get(),
-                                                "SHELL": self.shell.get(),
-                                                "ROUNDS": self.rnds.get(),
-                                                "STATUS": "WAITING",
-                                                "GUN_LIST": [],
-                                                "GUN_STATUS": {}}
+        self.engine.create_mission(self.tgt_id.get(), self.tgt_grid.get(), self.num_guns.get(),
+                                   self.moc.get(), self.sheaf.get(), self.shell.get(), self.rnds.get())
 
         for i in (self.tgt_id, self.tgt_grid, self.num_guns, self.moc,
                   self.sheaf, self.shell, self.rnds):
@@ -270,46 +220,23 @@ class Application(tk.Frame):
 
 
     def update_mission_list(self):
-        #Update the mission list
-        self.missions.delete(*self.missions.get_children())
-        for i in self.mission_list:
-                self.missions.insert("", "end", text=self.mission_list[i]["ID"], values=(self.mission_list[i]["GRID"],
-                                                                                         self.mission_list[i]["GUNS"],
-                                                                                         self.mission_list[i]["MOC"],
-                                                                                         self.mission_list[i]["SHEAF"],
-                                                                                         self.mission_list[i]["SHELL"],
-                                                                                         self.mission_list[i]["ROUNDS"],
-                                                                                         self.mission_list[i]["STATUS"]))
-
-
-    # This functions finds missions in waiting and assigns guns to them.
-    def process_missions(self):
-        for i in self.mission_list:
-            if self.mission_list[i]["STATUS"] == "WAITING":
-
-                # Make sure the guns are mission capable.
-                guns = [x for x in self.guns if self.guns[x]["CAPABLE"] == "YES"]
-                guns = [x for x in guns if getMin() <= get_rn(self.guns[x]["GRID"], self.mission_list[i]["GRID"]) <= getMax()]
-                if len(guns) >= int(self.mission_list[i]["GUNS"]):
-                    self.mission_list[i]["STATUS"] = "SENDING"
-                    guns = guns[:int(self.mission_list[i]["GUNS"])]
-                    self.mission_list[i]["GUN_LIST"] = guns
-
-                    # Calc a bcs sheath offset.
-                    g_offset = 360/len(guns)
-
-                    # Don't use a sheaf if there's only one gun!
-                    if len(guns) == 1:
-                        self.mission_list[i]["SHEAF"] = "CONVERGED"
-
-                    for n in range(len(guns)):
-                        data = self.calc(guns[n], i, sheaf=self.mission_list[i]["SHEAF"], shell=self.mission_list[i]["SHELL"], number=n, total=len(guns))
-
-                        self.queue_mission(guns[n], i, data)
-                        self.guns[guns[n]]["CAPABLE"] = "NO"
-                        self.mission_list[i]["GUN_STATUS"][guns[n]] = "SENDING"
-                    self.update_mission_list()
-                    return
+        """Updates the rows of the mission table that changed."""
+
+        self.mission_rows.sync((i, self.mission_list[i]["ID"], (self.mission_list[i]["GRID"],
+                                                                self.mission_list[i]["GUNS"],
+                                                                self.mission_list[i]["MOC"],
+                                                                self.mission_list[i]["SHEAF"],
+                                                                self.mission_list[i]["SHELL"],
+                                                                self.mission_list[i]["ROUNDS"],
+                                                                self.mission_list[i]["STATUS"])) for i in self.mission_list)
+
+        self.page_label["text"] = "PAGE {}/{}".format(self.mission_rows.page+1, self.mission_rows.pages())
+
+    def turn_page(self, step):
+        """Shows the next or previous page of missions."""
+
+        self.mission_rows.turn(step)
+        self.update_mission_list()
 
     # Ends the selected mission.
     def correct(self):
@@ -318,28 +245,7 @@ class Application(tk.Frame):
         if not tgt:
             return
 
-        dev_cor = self.dev_cor.get()
-        rn_cor = self.rn_cor.get()
-
-        if not dev_cor:
-            dev_cor = "0"
-
-        if not rn_cor:
-            rn_cor = "0"
-
-        self.mission_list[tgt]["GRID"] = correction_offset(self.mission_list[tgt]["GRID"],
-                                                           int(self.dir_cor.get()),
-                                                           dev_cor,
-                                                           rn_cor)
-
-
-        for i in self.mission_list[tgt]["GUN_LIST"]:
-            self.eom_queue.append({"GUN": i,
-                                   "ID": tgt})
-
-        self.mission_list[tgt]["STATUS"] = "WAITING"
-        self.mission_list[tgt]["GUN_LIST"] = []
-        self.mission_list[tgt]["GUN_STATUS"] = {}
+        self.engine.correct_mission(tgt, int(self.dir_cor.get()), self.dev_cor.get(), self.rn_cor.get())
 
         self.dir_cor["state"] = "normal"
         self.dir_cor.delete(0, tk.END)
@@ -358,17 +264,7 @@ class Application(tk.Frame):
         if not tgt:
             return
 
-        for i in self.mission_list[tgt]["GUN_LIST"]:
-            self.eom_queue.append({"GUN": i,
-                                   "ID": tgt})
-
-        for i in range(len(self.mission_queue)):
-            if self.mission_queue[i]["ID"] == tgt:
-                self.mission_queue[i] = None
-
-        self.mission_queue = [i for i in self.mission_queue if i]
-
-        del self.mission_list[tgt]
+        self.engine.end_mission(tgt)
 
         self.tgt_id2["state"] = "normal"
         self.tgt_id2.delete(0, tk.END)
@@ -415,25 +311,8 @@ class Application(tk.Frame):
 
 
         self.update_guns()
-        self.update_status()
         self.update_mission_list()
 
-    # Adds a mission to a queue that will be sent over network to the gun.
-    def queue_mission(self, gun, tgt, data):
-        self.mission_queue.append({"GUN": gun,
-                                   "ID": tgt,
-                                   "GRID": self.mission_list[tgt]["GRID"],
-                                   "MOC": self.mission_list[tgt]["MOC"],
-                                   "SHELL": self.mission_list[tgt]["SHELL"],
-                                   "ROUNDS": self.mission_list[tgt]["ROUNDS"],
-                                   "STATUS": self.mission_list[tgt]["STATUS"],
-                                   "RANGE": data[0],
-                                   "AZIMUTH":data[1],
-                                   "ELEVATION": data[2],
-                                   "TOF": data[3]}
-                                   )
-
-
     # This function is initiated when a mouse click is detected in the mission list.
     def selectItem(self, event):
         curItem = self.missions.item(self.missions.focus())
@@ -512,6 +391,21 @@ class Application(tk.Frame):
                                      onvalue=True, offvalue=False)
         self.centerbox.grid(row=4, column=1)
 
+        self.lb2 = tk.Label(self, text="MAP: ", font=font)
+        self.lb2.grid(row=5, column=0)
+        self.map_setting = tk.Entry(self, width=20, font=font)
+        self.map_setting.grid(row=5, column=1)
+
+        self.lb2 = tk.Label(self, text="JOURNAL: ", font=font)
+        self.lb2.grid(row=6, column=0)
+        self.journal_setting = tk.Entry(self, width=20, font=font)
+        self.journal_setting.grid(row=6, column=1)
+
+        self.lb2 = tk.Label(self, text="METRICS PORT: ", font=font)
+        self.lb2.grid(row=7, column=0)
+        self.metrics_setting = tk.Entry(self, width=20, font=font)
+        self.metrics_setting.grid(row=7, column=1)
+
         self.lb4 = tk.Label(self, text="MISSION GENERATOR", font=font)
         self.lb4.grid(row=0, column=3)
 
@@ -640,11 +534,11 @@ class Application(tk.Frame):
         self.host.grid(row=8, column=9)
 
         self.quit = tk.Button(self, text="QUIT",
-                              command=self.master.destroy, font=font)
+                              command=self.close, font=font)
         self.quit.grid(row=8, column=10)
 
         # Create the tree view.
-        self.tree = ttk.Treeview(root, columns=("GRID", "AMMO", "STATUS", "CAPABLE", "MISSION"))
+        self.tree = ttk.Treeview(self.master, columns=("GRID", "AMMO", "STATUS", "CAPABLE", "MISSION"))
         self.tree.heading("#0", text="UNIT")
         self.tree.heading("GRID", text="GRID")
         self.tree.heading("AMMO", text="AMMO")
@@ -663,7 +557,7 @@ class Application(tk.Frame):
 
 
         # Create the tree view.
-        self.missions = ttk.Treeview(root, columns=("GRID", "GUNS", "MOC", "SHEAF", "SHELL", "ROUNDS", "STATUS"))
+        self.missions = ttk.Treeview(self.master, columns=("GRID", "GUNS", "MOC", "SHEAF", "SHELL", "ROUNDS", "STATUS"))
         self.missions.heading("#0", text="Target Number")
         self.missions.heading("GRID", text="GRID")
         self.missions.heading("GUNS", text="GUNS")
@@ -685,10 +579,29 @@ class Application(tk.Frame):
 
         self.missions.pack(side="right")
 
-        self.after(1000, self.process_missions)
+        # Keep the tables in step without redrawing them. Long mission lists are paged.
+        self.gun_rows = TreeSync(self.tree)
+        self.mission_rows = TreeSync(self.missions, page_size=100)
+
+        self.prev_page = tk.Button(self, text="<", command=lambda: self.turn_page(-1), font=font)
+        self.prev_page.grid(row=9, column=8)
+
+        self.page_label = tk.Label(self, text="PAGE 1/1", font=font)
+        self.page_label.grid(row=9, column=9)
+
+        self.next_page = tk.Button(self, text=">", command=lambda: self.turn_page(1), font=font)
+        self.next_page.grid(row=9, column=10)
+
+
+
+def main():
+    setup_logging()
 
+    root = tk.Tk()
+    app = Application(master=root)
+    app.master.title("Squad Mortar Toolkit - Fire Direction Center")
+    app.master.protocol("WM_DELETE_WINDOW", app.close)
+    app.mainloop()
 
-root = tk.Tk()
-app = Application(master=root)
-app.master.title("Squad Mortar Toolkit - Fire Direction Center")
-app.mainloop()
+if __name__ == "__main__":
+    main()
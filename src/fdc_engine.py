@@ -0,0 +1,892 @@
+"""Bookkeeping for the FDC that doesn't need a GUI.
+
+The FDC holds messages for each gun until the gun answers them. A
+DispatchQueue keeps those messages in a separate first in, first out queue
+per gun, keyed by mission ID, so finding a gun's next message, answering it
+and dropping a whole mission don't have to look through every other gun's
+messages.
+
+An FdcEngine holds everything else the FDC does: the guns, the missions,
+assigning guns and calculating their firing data, corrections and ending
+missions. It has no GUI, so it can be driven from code, run as a daemon or
+profiled. The FDC window is just a view over one.
+
+    python src/fdc_engine.py --port 844 --missions missions.jsonl --journal fdc-state
+
+A MissionTracker works out the status of each mission from the statuses of
+its guns. It keeps a count of the guns in each status, so a gun's status
+changing is a constant time update and nothing has to be recounted while
+the missions are quiet.
+"""
+
+import sys
+import json
+import time
+import queue
+import signal
+import logging
+import argparse
+import collections
+
+from smt_lib import *
+from smt_proto import *
+from fdc_journal import Journal, JournalError
+from fdc_metrics import REGISTRY, MetricsServer, METRICS_PORT, setup_logging
+
+__all__ = [
+    "DispatchQueue",
+    "FdcEngine",
+    "MissionTracker"
+    ]
+
+log = logging.getLogger("fdc.engine")
+
+################################
+# METRICS
+################################
+
+TICK_SECONDS = REGISTRY.histogram("fdc_tick_seconds", "Time taken by each tick of the FDC.")
+HANDLE_SECONDS = REGISTRY.histogram("fdc_handle_seconds", "Time taken to handle a message from a gun.",
+                                    ("type",))
+MESSAGE_ERRORS = REGISTRY.counter("fdc_message_errors_total", "Messages from guns that couldn't be handled.")
+QUEUE_DEPTH = REGISTRY.gauge("fdc_queue_depth", "Messages waiting to be sent to guns.", ("queue",))
+QUEUE_MAX_DEPTH = REGISTRY.gauge("fdc_queue_max_depth", "Most messages waiting on any one gun.", ("queue",))
+GUNS = REGISTRY.gauge("fdc_guns", "Guns that have reported to the FDC.")
+SESSIONS = REGISTRY.gauge("fdc_sessions", "Guns connected with a persistent session.")
+CONNECTIONS = REGISTRY.gauge("fdc_connections", "Open connections to the FDC.")
+MISSIONS = REGISTRY.gauge("fdc_missions", "Active missions.")
+RECEIVED_SECONDS = REGISTRY.histogram("fdc_mission_received_seconds",
+                                      "Time from a mission being generated to all of its guns receiving it.",
+                                      buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+CALCS = REGISTRY.counter("fdc_calc_total", "Sheafs the firing data was calculated for.")
+CALC_GUNS = REGISTRY.counter("fdc_calc_guns_total", "Firing data calculated for each gun.")
+CALC_SECONDS = REGISTRY.histogram("fdc_calc_seconds", "Time taken to calculate the firing data of a sheaf.")
+
+################################
+# DISPATCH QUEUES
+################################
+
+class DispatchQueue:
+    """Messages waiting to be sent to guns, in the order they were queued.
+
+       Each gun has its own queue, keyed by mission ID, so a gun only ever
+       has one message per mission. Queueing, peeking at a gun's next
+       message and acknowledging a message are all constant time.
+    """
+
+    def __init__(self):
+        # Message of each mission waiting on each gun, oldest first.
+        self._guns = {}
+
+        # Guns each mission is waiting on.
+        self._missions = {}
+
+    def __len__(self):
+        return sum(len(i) for i in self._guns.values())
+
+    def __contains__(self, item):
+        """Checks for a (gun, mission) pair."""
+
+        gun, mission = item
+        return mission in self._guns.get(gun, ())
+
+    def put(self, gun, mission, msg):
+        """Queues a message for a gun. A message that is already queued for
+           the same gun and mission is replaced and goes to the back.
+        """
+
+        queue = self._guns.setdefault(gun, collections.OrderedDict())
+        queue.pop(mission, None)
+        queue[mission] = msg
+
+        self._missions.setdefault(mission, set()).add(gun)
+
+    def peek(self, gun):
+        """Returns a gun's oldest message without removing it, or None."""
+
+        queue = self._guns.get(gun)
+
+        if not queue:
+            return None
+
+        return next(iter(queue.values()))
+
+    def ack(self, gun, mission):
+        """Removes a gun's message for a mission once the gun has answered it.
+           Returns the message, or None if it wasn't queued.
+        """
+
+        queue = self._guns.get(gun)
+
+        if not queue or mission not in queue:
+            return None
+
+        msg = queue.pop(mission)
+        if not queue:
+            del self._guns[gun]
+
+        guns = self._missions[mission]
+        guns.discard(gun)
+        if not guns:
+            del self._missions[mission]
+
+        return msg
+
+    def drop(self, mission):
+        """Removes every gun's message for a mission."""
+
+        for gun in list(self._missions.get(mission, ())):
+            self.ack(gun, mission)
+
+    def pending(self, gun):
+        """Returns all of a gun's messages, oldest first."""
+
+        return list(self._guns.get(gun, {}).values())
+
+    def items(self):
+        """Yields every (gun, mission, message), each gun's oldest first."""
+
+        for gun, queue in self._guns.items():
+            for mission, msg in queue.items():
+                yield (gun, mission, msg)
+
+    def depth(self, gun):
+        """Returns the number of messages waiting on a gun."""
+
+        return len(self._guns.get(gun, ()))
+
+    def depths(self):
+        """Returns the number of messages waiting on each gun with any."""
+
+        return {gun: len(queue) for gun, queue in self._guns.items()}
+
+################################
+# MISSION STATUS
+################################
+
+class MissionTracker:
+    """Keeps the STATUS of each mission in step with its GUN_STATUS.
+
+       Missions are the FDC's mission dictionaries and are updated in place.
+       A mission is COMPLETE once every gun is, SENDING while any gun is,
+       RECEIVED once every gun is and SHOT once any gun is. A COMPLETE
+       mission stays that way, and one without guns is left alone.
+
+       on_change is called with the mission ID and the old and new status
+       whenever a mission's status changes.
+    """
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+
+        # Mission dictionaries by ID.
+        self._missions = {}
+
+        # Number of each mission's guns in each status.
+        self._counts = {}
+
+    def __len__(self):
+        return len(self._missions)
+
+    def __contains__(self, mission):
+        return mission in self._missions
+
+    def add(self, mission):
+        """Starts tracking a mission dictionary."""
+
+        self._missions[mission["ID"]] = mission
+        self._counts[mission["ID"]] = collections.Counter(mission["GUN_STATUS"].values())
+
+    def remove(self, mission):
+        """Stops tracking a mission."""
+
+        self._missions.pop(mission, None)
+        self._counts.pop(mission, None)
+
+    def assign(self, mission, guns, status="SENDING"):
+        """Gives a mission a new list of guns, all in the same status."""
+
+        msn = self._missions[mission]
+        msn["GUN_STATUS"] = {gun: status for gun in guns}
+        self._counts[mission] = collections.Counter({status: len(guns)} if guns else {})
+
+        self._refresh(mission)
+
+    def reset(self, mission, status="WAITING"):
+        """Takes every gun off a mission, like when it's corrected."""
+
+        msn = self._missions[mission]
+        msn["GUN_STATUS"] = {}
+        self._counts[mission] = collections.Counter()
+
+        self._set(mission, status)
+
+    def update(self, mission, gun, status):
+        """Records a gun's new status. Guns that aren't on the mission are
+           ignored. Returns the mission's new status if it changed, or None.
+        """
+
+        msn = self._missions.get(mission)
+
+        if msn is None or gun not in msn["GUN_STATUS"]:
+            return None
+
+        old = msn["GUN_STATUS"][gun]
+        if old == status:
+            return None
+
+        counts = self._counts[mission]
+        counts[old] -= 1
+        counts[status] += 1
+        msn["GUN_STATUS"][gun] = status
+
+        return self._refresh(mission)
+
+    def _refresh(self, mission):
+        """Works out a mission's status from its counts."""
+
+        msn = self._missions[mission]
+        counts = self._counts[mission]
+        total = len(msn["GUN_STATUS"])
+
+        if not total or msn["STATUS"] == "COMPLETE":
+            return None
+
+        if counts["COMPLETE"] == total:
+            status = "COMPLETE"
+        elif counts["SENDING"]:
+            status = "SENDING"
+        elif counts["RECEIVED"] == total:
+            status = "RECEIVED"
+        elif counts["SHOT"]:
+            status = "SHOT"
+        else:
+            return None
+
+        return self._set(mission, status)
+
+    def _set(self, mission, status):
+        msn = self._missions[mission]
+        old = msn["STATUS"]
+
+        if old == status:
+            return None
+
+        msn["STATUS"] = status
+
+        if self.on_change:
+            self.on_change(mission, old, status)
+
+        return status
+
+################################
+# ENGINE
+################################
+
+class FdcEngine:
+    """The FDC without a GUI.
+
+       Messages from guns are handled with handle_message, or with poll when
+       the engine is serving them itself. Call tick about once a second to
+       assign guns to waiting missions. Everything should be called from one
+       thread, the network server only passes messages to it through a queue.
+    """
+
+    def __init__(self, center=False, on_change=None):
+        # Use the center of grids instead of their northwest corner.
+        self._center = bool(center)
+
+        # Called with the mission ID and the old and new status when a mission's status changes.
+        self.on_change = on_change
+
+        # Network server, once serve is called.
+        self.server = None
+
+        # Messages from the network server waiting to be handled.
+        self.inbox = queue.Queue()
+
+        # Dictionary of guns connected to the fdc.
+        self.guns = {}
+
+        # Spatial index of the gun positions.
+        self.gun_index = GunIndex(center=self._center)
+
+        # Heightmap of the map being played, if one was loaded.
+        self.heightmap = None
+
+        # Dictionary of active missions.
+        self.missions = {}
+
+        # Keeps the status of each mission in step with its guns.
+        self.tracker = MissionTracker(self.mission_changed)
+
+        # When each mission was generated, until all of its guns receive it.
+        self._created = {}
+
+        # True while a journal is being replayed.
+        self.replaying = False
+
+        # Queues of individual active missions that will be sent down to each gun.
+        self.mission_queue = DispatchQueue()
+
+        # Queues of individual end of missions that will be sent down to each gun.
+        self.eom_queue = DispatchQueue()
+
+        # Journal the changes are written to, if there is one.
+        self.journal = None
+
+        # Server for the metrics, once serve_metrics is called.
+        self.metrics = None
+
+    def record(self, op, **fields):
+        """Writes a change to the journal, so it can be replayed after a restart."""
+
+        if self.journal:
+            self.journal.append(op, fields)
+
+    ################################
+    # NETWORK
+    ################################
+
+    def serve(self, host, port):
+        """Starts a network server for the guns. Raises OSError if the port
+           can't be bound. Returns the port that was bound.
+        """
+
+        # The server needs asyncio, which is slow to import, so it's loaded here.
+        from fdc_net import FdcServer
+
+        self.server = FdcServer(host, port, self.inbox)
+
+        try:
+            self.server.start()
+        except OSError:
+            self.server = None
+            raise
+
+        return self.server.port
+
+    def serve_metrics(self, host="127.0.0.1", port=METRICS_PORT):
+        """Serves the FDC's metrics over HTTP. Raises OSError if the port
+           can't be bound. Returns the port that was bound.
+        """
+
+        self.metrics = MetricsServer(host, port)
+
+        try:
+            return self.metrics.start()
+        except OSError:
+            self.metrics = None
+            raise
+
+    def stop(self):
+        """Stops the network and metrics servers and writes out the journal."""
+
+        if self.server:
+            self.server.stop()
+            self.server = None
+
+        if self.metrics:
+            self.metrics.stop()
+            self.metrics = None
+
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def poll(self, timeout=0):
+        """Handles the messages the network server has received, waiting up
+           to timeout seconds for the first one. Returns the number handled.
+        """
+
+        count = 0
+
+        while True:
+            try:
+                if timeout and not count:
+                    msg = self.inbox.get(timeout=timeout)
+                else:
+                    msg = self.inbox.get_nowait()
+            except queue.Empty:
+                return count
+
+            start = time.perf_counter()
+
+            try:
+                reply = self.handle_message(msg.kind, msg.data)
+            except Exception as e:
+                # A bad message shouldn't stop the FDC.
+                log.warning("Error handling %r: %s", msg, e)
+                MESSAGE_ERRORS.inc()
+                reply = None
+
+            HANDLE_SECONDS.observe(time.perf_counter()-start, msg.kind)
+            msg.reply(reply)
+
+            count += 1
+
+    def push(self, gun, data):
+        """Sends a message to a gun straight away if it's connected in a session.
+           Messages stay queued until the gun answers them either way, so a gun
+           that drops its connection gets them again when it's back.
+        """
+
+        if self.server:
+            self.server.push(gun, data)
+
+    def handle_message(self, kind, data):
+        """Handles a message from a gun and returns the reply to send back, if any."""
+
+        if kind == "GUN":
+
+            # Update gun list.
+            data["KEY"] = self.grid_key(data["GRID"])
+            if self.guns.get(data["NAME"]) != data:
+                self.record("message", kind=kind, data=data)
+            self.guns[data["NAME"]] = data
+            self.gun_index.update(data["NAME"], data["KEY"])
+
+            # End of missions go out before new missions.
+            msg = self.eom_queue.peek(data["NAME"])
+            if msg:
+                return pack("EOM", msg)
+
+            msg = self.mission_queue.peek(data["NAME"])
+            if msg:
+                return pack("TGT", msg)
+
+        elif kind == "PING":
+
+            # A gun opened a session, so send it everything it's still waiting on.
+            waiting = [pack("EOM", i) for i in self.eom_queue.pending(data["NAME"])]
+            waiting += [pack("TGT", i) for i in self.mission_queue.pending(data["NAME"])]
+
+            return b"".join(waiting) or pack("PING", ping_message())
+
+        elif kind == "STATUS":
+
+            self.record("message", kind=kind, data=data)
+
+            # A mission only counts as received once it's off the gun's queue.
+            if data["STATUS"] != "RECEIVED" or self.mission_queue.ack(data["GUN"], data["ID"]):
+                self.tracker.update(data["ID"], data["GUN"], data["STATUS"])
+
+        elif kind == "EOM":
+
+            self.record("message", kind=kind, data=data)
+            self.eom_queue.ack(data["GUN"], data["ID"])
+
+        else:
+            log.warning("Unknown message type %s", kind)
+
+        return None
+
+    def state(self):
+        """Returns everything needed to rebuild the engine, as plain data.
+           It's a copy, so it can be written out on another thread while the
+           engine carries on.
+        """
+
+        # Queued messages are replaced, never changed, so they can be shared.
+        return {"guns": {name: dict(gun) for name, gun in self.guns.items()},
+                "missions": {tgt: dict(mission, GUN_LIST=list(mission["GUN_LIST"]),
+                                       GUN_STATUS=dict(mission["GUN_STATUS"]))
+                             for tgt, mission in self.missions.items()},
+                "mission_queue": list(self.mission_queue.items()),
+                "eom_queue": list(self.eom_queue.items())}
+
+    @property
+    def center(self):
+        return self._center
+
+    @center.setter
+    def center(self, center):
+        """Changing the grid setting moves every gun in the index to match."""
+
+        center = bool(center)
+
+        if center != self._center:
+            self._center = center
+            self.gun_index = GunIndex(center=center)
+
+            for name, gun in self.guns.items():
+                self.gun_index.update(name, gun["KEY"])
+
+    def restore(self, state):
+        """Replaces the guns, missions and queues with a saved state."""
+
+        self.guns.clear()
+        self.missions.clear()
+        self.gun_index = GunIndex(center=self._center)
+        self.tracker = MissionTracker(self.mission_changed)
+        self.mission_queue = DispatchQueue()
+        self.eom_queue = DispatchQueue()
+        self._created.clear()
+
+        # Copied like state() does, so the engine never changes the state it was given.
+        for name, gun in state["guns"].items():
+            self.guns[name] = dict(gun)
+            self.gun_index.update(name, gun["KEY"])
+
+        for tgt, mission in state["missions"].items():
+            self.missions[tgt] = dict(mission, GUN_LIST=list(mission["GUN_LIST"]),
+                                      GUN_STATUS=dict(mission["GUN_STATUS"]))
+            self.tracker.add(self.missions[tgt])
+
+        for gun, tgt, msg in state["mission_queue"]:
+            self.mission_queue.put(gun, tgt, msg)
+
+        for gun, tgt, msg in state["eom_queue"]:
+            self.eom_queue.put(gun, tgt, msg)
+
+    ################################
+    # TERRAIN
+    ################################
+
+    def load_map(self, path):
+        """Loads a heightmap for the terrain clearance checks.
+           Returns False if it couldn't be loaded.
+        """
+
+        # Terrain checks need NumPy, so it's only loaded with a heightmap.
+        try:
+            import smt_terrain
+        except ImportError:
+            log.error("NumPy is needed to use a heightmap.")
+            return False
+
+        try:
+            self.heightmap = smt_terrain.load_heightmap(path)
+        except (OSError, ValueError) as e:
+            log.error("Couldn't load the heightmap: %s", e)
+            return False
+
+        return True
+
+    def clear_guns(self, guns, tgt, profile):
+        """Returns the guns whose shots at a target aren't masked by terrain."""
+
+        if self.heightmap is None or not guns:
+            return guns
+
+        grids = [self.guns[n]["GRID"] for n in guns]
+        tgt = self.missions[tgt]["GRID"]
+
+        from smt_terrain import calc_data_terrain, check_clearance
+
+        # Check the arcs at the elevations corrected for the altitude difference.
+        rn, az, el, tof, dh, mask = calc_data_terrain(grids, tgt, self.heightmap, center=self.center,
+                                                      profile=profile)
+        clear, strike, dist = check_clearance(grids, tgt, el, self.heightmap, center=self.center)
+
+        return [n for n, ok in zip(guns, mask & clear) if ok]
+
+    ################################
+    # MISSIONS
+    ################################
+
+    def grid_key(self, grid):
+        """Returns the integer key of a grid, or None if the grid isn't valid."""
+
+        try:
+            return grid_to_key(grid)
+        except InvalidGridError:
+            return None
+
+    def create_mission(self, tgt, grid, guns, moc="", sheaf="", shell="", rounds=""):
+        """Adds a mission that waits for guns. Returns the mission."""
+
+        self.missions[tgt] = {"ID": tgt,
+                              "GRID": grid,
+                              "KEY": self.grid_key(grid),
+                              "GUNS": guns,
+                              "MOC": moc,
+                              "SHEAF": sheaf,
+                              "SHELL": shell,
+                              "ROUNDS": rounds,
+                              "STATUS": "WAITING",
+                              "GUN_LIST": [],
+                              "GUN_STATUS": {}}
+        self.tracker.add(self.missions[tgt])
+
+        # Replayed missions weren't just generated, so they aren't timed.
+        if not self.replaying:
+            self._created[tgt] = time.monotonic()
+
+        self.record("create", tgt=tgt, grid=grid, guns=guns, moc=moc, sheaf=sheaf,
+                    shell=shell, rounds=rounds)
+
+        return self.missions[tgt]
+
+    def calc(self, guns, tgt):
+        """Calculates the firing data of every gun in a mission's sheaf.
+           Returns None if any of the aim points are out of range.
+        """
+
+        mission = self.missions[tgt]
+
+        # Ballistic profile of the mortar firing this shell, HE if none was picked.
+        profile = find_profile("MORTAR", mission["SHELL"] or "HE")
+
+        CALCS.inc()
+        CALC_GUNS.inc(len(guns))
+
+        try:
+            with CALC_SECONDS.time():
+                gun_grids = [self.guns[i]["GRID"] for i in guns]
+                grids, rn, az, el, tof, ok = calc_sheaf(gun_grids, mission["GRID"],
+                                                        mission["SHEAF"] or "CONVERGED",
+                                                        profile=profile, center=self.center)
+
+                # With a heightmap, guns are sent the data corrected for altitude,
+                # the same as the terrain clearance checks use.
+                if self.heightmap is not None:
+                    from smt_terrain import calc_data_terrain
+
+                    rn, az, el, tof, dh, ok = calc_data_terrain(gun_grids, grids, self.heightmap,
+                                                                center=self.center, profile=profile)
+        except SMTLIB_Error as e:
+            log.warning("Couldn't calculate mission %s: %s", tgt, e)
+            return None
+
+        if not ok.all():
+            return None
+
+        # Turn the arrays back into plain numbers for the guns.
+        num = lambda v: int(v) if float(v).is_integer() else float(v)
+
+        return [(num(rn[n]), num(az[n]), num(el[n]), num(tof[n])) for n in range(len(guns))]
+
+    def tick(self):
+        """Assigns guns to the missions that are waiting for them.
+           Returns the IDs of the missions that were assigned.
+        """
+
+        assigned = []
+        start = time.perf_counter()
+
+        for i in self.missions:
+            if self.missions[i]["STATUS"] == "WAITING" and self.missions[i]["KEY"] is not None:
+                if self.assign(i):
+                    assigned.append(i)
+
+        if self.journal:
+            self.journal.maybe_snapshot(self)
+
+        TICK_SECONDS.observe(time.perf_counter()-start)
+        self.update_gauges()
+
+        return assigned
+
+    def update_gauges(self):
+        """Updates the metrics of the queues, guns and connections."""
+
+        for name, q in (("mission", self.mission_queue), ("eom", self.eom_queue)):
+            depths = q.depths()
+            QUEUE_DEPTH.set(sum(depths.values()), name)
+            QUEUE_MAX_DEPTH.set(max(depths.values(), default=0), name)
+
+        GUNS.set(len(self.guns))
+        MISSIONS.set(len(self.missions))
+
+        if self.server:
+            SESSIONS.set(len(self.server.sessions))
+            CONNECTIONS.set(self.server.clients)
+
+    def mission_changed(self, tgt, old, new):
+        """Called by the tracker when a mission's status changes."""
+
+        # Any status past SENDING means every gun has the mission, even if
+        # one of them fired before the others reported it received.
+        if new not in ("WAITING", "SENDING") and tgt in self._created:
+            RECEIVED_SECONDS.observe(time.monotonic()-self._created.pop(tgt))
+
+        if self.on_change:
+            self.on_change(tgt, old, new)
+
+    def assign(self, tgt):
+        """Assigns guns to a mission and queues their firing data.
+           Returns False if there aren't enough guns that can fire it.
+        """
+
+        mission = self.missions[tgt]
+
+        # Make sure the guns are mission capable and within range.
+        profile = find_profile("MORTAR", mission["SHELL"] or "HE")
+        guns = self.gun_index.query(mission["KEY"], profile=profile,
+                                    where=lambda x: self.guns[x]["CAPABLE"] == "YES")
+        guns = self.clear_guns(guns, tgt, profile)
+
+        try:
+            wanted = int(mission["GUNS"])
+        except ValueError:
+            return False
+
+        if len(guns) < wanted:
+            return False
+
+        guns = guns[:wanted]
+
+        # Don't use a sheaf if there's only one gun!
+        if len(guns) == 1:
+            mission["SHEAF"] = "CONVERGED"
+
+        # Calculate the whole sheaf at once.
+        data = self.calc(guns, tgt)
+        if data is None:
+            return False
+
+        self.dispatch(tgt, guns, data)
+
+        return True
+
+    def dispatch(self, tgt, guns, data):
+        """Gives a mission to guns and queues the firing data of each one."""
+
+        mission = self.missions[tgt]
+
+        self.record("dispatch", tgt=tgt, guns=guns, data=data, sheaf=mission["SHEAF"])
+
+        mission["GUN_LIST"] = guns
+        self.tracker.assign(tgt, guns, "SENDING")
+
+        for n in range(len(guns)):
+            self.queue_mission(guns[n], tgt, data[n])
+            self.guns[guns[n]]["CAPABLE"] = "NO"
+
+    def correct_mission(self, tgt, direction, dev_cor="0", rn_cor="0"):
+        """Moves a mission's target by a correction and sends it out again."""
+
+        self.retarget(tgt, correction_offset(self.missions[tgt]["GRID"], direction,
+                                             dev_cor or "0", rn_cor or "0"))
+
+    def retarget(self, tgt, grid):
+        """Moves a mission to a new grid, ends it for its guns and waits for
+           guns to be assigned again.
+        """
+
+        self.record("retarget", tgt=tgt, grid=grid)
+
+        mission = self.missions[tgt]
+        mission["GRID"] = grid
+        mission["KEY"] = self.grid_key(grid)
+
+        for i in mission["GUN_LIST"]:
+            self.queue_eom(i, tgt)
+
+        # Firing data for the old grid mustn't reach guns that haven't got it yet.
+        self.mission_queue.drop(tgt)
+
+        mission["GUN_LIST"] = []
+        self.tracker.reset(tgt, "WAITING")
+
+    def end_mission(self, tgt):
+        """Ends a mission and tells its guns."""
+
+        self.record("end", tgt=tgt)
+
+        for i in self.missions[tgt]["GUN_LIST"]:
+            self.queue_eom(i, tgt)
+
+        self.mission_queue.drop(tgt)
+
+        del self.missions[tgt]
+        self.tracker.remove(tgt)
+        self._created.pop(tgt, None)
+
+    # Adds a mission to a queue that will be sent over network to the gun.
+    def queue_mission(self, gun, tgt, data):
+        msg = mission_message(gun, self.missions[tgt], data)
+        self.mission_queue.put(gun, tgt, msg)
+        self.push(gun, pack("TGT", msg))
+
+    # Adds an end of mission to the queue that will be sent to the gun.
+    def queue_eom(self, gun, tgt):
+        msg = eom_message(tgt, gun)
+        self.eom_queue.put(gun, tgt, msg)
+        self.push(gun, pack("EOM", msg))
+
+################################
+# DAEMON
+################################
+
+def load_missions(engine, path):
+    """Creates the missions in a JSON lines file. Each line has the ID, GRID
+       and GUNS of a mission, and optionally its MOC, SHEAF, SHELL and ROUNDS.
+       Missions that already exist, like ones replayed from a journal, are skipped.
+    """
+
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                i = json.loads(line)
+                if str(i["ID"]) in engine.missions:
+                    continue
+                engine.create_mission(str(i["ID"]), i["GRID"], str(i["GUNS"]), i.get("MOC", ""),
+                                      i.get("SHEAF", ""), i.get("SHELL", ""), str(i.get("ROUNDS", "")))
+
+def run(engine, interval=1.0):
+    """Handles messages and ticks the engine until interrupted."""
+
+    next_tick = time.monotonic()+interval
+
+    while True:
+        engine.poll(max(0.0, next_tick-time.monotonic()))
+
+        if time.monotonic() >= next_tick:
+            engine.tick()
+            next_tick += interval
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the FDC without a GUI.")
+    parser.add_argument("--host", default="", help="address to listen on (default: all)")
+    parser.add_argument("--port", type=int, default=844, help="port to listen on (default: 844)")
+    parser.add_argument("--center", action="store_true",
+                        help="use the center of each grid instead of its northwest corner")
+    parser.add_argument("--map", help="heightmap used to skip guns masked by terrain")
+    parser.add_argument("--missions", help="JSON lines file of missions to fire")
+    parser.add_argument("--journal", help="directory to keep the FDC's state in, so it survives a restart")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between ticks (default: 1)")
+    parser.add_argument("--metrics", type=int, metavar="PORT",
+                        help="serve metrics on this port of localhost (default: off, usually {})".format(METRICS_PORT))
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        type=str.upper, help="lowest level of messages to log (default: INFO)")
+    args = parser.parse_args(argv)
+
+    setup_logging(args.log_level)
+
+    engine = FdcEngine(center=args.center,
+                       on_change=lambda tgt, old, new: log.info("Mission %s: %s -> %s", tgt, old, new))
+
+    try:
+        if args.map and not engine.load_map(args.map):
+            return 1
+        if args.journal:
+            log.info("Replayed %s changes", Journal(args.journal).load(engine))
+        if args.missions:
+            load_missions(engine, args.missions)
+        if args.metrics is not None:
+            log.info("Metrics served on port %s", engine.serve_metrics(port=args.metrics))
+        port = engine.serve(args.host, args.port)
+    except (OSError, ValueError, KeyError, JournalError) as e:
+        log.error("%s", e)
+        engine.stop()
+        return 1
+
+    log.info("FDC listening on port %s", port)
+
+    # Stop cleanly when the daemon is killed, so the journal is written out.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    try:
+        run(engine, args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.stop()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,336 @@
+"""A write-ahead journal of the FDC's state.
+
+Every change the FDC makes to its guns, missions and queues is appended to a
+journal as a line of JSON, and every so often the whole state is written to
+a snapshot and the journal is started over. After a crash or a restart, the
+snapshot is loaded and the journal replayed on top of it.
+
+The FDC doesn't wait on the disk. Changes are put on a queue and written by
+a background thread, which syncs the journal to disk once per batch instead
+of once per change. A crash can lose the changes of the last sync interval.
+
+    journal = Journal("fdc-state")
+    journal.load(engine)    # Replays the saved state into a new engine.
+    ...
+    journal.close()
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+__all__ = [
+    "Journal",
+    "JournalError"
+    ]
+
+log = logging.getLogger("fdc.journal")
+
+################################
+# JOURNAL VARIABLES
+################################
+
+# Seconds between syncs of the journal to disk.
+sync_interval = 0.05
+
+# Changes written to the journal before a snapshot is taken.
+snapshot_every = 10000
+
+# Seconds between snapshots, as long as something changed.
+snapshot_interval = 300.0
+
+JOURNAL_FILE = "journal.jsonl"
+SNAPSHOT_FILE = "snapshot.json"
+
+# State of an FDC that has nothing yet.
+EMPTY = {"guns": {}, "missions": {}, "mission_queue": [], "eom_queue": []}
+
+################################
+# EXCEPTIONS
+################################
+
+class JournalError(Exception):
+    """Exception for a journal or snapshot that can't be used."""
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return "Journal error: {}".format(self.reason)
+
+################################
+# JOURNAL
+################################
+
+class Journal:
+    """An append-only journal with snapshots, kept in a directory.
+
+       Changes are numbered, and a snapshot remembers the number of the last
+       change it includes, so replaying never applies a change twice.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seq = 0
+
+        # Changes since the last snapshot.
+        self.changes = 0
+        self.last_snapshot = time.monotonic()
+
+        # Number of times the journal was synced to disk.
+        self.syncs = 0
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._file = None
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.path, JOURNAL_FILE)
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.path, SNAPSHOT_FILE)
+
+    ################################
+    # RECOVERY
+    ################################
+
+    def load(self, engine):
+        """Rebuilds an engine from the snapshot and journal, then starts
+           journaling its changes. Returns the number of changes replayed.
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Nothing that's replayed should be journaled again.
+        engine.journal = None
+
+        # Start from nothing if there's no snapshot.
+        snapshot = {"seq": 0, "state": EMPTY}
+
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError) as e:
+                raise JournalError("bad snapshot {}: {}".format(self.snapshot_path, e))
+
+        try:
+            seq = int(snapshot["seq"])
+            engine.restore(snapshot["state"])
+        except (KeyError, TypeError, ValueError) as e:
+            raise JournalError("bad snapshot {}: {}".format(self.snapshot_path, e))
+
+        self.seq = seq
+
+        count = 0
+
+        if os.path.exists(self.journal_path):
+            engine.replaying = True
+
+            # Bytes up to the end of the last whole change.
+            good = 0
+
+            try:
+                with open(self.journal_path, "rb") as f:
+                    for line in f:
+                        # The last line is cut short if the FDC died while writing it.
+                        if not line.endswith(b"\n"):
+                            break
+
+                        good += len(line)
+
+                        try:
+                            record = json.loads(line)
+                            seq = int(record["seq"])
+                        except (ValueError, KeyError, TypeError) as e:
+                            log.warning("Skipped a bad line in %s: %s", self.journal_path, e)
+                            continue
+
+                        if seq <= self.seq:
+                            continue
+
+                        try:
+                            replay(engine, record)
+                        except (KeyError, IndexError, ValueError) as e:
+                            log.warning("Couldn't replay change %s: %s", seq, e)
+
+                        self.seq = seq
+                        count += 1
+            finally:
+                engine.replaying = False
+
+            # Cut off the torn line, or new changes would be appended to it
+            # and lost on the next replay.
+            if good < os.path.getsize(self.journal_path):
+                log.warning("Dropped a torn change at the end of %s", self.journal_path)
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(good)
+
+        self.changes = count
+        self.start()
+        engine.journal = self
+
+        return count
+
+    ################################
+    # WRITING
+    ################################
+
+    def start(self):
+        """Starts the thread that writes the journal."""
+
+        if self._thread:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        self._file = open(self.journal_path, "a")
+        self._thread = threading.Thread(target=self._run, name="fdc-journal", daemon=True)
+        self._thread.start()
+
+    def append(self, op, fields):
+        """Adds a change to the journal. The change is turned into JSON
+           straight away, since the FDC keeps changing its dictionaries.
+        """
+
+        self.seq += 1
+        self.changes += 1
+
+        fields["op"] = op
+        fields["seq"] = self.seq
+        self._queue.put(json.dumps(fields))
+
+    def maybe_snapshot(self, engine):
+        """Takes a snapshot if enough has changed since the last one."""
+
+        if not self.changes:
+            return
+
+        if self.changes >= snapshot_every or time.monotonic()-self.last_snapshot >= snapshot_interval:
+            self.snapshot(engine)
+
+    def snapshot(self, engine):
+        """Saves the engine's whole state, after which the journal starts over.
+           The state is copied here but turned into JSON on the writer thread.
+        """
+
+        self._queue.put((self.seq, engine.state()))
+
+        self.changes = 0
+        self.last_snapshot = time.monotonic()
+
+    def flush(self):
+        """Waits until everything appended so far is on disk."""
+
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """Writes everything that's waiting and stops the writer."""
+
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        f = self._file
+        dirty = False
+        last_sync = time.monotonic()
+
+        while True:
+            try:
+                items = [self._queue.get(timeout=sync_interval)]
+            except queue.Empty:
+                items = []
+
+            # Write everything that's waiting as one batch.
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            waiting = []
+
+            for item in items:
+                if item is None:
+                    stop = True
+                elif isinstance(item, str):
+                    f.write(item+"\n")
+                    dirty = True
+                elif isinstance(item, tuple):
+                    f = self._compact(f, *item)
+                    dirty = False
+                else:
+                    waiting.append(item)
+
+            if dirty and (stop or waiting or time.monotonic()-last_sync >= sync_interval):
+                f.flush()
+                os.fsync(f.fileno())
+                self.syncs += 1
+                dirty = False
+                last_sync = time.monotonic()
+
+            for i in waiting:
+                i.set()
+
+            if stop:
+                f.close()
+                return
+
+    def _compact(self, f, seq, state):
+        """Writes a snapshot and starts the journal over. Everything in the
+           journal is older than the snapshot, so it isn't needed anymore.
+        """
+
+        tmp = self.snapshot_path+".tmp"
+
+        with open(tmp, "w") as s:
+            json.dump({"seq": seq, "state": state}, s)
+            s.flush()
+            os.fsync(s.fileno())
+
+        os.replace(tmp, self.snapshot_path)
+
+        # If this is cut short, replay skips the changes the snapshot has.
+        f.close()
+        f = open(self.journal_path, "w")
+        self._file = f
+
+        return f
+
+################################
+# REPLAY
+################################
+
+def replay(engine, record):
+    """Applies a change from the journal to an engine."""
+
+    op = record["op"]
+
+    if op == "message":
+        engine.handle_message(record["kind"], record["data"])
+
+    elif op == "create":
+        engine.create_mission(record["tgt"], record["grid"], record["guns"], record["moc"],
+                              record["sheaf"], record["shell"], record["rounds"])
+
+    elif op == "dispatch":
+        engine.missions[record["tgt"]]["SHEAF"] = record["sheaf"]
+        engine.dispatch(record["tgt"], record["guns"], record["data"])
+
+    elif op == "retarget":
+        engine.retarget(record["tgt"], record["grid"])
+
+    elif op == "end":
+        engine.end_mission(record["tgt"])
+
+    else:
+        raise ValueError("unknown change {!r}".format(op))
@@ -0,0 +1,348 @@
+"""Metrics and logging for the FDC.
+
+Counters, gauges and histograms are kept in a registry and can be served in
+the Prometheus text format from a small HTTP server on its own thread:
+
+    server = MetricsServer("127.0.0.1", 9844)
+    server.start()
+
+    curl http://127.0.0.1:9844/metrics
+
+Every metric can be updated from any thread. Updates only take a lock and
+add a few numbers, so they're cheap enough for the FDC's hot paths.
+
+The FDC logs through the standard logging module. setup_logging sets the
+level and limits how often the same message is logged, so a flood of bad
+messages can't slow the FDC down.
+"""
+
+import time
+import bisect
+import logging
+import threading
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "MetricsServer",
+    "RateLimitFilter",
+    "REGISTRY",
+    "Registry",
+    "setup_logging"
+    ]
+
+################################
+# METRICS VARIABLES
+################################
+
+# Histogram buckets for durations in seconds.
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Default port of the metrics server.
+METRICS_PORT = 9844
+
+################################
+# METRICS
+################################
+
+def _labels(names, values):
+    """Formats label values like {type="GUN"}."""
+
+    if not names:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for n, v in zip(names, values)) + "}"
+
+def _number(v):
+    if v == float("inf"):
+        return "+Inf"
+
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+        # Metrics without labels are shown as zero before they're first used.
+        if not self.labels:
+            self._values[()] = self._zero()
+
+    def _zero(self):
+        return 0
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("{} needs the labels {}".format(self.name, self.labels))
+
+        return tuple(labels)
+
+    def render(self):
+        """Returns the metric in the Prometheus text format."""
+
+        lines = ["# HELP {} {}".format(self.name, self.doc),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for key, value in values:
+            lines.append("{}{} {}".format(self.name, _labels(self.labels, key), _number(value)))
+
+        return lines
+
+class Counter(_Metric):
+    """A number that only goes up, like the messages handled."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, *labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0)+amount
+
+class Gauge(_Metric):
+    """A number that goes up and down, like a queue depth."""
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, *labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0)+amount
+
+class Histogram(_Metric):
+    """Counts observations, like durations, in buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, doc, labels)
+
+    def _zero(self):
+        # A count per bucket, then the sum.
+        return [0]*(len(self.buckets)+1)+[0.0]
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        n = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = self._zero()
+
+            counts[n] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        """Returns a context manager that observes how long its block took."""
+
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.doc),
+                 "# TYPE {} histogram".format(self.name)]
+
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+
+        for key, counts in values:
+            total = 0
+
+            for bound, count in zip(self.buckets+(float("inf"),), counts):
+                total += count
+                lines.append("{}_bucket{} {}".format(self.name, _labels(self.labels+("le",), key+(_number(bound),)),
+                                                     total))
+
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.labels, key), _number(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.labels, key), total))
+
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter()-self.start, *self.labels)
+
+class Registry:
+    """A set of metrics that are served together."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _add(self, cls, name, *args, **kw):
+        with self._lock:
+            metric = self._metrics.get(name)
+
+            # Modules that are imported again get the same metric back.
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kw)
+            elif type(metric) is not cls:
+                raise ValueError("{} is already a {}".format(name, metric.kind))
+
+            return metric
+
+    def counter(self, name, doc, labels=()):
+        return self._add(Counter, name, doc, labels)
+
+    def gauge(self, name, doc, labels=()):
+        return self._add(Gauge, name, doc, labels)
+
+    def histogram(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        return self._add(Histogram, name, doc, labels, buckets=buckets)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+
+        lines = []
+        for name, metric in metrics:
+            lines += metric.render()
+
+        return "\n".join(lines)+"\n"
+
+# The registry the FDC's metrics are kept in.
+REGISTRY = Registry()
+
+################################
+# HTTP SERVER
+################################
+
+class MetricsServer:
+    """Serves a registry at /metrics from an HTTP server on its own thread."""
+
+    def __init__(self, host="127.0.0.1", port=METRICS_PORT, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Starts the server thread. Raises OSError if the port can't be bound.
+           Returns the port that was bound.
+        """
+
+        # The HTTP server is only imported when metrics are served.
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log.debug("Metrics request: "+fmt, *args)
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fdc-metrics", daemon=True)
+        self._thread.start()
+
+        return self.port
+
+    def stop(self):
+        """Stops the server and waits for its thread to finish."""
+
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+################################
+# LOGGING
+################################
+
+log = logging.getLogger("fdc")
+
+class RateLimitFilter(logging.Filter):
+    """Lets each message through at most burst times every per seconds.
+
+       Messages are told apart by their level and format string, so the same
+       error from many guns counts as one message. Once a message is let
+       through again, it says how many like it were dropped.
+    """
+
+    def __init__(self, burst=5, per=10.0):
+        super().__init__()
+        self.burst = burst
+        self.per = per
+
+        # Start of the window, messages let through and dropped, by message.
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.levelno, record.msg)
+        now = time.monotonic()
+
+        with self._lock:
+            start, passed, dropped = self._seen.get(key, (now, 0, 0))
+
+            if now-start >= self.per:
+                start, passed = now, 0
+
+            if passed >= self.burst:
+                self._seen[key] = (start, passed, dropped+1)
+                return False
+
+            self._seen[key] = (start, passed+1, 0)
+
+        if dropped:
+            record.msg = "{} ({} like this dropped)".format(record.msg, dropped)
+
+        return True
+
+def setup_logging(level="INFO", burst=5, per=10.0):
+    """Logs the FDC's messages to stderr at a level, rate limited."""
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(RateLimitFilter(burst, per))
+
+    log.handlers[:] = [handler]
+    log.setLevel(level.upper() if isinstance(level, str) else level)
+    log.propagate = False
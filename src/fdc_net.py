@@ -0,0 +1,293 @@
+"""The FDC's network server.
+
+An asyncio server runs on its own thread and services any number of MC
+connections at once. Messages aren't handled on the network thread. Each one
+is put on a thread-safe queue for the FDC to pick up, and the FDC hands back
+the reply to send, so all of the FDC's state stays on one thread.
+
+Most connections carry a single message and its reply. A gun that opens with
+a PING keeps its connection instead: it becomes the gun's session, the FDC
+can push messages down it at any time with push, and later PINGs are
+answered here without bothering the FDC. Gun reports the FDC has nothing to
+say to get a PING back too.
+"""
+
+import time
+import queue
+import asyncio
+import logging
+import collections
+import threading
+
+from smt_proto import Decoder, pack, ping_message, ProtocolError
+from fdc_metrics import REGISTRY
+
+__all__ = [
+    "FdcServer",
+    "Message"
+    ]
+
+log = logging.getLogger("fdc.net")
+
+DECODE_SECONDS = REGISTRY.histogram("fdc_decode_seconds", "Time taken to decode a message from a gun.",
+                                    ("type",))
+BAD_MESSAGES = REGISTRY.counter("fdc_bad_messages_total", "Connections dropped for a bad or late message.")
+
+################################
+# SERVER VARIABLES
+################################
+
+# Most bytes a client can send before its message is complete.
+max_message = 65536
+
+# Seconds a client has to send its message.
+read_timeout = 5.0
+
+# Seconds to wait for the FDC to answer a message before giving up.
+reply_timeout = 3.0
+
+# Seconds a session can go without sending anything before it's dropped.
+idle_timeout = 15.0
+
+# Reply to the PINGs that keep a session alive.
+PONG = pack("PING", ping_message())
+
+################################
+# MESSAGES
+################################
+
+class Message:
+    """A message from a client waiting on the FDC's inbox.
+
+       Call reply with the bytes to send back, or None to send nothing.
+       Every message should be replied to, so the client isn't left waiting.
+    """
+
+    def __init__(self, kind, data, address, loop, future):
+        self.kind = kind
+        self.data = data
+        self.address = address
+        self._loop = loop
+        self._future = future
+
+    def __repr__(self):
+        return "Message({!r}, {!r})".format(self.kind, self.data)
+
+    def reply(self, data=None):
+        """Sends a reply to the client. Safe to call from any thread."""
+
+        self._loop.call_soon_threadsafe(self._set, data)
+
+    def _set(self, data):
+        if not self._future.done():
+            self._future.set_result(data)
+
+################################
+# SERVER
+################################
+
+class FdcServer:
+    """An asyncio server on its own thread that puts messages on an inbox."""
+
+    def __init__(self, host, port, inbox=None):
+        self.host = host
+        self.port = port
+        self.inbox = queue.Queue() if inbox is None else inbox
+
+        self.clients = 0
+        self.messages = 0
+
+        self._loop = None
+        self._thread = None
+        self._stopping = None
+        self._ready = threading.Event()
+        self._error = None
+
+        # Writers of the guns that are connected in sessions, by gun name.
+        self._sessions = {}
+
+    def start(self):
+        """Starts the server thread. Raises OSError if the port can't be bound."""
+
+        self._thread = threading.Thread(target=self._run, name="fdc-server", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+        if self._error:
+            raise self._error
+
+    def stop(self):
+        """Stops the server and waits for its thread to finish."""
+
+        if self._loop and self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+            self._thread.join()
+
+    @property
+    def sessions(self):
+        """Returns the names of the guns connected in sessions."""
+
+        return list(self._sessions)
+
+    def push(self, name, data):
+        """Sends bytes to a gun if it's connected in a session. Safe to call
+           from any thread. Returns False if the gun has no session, in which
+           case it gets the message in reply to its next report instead.
+        """
+
+        if name not in self._sessions:
+            return False
+
+        self._loop.call_soon_threadsafe(self._push, name, data)
+        return True
+
+    def _push(self, name, data):
+        writer = self._sessions.get(name)
+
+        if writer and not writer.is_closing():
+            writer.write(data)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._loop.close()
+
+    async def _serve(self):
+        self._stopping = asyncio.Event()
+
+        try:
+            server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as e:
+            self._error = e
+            self._ready.set()
+            return
+
+        # Use the port that was actually bound, in case it was 0.
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+
+        async with server:
+            await self._stopping.wait()
+
+        # Sessions stay open until they're closed, which lets their handlers finish.
+        for writer in list(self._sessions.values()):
+            writer.close()
+
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=reply_timeout)
+
+    async def _read(self, reader, decoder, pending):
+        """Reads a client's next message, or (None, None) if it closed the
+           connection between messages. Messages that arrived together wait
+           in pending.
+        """
+
+        while not pending:
+            if len(decoder) >= max_message:
+                raise ProtocolError("message too large")
+
+            chunk = await reader.read(4096)
+
+            if not chunk:
+                # Connections that don't send anything are just tests.
+                if not len(decoder):
+                    return (None, None)
+                raise ProtocolError("connection closed mid message")
+
+            start = time.perf_counter()
+            msgs = decoder.feed(chunk)
+
+            # Messages that arrive together share the time it took.
+            if msgs:
+                t = (time.perf_counter()-start)/len(msgs)
+                for kind, data in msgs:
+                    DECODE_SECONDS.observe(t, kind)
+
+            pending.extend(msgs)
+
+        return pending.popleft()
+
+    async def _ask(self, kind, data, address):
+        """Passes a message to the FDC and returns its reply, or None if it
+           didn't answer in time.
+        """
+
+        self.messages += 1
+        future = self._loop.create_future()
+        self.inbox.put(Message(kind, data, address, self._loop, future))
+
+        try:
+            return await asyncio.wait_for(future, reply_timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _handle(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        decoder = Decoder()
+        pending = collections.deque()
+        name = None
+        self.clients += 1
+
+        try:
+            try:
+                kind, data = await asyncio.wait_for(self._read(reader, decoder, pending), read_timeout)
+            except (ProtocolError, asyncio.TimeoutError) as e:
+                log.warning("Bad message from %s: %s", address, e)
+                BAD_MESSAGES.inc()
+                return
+
+            if kind is None:
+                return
+
+            # A PING with a name opens a session, anything else gets a single reply.
+            if kind == "PING" and data["NAME"]:
+                name = data["NAME"]
+
+                old = self._sessions.get(name)
+                if old:
+                    old.close()
+                self._sessions[name] = writer
+
+            opening = True
+
+            while kind is not None:
+                # Only the PING that opens a session goes to the FDC, so it
+                # can resend anything the gun missed while it was away.
+                if kind == "PING" and not opening:
+                    reply = PONG
+                else:
+                    reply = await self._ask(kind, data, address)
+
+                opening = False
+
+                # Reports over a session are always answered, so the gun
+                # knows the FDC is still there even with nothing to send it.
+                if not reply and name is not None and kind == "GUN":
+                    reply = PONG
+
+                if reply:
+                    writer.write(reply)
+                    await writer.drain()
+
+                if name is None:
+                    break
+
+                try:
+                    kind, data = await asyncio.wait_for(self._read(reader, decoder, pending), idle_timeout)
+                except (ProtocolError, asyncio.TimeoutError) as e:
+                    log.info("Dropped session of %s: %s", name, e)
+                    break
+
+        except (ConnectionError, OSError):
+            pass
+
+        finally:
+            if name and self._sessions.get(name) is writer:
+                del self._sessions[name]
+
+            self.clients -= 1
+            writer.close()
@@ -1,128 +1,276 @@
 import sys
 import math
+import time
+import select
 import socket
-import pickle
 import tkinter as tk
-from tkinter import ttk
+from tkinter import ttk, BooleanVar
 from tkinter.font import *
 
+from smt_proto import *
+
+################################
+# CONNECTION VARIABLES
+################################
+
+# Seconds between heartbeats of a persistent connection.
+ping_interval = 2.0
+
+# Seconds without hearing from the FDC before the connection is dropped.
+dead_timeout = 10.0
+
+# Most seconds to wait between tries to reconnect.
+max_retry = 16.0
+
+# Seconds to wait for the FDC to accept a connection.
+connect_timeout = 3.0
 
 class Application(tk.Frame):
     def __init__(self, master=None):
         super().__init__(master)
         self.master = master  
         self.pack()
-        self.create_widgets()
 
-        self.FLAGS = {"GUN": b"AA",
-                      "TGT": b"BB",
-                      "EOM": b"CC"}
+        self.persistent = BooleanVar()
+
+        self.create_widgets()
 
         self.fdc = None
 
         self.set_status = ""
         self.set_eom = ""
 
+        # State of a persistent connection.
+        self.decoder = None
+        self.last_report = None
+        self.last_seen = 0
+        self.retry = ping_interval
+
         # Only run if we're on Windows.
         if sys.platform == "win32":
             import ctypes
             ctypes.windll.shcore.SetProcessDpiAwareness(1) # Fixes blurry font.
 
     def connect(self):
-        # Open up a socket.
-        self.fdc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.cnt["state"] = "disabled"
+        self.persistbox["state"] = "disabled"
 
-        self.after(1000, self.update)
+        if self.persistent.get():
+            self.after(0, self.heartbeat)
+        else:
+            self.after(1000, self.update)
 
+    def report(self):
+        """Returns this gun's report for the FDC."""
 
-    def update(self):
-        print("Updating!")
-        data = {"NAME": self.id1.get(),
-                "GRID": self.grid1.get(),
-                "AMMO": self.ammo.get(),
-                "STATUS": self.status1.get(),
-                "CAPABLE": self.mission.get(),
-                "MISSION": self.tgt_id.get()}
-
-        if not self.id1.get():
-            pass
+        return gun_report(self.id1.get(), self.grid1.get(), self.ammo.get(),
+                          self.status1.get(), self.mission.get(), self.tgt_id.get())
 
-        if not self.grid1.get():
-            data["GRID"] = "N/A"
+    def pending(self, data):
+        """Returns the EOM or status message waiting to be sent, if there is one."""
 
-        if not self.ammo.get():
-            data["AMMO"] = "N/A"
+        if self.set_eom:
+            msg = pack("EOM", eom_message(self.set_eom, data["NAME"], "EOM"))
+            self.set_eom = ""
+            return msg
 
-        if not self.status1.get():
-            data["STATUS"] = "OUT OF ACTION"
+        if self.set_status:
+            msg = pack("STATUS", status_message(data["MISSION"], data["NAME"], self.set_status))
+            self.set_status = ""
+            return msg
 
-        if not self.mission.get() or self.tgt_id.get():
-            data["CAPABLE"] = "NO"
+        return None
 
+    def update(self):
+        print("Updating!")
+        data = self.report()
 
         self.fdc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.fdc.connect((self.fdc_ip.get(), int(self.fdc_port.get())))
 
 
         # SEND DATA TO THE FDC.
-        if self.set_eom:
-            self.fdc.sendall(self.FLAGS["EOM"]+pickle.dumps({"ID": self.set_eom,
-                                                             "GUN": data["NAME"],
-                                                             "STATUS": "EOM"}))
-            self.set_eom = ""
+        self.fdc.sendall(self.pending(data) or pack("GUN", data))
 
-        elif self.set_status:
-            self.fdc.sendall(self.FLAGS["TGT"]+pickle.dumps({"ID": data["MISSION"],
-                                                          "GUN": data["NAME"],
-                                                          "STATUS": self.set_status}))
-            self.set_status = ""
 
-        else:
-            self.fdc.sendall(self.FLAGS["GUN"]+pickle.dumps(data))
+        # RECEIVE DATA FROM THE FDC.
+        self.handle(*self.receive())
 
+        self.fdc.shutdown(1)
+        self.fdc.close()
 
-        # RECEIVE DATA FROM THE FDC.
-        try:
-            self.fdc.settimeout(4)
-            data = self.fdc.recv(2048)
-        except:
-            data = None
 
+        # Threading problem. Needs to be time took since last update + 5,
+        # otherwise they can back up and freeze the system.
+        self.after(3000, self.update)
 
+    def handle(self, kind, data):
+        """Handles a message from the FDC."""
 
         if not data:
             pass
 
-        elif data[:2] == self.FLAGS["EOM"]:
+        elif kind == "EOM":
             print("EOM!")
-            data = pickle.loads(data[2:])
 
             self.set_eom = data["ID"]
 
             if data["ID"] == self.tgt_id.get():
                 self.eom()
 
-
-
-        elif data[:2] == self.FLAGS["TGT"]:
-            data = pickle.loads(data[2:])
+        elif kind == "TGT":
             print(data)
 
             if not self.tgt_id.get():
                 self.process(data)
                 self.set_status = "RECEIVED"
 
+        elif kind == "PING":
+            pass
+
         else:
             print(data)
 
-        self.fdc.shutdown(1)
-        self.fdc.close()
+    def receive(self, timeout=4):
+        """Reads one reply from the FDC. Replies can arrive in pieces, so keep
+        reading until a whole message is in or the FDC closes the connection.
+        Returns (None, None) if there's no reply.
+        """
 
+        decoder = Decoder()
+        self.fdc.settimeout(timeout)
 
-        # Threading problem. Needs to be time took since last update + 5,
-        # otherwise they can back up and freeze the system.
-        self.after(3000, self.update)
+        try:
+            while True:
+                data = self.fdc.recv(4096)
+                if not data:
+                    break
+
+                msgs = decoder.feed(data)
+                if msgs:
+                    return msgs[0]
+
+        except (OSError, ProtocolError) as e:
+            print(e)
+
+        return (None, None)
+
+    ################################
+    # PERSISTENT CONNECTION
+    ################################
+
+    def open(self):
+        """Connects to the FDC and opens a session for this gun.
+        Returns False if the FDC can't be reached.
+        """
 
+        try:
+            self.fdc = socket.create_connection((self.fdc_ip.get(), int(self.fdc_port.get())),
+                                                timeout=connect_timeout)
+            self.fdc.sendall(pack("PING", ping_message(self.id1.get())))
+        except (OSError, ValueError) as e:
+            print("Couldn't connect to the FDC: {}".format(e))
+            self.close()
+            return False
+
+        self.decoder = Decoder()
+        self.last_report = None
+        self.last_seen = time.monotonic()
+        self.retry = ping_interval
+
+        # The FDC pushes messages at any time, so check for them often.
+        self.after(50, self.poll, self.fdc)
+
+        return True
+
+    def close(self):
+        if self.fdc:
+            try:
+                self.fdc.close()
+            except OSError:
+                pass
+
+        self.fdc = None
+
+    def send(self, data):
+        """Sends a message over the session. Drops the session if it fails."""
+
+        try:
+            self.fdc.sendall(data)
+        except OSError as e:
+            print("Lost the FDC: {}".format(e))
+            self.close()
+            return False
+
+        return True
+
+    def flush(self):
+        """Sends any EOM or status message straight away instead of waiting
+        for the next heartbeat.
+        """
+
+        if self.fdc and self.persistent.get():
+            msg = self.pending(self.report())
+            if msg:
+                self.send(msg)
+
+    def heartbeat(self):
+        """Keeps the session alive. Reports are only sent when they change,
+        otherwise a PING is enough. Reconnects if the session was lost,
+        waiting longer after each failed try.
+        """
+
+        if not self.fdc:
+            if not self.open():
+                self.retry = min(self.retry*2, max_retry)
+                self.after(int(self.retry*1000), self.heartbeat)
+                return
+
+        # Drop a session the FDC stopped answering, the next heartbeat reconnects.
+        if time.monotonic()-self.last_seen > dead_timeout:
+            print("The FDC stopped answering.")
+            self.close()
+            self.after(0, self.heartbeat)
+            return
+
+        data = self.report()
+        self.flush()
+
+        if self.fdc and data != self.last_report:
+            if self.send(pack("GUN", data)):
+                self.last_report = data
+        elif self.fdc:
+            self.send(pack("PING", ping_message(data["NAME"])))
+
+        self.after(int(ping_interval*1000), self.heartbeat)
+
+    def poll(self, sock):
+        """Handles the messages the FDC has sent over the session."""
+
+        # Stop once the session this was polling is gone.
+        if self.fdc is not sock:
+            return
+
+        try:
+            while select.select([self.fdc], [], [], 0)[0]:
+                data = self.fdc.recv(4096)
+                if not data:
+                    raise ConnectionError("connection closed")
+
+                self.last_seen = time.monotonic()
+
+                for kind, msg in self.decoder.feed(data):
+                    self.handle(kind, msg)
+
+        except (OSError, ProtocolError) as e:
+            print("Lost the FDC: {}".format(e))
+            self.close()
+            return
+
+        # Answer anything that was handled right away.
+        self.flush()
+
+        self.after(50, self.poll, sock)
 
     def eom(self):
         self.tgt_id["state"] = "normal"
@@ -195,9 +343,11 @@ class Application(tk.Frame):
 
     def do_shot(self):
         self.set_status = "SHOT"
+        self.flush()
 
     def do_complete(self):
         self.set_status = "COMPLETE"
+        self.flush()
 
     def create_widgets(self):
         # Configure the font.
@@ -252,6 +402,11 @@ class Application(tk.Frame):
         self.fdc_port = tk.Entry(self, width=20, font=font)
         self.fdc_port.grid(row=6, column=1)
 
+        # KEEP THE CONNECTION OPEN SO MISSIONS ARRIVE RIGHT AWAY.
+        self.persistbox = ttk.Checkbutton(self, text="PERSISTENT", variable=self.persistent,
+                                          onvalue=True, offvalue=False)
+        self.persistbox.grid(row=7, column=1)
+
 
         # TARGET ID
         self.lb6 = tk.Label(self, text="TARGET ID: ", font=font)
@@ -313,7 +468,11 @@ class Application(tk.Frame):
         self.quit.grid(row=8, column=10, padx=2, pady=10)
 
 
-root = tk.Tk()
-app = Application(master=root)
-app.master.title("Squad Mortar Toolkit - Mortar Calculator Software")
-app.mainloop()
+def main():
+    root = tk.Tk()
+    app = Application(master=root)
+    app.master.title("Squad Mortar Toolkit - Mortar Calculator Software")
+    app.mainloop()
+
+if __name__ == "__main__":
+    main()
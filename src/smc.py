@@ -1,9 +1,8 @@
 import sys
 import math
 import tkinter as tk
-from tkinter import *
+from tkinter import BooleanVar, Checkbutton
 from tkinter.font import *
-import keyboard
 
 from smt_lib import *
 
@@ -13,7 +12,13 @@ class Application(tk.Frame):
         self.master = master
         self.pack()
 
-        keyboard.add_hotkey("ctrl+left alt", self.onCall)
+        # The keyboard hook is only loaded when the GUI starts. It's slow to
+        # import and needs extra permissions on some systems.
+        try:
+            import keyboard
+            keyboard.add_hotkey("ctrl+left alt", self.onCall)
+        except ImportError as e:
+            print("Hotkey disabled: {}".format(e))
 
         self.centered = BooleanVar()
         
@@ -175,7 +180,11 @@ class Application(tk.Frame):
                               command=self.calc, font=font)
         self.calc.grid(row=4, column=11)
 
-root = tk.Tk()
-app = Application(master=root)
-app.master.title("Squad Mortar Toolkit - Standalone Mortar Calculator")
-app.mainloop()
+def main():
+    root = tk.Tk()
+    app = Application(master=root)
+    app.master.title("Squad Mortar Toolkit - Standalone Mortar Calculator")
+    app.mainloop()
+
+if __name__ == "__main__":
+    main()
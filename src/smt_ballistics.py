@@ -0,0 +1,535 @@
+"""A numerical ballistic solver that turns range cards into dense tables.
+
+Rounds are integrated as point masses with gravity and quadratic drag. The
+muzzle velocity and drag are fitted to the measured rows of a range card,
+and a whole fan of launch angles is then integrated at once with NumPy. The
+result is a table of elevation, time of flight and apex height for every
+range step, for both high and low angle fire and for a set of altitude
+differences between the gun and target.
+
+Solving takes a few seconds, so tables are cached to disk as compressed
+NumPy archives keyed by everything that went into them. Asking for the same
+table again loads it straight from the cache.
+"""
+
+import os
+import json
+import math
+import hashlib
+import zipfile
+
+import numpy as np
+
+import smt_lib
+
+__all__ = [
+    "BallisticTable",
+    "fill_card",
+    "fit",
+    "integrate",
+    "solve",
+    "solved_profile"
+    ]
+
+################################
+# SOLVER VARIABLES
+################################
+
+# Bumped whenever the solver changes, so old cached tables are ignored.
+SOLVER_VERSION = 2
+
+# Gravity in meters per second squared.
+gravity = 9.81
+
+# NATO mils in a radian, which the range card elevations use.
+MILS = 6400/(2*math.pi)
+
+# Default integration time step in seconds.
+time_step = 0.01
+
+# Longest time of flight integrated in seconds. Rounds still in the air
+# after it are treated as never coming down.
+max_time = 300.0
+
+# Default spacing of the launch angles that are integrated, in mils.
+angle_step = 0.5
+
+# Default altitude differences of the tables in meters, target above gun.
+altitudes = tuple(range(-100, 101, 10))
+
+# Where solved tables are cached. Set to None to turn the cache off.
+cache_dir = os.environ.get("SMT_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".cache", "smt"))
+
+################################
+# INTEGRATOR
+################################
+
+def _accel(vx, vz, k, g):
+    """Returns the acceleration of rounds from gravity and quadratic drag."""
+
+    speed = np.hypot(vx, vz)
+
+    return (-k*speed*vx, -g-k*speed*vz)
+
+def integrate(angles, v0, k, g=None, dh=(0,), dt=None):
+    """Flies rounds at launch angles in mils and returns where they come down.
+       (range, time of flight, apex height)
+
+       Ranges and times of flight have a column for each altitude difference
+       in dh, and are where each round passes that height on its way down.
+       Rounds that never get down to a height are NaN. Apex heights are
+       relative to the gun. All of the rounds are integrated together with
+       a fourth order Runge-Kutta step. Raises ValueError if the muzzle
+       velocity, gravity or time step isn't positive or the drag is negative.
+    """
+
+    g = gravity if g is None else g
+    dt = time_step if dt is None else dt
+
+    # Rounds would never come down, so the loop below would never end.
+    if not (v0 > 0 and g > 0 and dt > 0 and k >= 0):
+        raise ValueError("Can't integrate v0={}, k={}, g={}, dt={}".format(v0, k, g, dt))
+
+    theta = np.asarray(angles, dtype=float)/MILS
+    dh = np.asarray(dh, dtype=float)
+
+    x = np.zeros(theta.shape)
+    z = np.zeros(theta.shape)
+    vx = v0*np.cos(theta)
+    vz = v0*np.sin(theta)
+    t = 0.0
+
+    rn = np.full(theta.shape+dh.shape, np.nan)
+    tof = np.full(theta.shape+dh.shape, np.nan)
+    apex = np.zeros(theta.shape)
+    bottom = dh.min() if dh.size else 0.0
+
+    # Keep going until every round is on its way down below the lowest height.
+    while True:
+        ax1, az1 = _accel(vx, vz, k, g)
+        ax2, az2 = _accel(vx+ax1*dt/2, vz+az1*dt/2, k, g)
+        ax3, az3 = _accel(vx+ax2*dt/2, vz+az2*dt/2, k, g)
+        ax4, az4 = _accel(vx+ax3*dt, vz+az3*dt, k, g)
+
+        nx = x + dt*(vx + dt*(ax1+ax2+ax3)/6)
+        nz = z + dt*(vz + dt*(az1+az2+az3)/6)
+        vx = vx + dt*(ax1+2*ax2+2*ax3+ax4)/6
+        vz = vz + dt*(az1+2*az2+2*az3+az4)/6
+
+        # Find the rounds that just passed each height on the way down.
+        down = (z[:, None] >= dh) & (nz[:, None] < dh) & np.isnan(rn)
+        if down.any():
+            f = (z[:, None]-dh)/np.where(down, (z-nz)[:, None], 1)
+            rn = np.where(down, x[:, None]+(nx-x)[:, None]*f, rn)
+            tof = np.where(down, t+dt*f, tof)
+
+        x = nx
+        z = nz
+        t += dt
+        np.maximum(apex, z, out=apex)
+
+        if np.all((z < bottom) & (vz < 0)) or t >= max_time:
+            return (rn, tof, apex)
+
+################################
+# FITTING
+################################
+
+def _residuals(params, card, dt):
+    """Returns the sum of squared errors of a solution against a range card."""
+
+    angles = np.arange(700, 1600, 2.0)
+    rn, tof, apex = integrate(angles, *params, dt=dt)
+    rn = rn[:, 0]
+    tof = tof[:, 0]
+
+    # Only the high angle part of the fan is compared against the card.
+    top = np.nanargmax(rn)
+    r = rn[top:][::-1]
+    a = angles[top:][::-1]
+    f = tof[top:][::-1]
+
+    # Solutions that can't reach every range on the card aren't allowed.
+    if r[-1] < max(row[0] for row in card):
+        return math.inf
+
+    err = 0.0
+    for row in card:
+        err += (np.interp(row[0], r, a)-row[1])**2
+
+        # Zeros mean the time of flight wasn't measured.
+        if row[2]:
+            err += ((np.interp(row[0], r, f)-row[2])*10)**2
+
+    return err
+
+def fit(card=None, dt=None):
+    """Fits a muzzle velocity, drag coefficient and gravity to a range card.
+       (muzzle velocity, drag coefficient, gravity)
+
+       The measured elevations and times of flight are matched with a
+       Nelder-Mead search, starting from a vacuum trajectory that reaches
+       a little past the card's last range at 45 degrees. The solution has
+       to reach every range on the card. Raises ValueError if none does.
+    """
+
+    card = smt_lib.getCard() if card is None else card
+    dt = 0.05 if dt is None else dt
+    reach = max(row[0] for row in card)
+
+    def cost(p):
+        if p[0] <= 0 or p[1] < 0 or p[2] <= 0:
+            return math.inf
+        return _residuals(p, card, dt)
+
+    # Starting point and step sizes of each parameter.
+    start = np.array([math.sqrt(gravity*reach)*1.02, 0.0, gravity])
+    steps = np.array([2.0, 2e-5, 0.2])
+
+    simplex = [start]+[start+np.eye(len(start))[i]*steps[i] for i in range(len(start))]
+    costs = [cost(p) for p in simplex]
+
+    for _ in range(300):
+        order = np.argsort(costs)
+        simplex = [simplex[i] for i in order]
+        costs = [costs[i] for i in order]
+
+        # Stop once the simplex has shrunk below a useful precision.
+        if np.max(np.abs((simplex[-1]-simplex[0])/steps)) < 1e-3:
+            break
+
+        mid = np.mean(simplex[:-1], axis=0)
+        r = mid+(mid-simplex[-1])
+        cr = cost(r)
+
+        if cr < costs[0]:
+            e = mid+2*(mid-simplex[-1])
+            ce = cost(e)
+            simplex[-1], costs[-1] = (e, ce) if ce < cr else (r, cr)
+        elif cr < costs[-2]:
+            simplex[-1], costs[-1] = r, cr
+        else:
+            c = mid+(simplex[-1]-mid)/2
+            cc = cost(c)
+            if cc < costs[-1]:
+                simplex[-1], costs[-1] = c, cc
+            else:
+                simplex = [simplex[0]]+[simplex[0]+(p-simplex[0])/2 for p in simplex[1:]]
+                costs = [costs[0]]+[cost(p) for p in simplex[1:]]
+
+    best = int(np.argmin(costs))
+    if math.isinf(costs[best]):
+        raise ValueError("Couldn't fit a trajectory that reaches {} m".format(reach))
+
+    return tuple(float(i) for i in simplex[best])
+
+################################
+# TABLES
+################################
+
+class BallisticTable:
+    """Dense firing tables for a weapon and shell.
+
+       Each of the high and low angle tables is an array of shape
+       (altitudes, ranges). Ranges a round can't reach are NaN.
+    """
+
+    _ARRAYS = ("ranges", "altitudes", "el_high", "tof_high", "apex_high",
+               "el_low", "tof_low", "apex_low")
+
+    def __init__(self, ranges, altitudes, el_high, tof_high, apex_high,
+                 el_low, tof_low, apex_low, params):
+        self.ranges = ranges
+        self.altitudes = altitudes
+        self.el_high = el_high
+        self.tof_high = tof_high
+        self.apex_high = apex_high
+        self.el_low = el_low
+        self.tof_low = tof_low
+        self.apex_low = apex_low
+
+        # (muzzle velocity, drag coefficient, gravity)
+        self.params = tuple(params)
+
+    def __repr__(self):
+        return "BallisticTable(params={}, {} ranges, {} altitudes)".format(
+            tuple(round(i, 6) for i in self.params), len(self.ranges), len(self.altitudes))
+
+    def _lookup(self, name, rn, dh, high):
+        """Interpolates a table between range steps and altitudes."""
+
+        table = getattr(self, "{}_{}".format(name, "high" if high else "low"))
+        rn = np.asarray(rn, dtype=float)
+        dh = np.broadcast_to(np.asarray(dh, dtype=float), rn.shape)
+
+        # Fractional positions along both axes of the table.
+        step = self.ranges[1]-self.ranges[0]
+        i = (rn-self.ranges[0])/step
+        j = np.interp(dh, self.altitudes, np.arange(len(self.altitudes)))
+
+        out = np.full(rn.shape, np.nan)
+        ok = (i >= 0) & (i <= len(self.ranges)-1) & (dh >= self.altitudes[0]) & (dh <= self.altitudes[-1])
+
+        i0 = np.minimum(np.where(ok, i, 0).astype(int), len(self.ranges)-2)
+        j0 = np.minimum(j.astype(int), max(len(self.altitudes)-2, 0))
+        j1 = np.minimum(j0+1, len(self.altitudes)-1)
+        fi = np.where(ok, i, 0)-i0
+        fj = j-j0
+
+        # Neighbours with no weight are skipped, so an unreachable one
+        # doesn't turn an exact lookup into NaN.
+        def lerp(a, b, f):
+            return np.where(f > 0, a*(1-f) + b*f, a)
+
+        near = lerp(table[j0, i0], table[j0, i0+1], fi)
+        far = lerp(table[j1, i0], table[j1, i0+1], fi)
+        out[ok] = lerp(near, far, fj)[ok]
+
+        return out if out.ndim else float(out)
+
+    def el(self, rn, dh=0, high=True):
+        """Returns the elevation in mils for a range and altitude difference."""
+
+        return self._lookup("el", rn, dh, high)
+
+    def tof(self, rn, dh=0, high=True):
+        """Returns the time of flight in seconds for a range and altitude difference."""
+
+        return self._lookup("tof", rn, dh, high)
+
+    def apex(self, rn, dh=0, high=True):
+        """Returns the apex height above the gun for a range and altitude difference."""
+
+        return self._lookup("apex", rn, dh, high)
+
+    def card(self, step=50, dh=0, high=True, start=None, stop=None):
+        """Returns a range card of (range, elevation, TOF) rows every step
+           meters, always ending on stop. Ranges that can't be reached are
+           left out.
+        """
+
+        start = self.ranges[0] if start is None else start
+        stop = self.ranges[-1] if stop is None else stop
+
+        ranges = np.arange(start, stop+step/2, step)
+        if not len(ranges) or ranges[-1] != stop:
+            ranges = np.append(ranges, stop)
+
+        rows = []
+        for rn in ranges:
+            el = self.el(rn, dh, high)
+            tof = self.tof(rn, dh, high)
+
+            if not math.isnan(el):
+                rn = int(rn) if float(rn).is_integer() else float(rn)
+                rows.append((rn, smt_lib.half_round(el), round(tof, 1)))
+
+        return tuple(rows)
+
+    def save(self, path):
+        """Writes the table to a compressed NumPy archive."""
+
+        arrays = {n: getattr(self, n).astype(np.float32) for n in self._ARRAYS}
+
+        # Write to a temporary file first so a cache is never half written.
+        tmp = path+".tmp"
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, params=np.array(self.params), **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a table written by save."""
+
+        with np.load(path) as data:
+            return cls(*[data[n].astype(float) for n in cls._ARRAYS],
+                       params=[float(i) for i in data["params"]])
+
+def _invert(angles, rn, tof, apex, ranges):
+    """Turns the results of a fan of launch angles into high and low angle
+       tables of elevation, time of flight and apex height by range.
+    """
+
+    out = np.full((6, len(ranges)), np.nan)
+    ok = ~np.isnan(rn)
+
+    if not ok.any():
+        return out
+
+    angles = angles[ok]
+    rn = rn[ok]
+    tof = tof[ok]
+    apex = apex[ok]
+    top = np.argmax(rn)
+
+    # The low angle branch gets longer with elevation and the high one shorter.
+    for n, part in enumerate((slice(top, None), slice(None, top+1))):
+        r = rn[part]
+        if n == 0:
+            r = r[::-1]
+        order = np.argsort(r, kind="stable")
+        r = r[order]
+
+        inside = (ranges >= r[0]) & (ranges <= r[-1])
+        for m, v in enumerate((angles, tof, apex)):
+            v = v[part][::-1] if n == 0 else v[part]
+            out[n*3+m, inside] = np.interp(ranges[inside], r, v[order])
+
+    return out
+
+def _key(card, resolution, dh, max_range, dt, step, params):
+    """Returns the cache key of everything that goes into a table."""
+
+    params = {"version": SOLVER_VERSION, "gravity": gravity, "card": [list(r) for r in card],
+              "resolution": resolution, "altitudes": list(dh), "max_range": max_range, "dt": dt,
+              "angle_step": step, "params": params}
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:20]
+
+def solve(card=None, resolution=1.0, dh=None, max_range=None, params=None,
+          dt=None, step=None, cache=True):
+    """Returns the ballistic table of a range card, solving it if it isn't cached.
+
+       resolution is the range step of the table in meters, dh the altitude
+       differences, and max_range the longest range in the table (the card's
+       last range by default). The muzzle velocity, drag and gravity are
+       fitted to the card unless params gives them.
+    """
+
+    card = smt_lib.getCard() if card is None else tuple(tuple(r) for r in card)
+    dh = altitudes if dh is None else tuple(dh)
+    dt = time_step if dt is None else dt
+    step = angle_step if step is None else step
+    max_range = card[-1][0] if max_range is None else max_range
+
+    path = None
+    if cache and cache_dir:
+        key = _key(card, resolution, dh, max_range, dt, step,
+                   None if params is None else list(params))
+        path = os.path.join(cache_dir, "table-{}.npz".format(key))
+
+        try:
+            return BallisticTable.load(path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            pass
+
+    if params is None:
+        params = fit(card)
+
+    angles = np.arange(step, 1600, step)
+    ranges = np.arange(0, max_range+resolution/2, resolution, dtype=float)
+    rn, tof, apex = integrate(angles, *params, dh=dh, dt=dt)
+
+    tables = np.full((6, len(dh), len(ranges)), np.nan)
+    for j in range(len(dh)):
+        # Apex heights are kept relative to the gun, like the altitudes.
+        tables[:, j] = _invert(angles, rn[:, j], tof[:, j], apex, ranges)
+
+    table = BallisticTable(ranges, np.asarray(dh, dtype=float), *tables, params=params)
+
+    if path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            table.save(path)
+        except OSError:
+            pass
+
+    return table
+
+################################
+# PROFILES
+################################
+
+def _offsets(card, table, col):
+    """Returns the ranges of the measured rows of a card and how far the
+       table is off from each of them, for elevation (1) or TOF (2).
+    """
+
+    # Zeros mean the value wasn't measured.
+    rows = [r for r in card if r[col]]
+    rn = np.array([r[0] for r in rows], dtype=float)
+    lookup = table.el if col == 1 else table.tof
+
+    off = np.array([r[col] for r in rows], dtype=float)-lookup(rn)
+    ok = ~np.isnan(off)
+
+    return (rn[ok], off[ok])
+
+def _correction(offsets, rn):
+    """Interpolates the offsets of a table from the measured rows of a card
+       to a range. Past the first and last measured rows they're held flat.
+    """
+
+    if not len(offsets[0]):
+        return 0.0
+
+    return float(np.interp(rn, *offsets))
+
+def fill_card(card=None, table=None):
+    """Returns a range card with the untested times of flight filled in from
+       a ballistic table. Measured values are kept as they are.
+
+       The fitted solution never matches the card exactly, so the solved
+       times of flight are shifted by the table's error at the measured rows
+       around them. That way the filled rows carry on from the measured ones
+       instead of jumping.
+    """
+
+    card = smt_lib.getCard() if card is None else card
+    table = solve(card) if table is None else table
+    offsets = _offsets(card, table, 2)
+
+    rows = []
+    for rn, el, tof in card:
+        if not tof:
+            t = table.tof(rn)
+            tof = tof if math.isnan(t) else round(t+_correction(offsets, rn), 1)
+        rows.append((rn, el, tof))
+
+    return tuple(rows)
+
+def _anchor(rows, card, table):
+    """Shifts the rows of a solved range card onto a measured one, the same
+       way fill_card does, for both the elevations and times of flight.
+    """
+
+    el = _offsets(card, table, 1)
+    tof = _offsets(card, table, 2)
+
+    return tuple((rn, smt_lib.half_round(table.el(rn)+_correction(el, rn)),
+                  round(table.tof(rn)+_correction(tof, rn), 1)) for rn, _, _ in rows)
+
+def solved_profile(profile=None, name=None, step=None, register=True, **kw):
+    """Returns a copy of a ballistic profile with a solved range card.
+
+       With no step, the measured card is kept and only its untested times
+       of flight are filled in. With a step, the whole card is replaced by
+       one generated every step meters, shifted to agree with the measured
+       rows of the old one. Other keyword arguments are passed
+       to solve. The new profile is named after the old one with -SOLVED
+       on the end and registered, unless register is False.
+    """
+
+    profile = smt_lib.get_profile(profile)
+    table = solve(profile.card, **kw)
+
+    if step is None:
+        card = fill_card(profile.card, table)
+    else:
+        card = table.card(step=step, start=profile.min_range, stop=profile.max_range)
+
+        # The solved profile has to cover the same ranges as the old one.
+        if not card or card[-1][0] != profile.max_range:
+            raise ValueError("The solved table doesn't reach {} m".format(profile.max_range))
+
+        card = _anchor(card, profile.card, table)
+
+    new = smt_lib.Profile(name or profile.name+"-SOLVED", profile.weapon, profile.shell,
+                          card, profile.burst, min_range=profile.min_range,
+                          max_range=profile.max_range)
+
+    if register:
+        smt_lib.register_profile(new)
+
+    return new
@@ -0,0 +1,310 @@
+"""A command line tool for calculating firing data in bulk.
+
+Reads gun and target records from files or stdin and writes one result per
+record, in the same order, to stdout. Records can be CSV with a header row
+or JSON lines, and need a gun and tgt field. Any other fields, like an id,
+are passed through to the output.
+
+    python src/smt_cli.py targets.csv > data.csv
+    cat targets.jsonl | python src/smt_cli.py --workers 4 --output-format jsonl
+
+Records are read in fixed size chunks, so memory use stays flat no matter
+how long the input is. Records that can't be solved get an error message
+instead of firing data, and the run carries on.
+"""
+
+import io
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+import collections
+
+import smt_lib
+
+################################
+# CLI VARIABLES
+################################
+
+# Fields of the firing data, in output order.
+DATA_FIELDS = ("rn", "az", "el", "tof")
+
+# Default number of records per chunk.
+chunk_size = 1000
+
+################################
+# INPUT
+################################
+
+def _sniff(f):
+    """Guesses if a stream is JSON lines or CSV from its first character.
+       Returns the format and the stream, with nothing read from it lost.
+    """
+
+    # Peek at binary streams so nothing is consumed.
+    if hasattr(f, "buffer"):
+        start = f.buffer.peek(1)[:1].decode(errors="replace")
+    else:
+        start = f.readline()
+        f = itertools.chain([start], f)
+
+    return ("jsonl" if start.startswith("{") else "csv", f)
+
+def _records(f, fmt):
+    """Yields a dictionary for every record in a stream."""
+
+    if fmt == "csv":
+        for row in csv.DictReader(f):
+            yield row
+        return
+
+    for n, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("not an object")
+        except ValueError as e:
+            # Bad lines still get a result so the output lines up with the input.
+            record = {"error": "Invalid JSON on line {}: {}".format(n, e)}
+
+        yield record
+
+def read_records(paths, fmt="auto"):
+    """Yields every record from a list of files, with - being stdin."""
+
+    for path in paths or ["-"]:
+        if path == "-":
+            f = sys.stdin
+            form = fmt
+            if form == "auto":
+                form, f = _sniff(f)
+            yield from _records(f, form)
+            continue
+
+        form = fmt
+        if form == "auto":
+            form = "csv" if path.lower().endswith(".csv") else "jsonl"
+
+        with open(path, newline="") as f:
+            yield from _records(f, form)
+
+def chunks(records, size):
+    """Groups records into lists of at most size records."""
+
+    records = iter(records)
+
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+################################
+# CALCULATION
+################################
+
+def _init_worker(profiles_path):
+    """Loads extra ballistic profiles in a worker process."""
+
+    if profiles_path:
+        smt_lib.load_profiles(profiles_path)
+
+def calc_chunk(chunk, center=False, profile=None):
+    """Calculates the firing data of a chunk of records.
+       Returns the records with the firing data or an error added.
+    """
+
+    out = []
+
+    for record in chunk:
+        record = dict(record)
+
+        if "error" not in record:
+            gun = record.get("gun")
+            tgt = record.get("tgt")
+
+            try:
+                if not gun or not tgt:
+                    raise ValueError("Missing gun or target grid")
+
+                # JSON can hold numbers or lists, which calc_data would take
+                # as grid keys or choke on.
+                if not isinstance(gun, str) or not isinstance(tgt, str):
+                    raise ValueError("Gun and target grids must be strings")
+
+                data = smt_lib.calc_data(gun, tgt, center=center, profile=profile)
+                record.update(zip(DATA_FIELDS, data))
+                record["error"] = ""
+
+            except (smt_lib.OutOfRangeError, smt_lib.InvalidGridError, ValueError) as e:
+                record["error"] = str(e)
+
+        out.append(record)
+
+    return out
+
+def _fields(records):
+    """Returns the output columns for records like these, firing data last.
+       Records that couldn't be read don't have the input's columns, so the
+       first one that could is used.
+    """
+
+    record = next((i for i in records if "error" not in i), {"gun": "", "tgt": ""})
+
+    return [k for k in record if k not in DATA_FIELDS+("error",)]+list(DATA_FIELDS)+["error"]
+
+def format_records(records, fmt, fields=None):
+    """Formats results as CSV rows or JSON lines, see _fields for the columns."""
+
+    if fmt == "jsonl":
+        return "".join(json.dumps(i)+"\n" for i in records)
+
+    f = io.StringIO()
+    w = csv.DictWriter(f, fields or _fields(records), extrasaction="ignore", lineterminator="\n")
+    w.writerows(records)
+
+    return f.getvalue()
+
+def process_chunk(chunk, center=False, profile=None, fmt="csv", fields=None):
+    """Calculates and formats a chunk of records.
+       (output text, number of records, number of errors)
+    """
+
+    records = calc_chunk(chunk, center, profile)
+
+    return (format_records(records, fmt, fields), len(records),
+            sum(1 for i in records if i["error"]))
+
+def process_chunks(chunks, workers=0, profiles_path=None, **kw):
+    """Yields the results of process_chunk for every chunk in input order.
+
+       With workers, chunks are spread over a process pool and formatted
+       there too, so this process only has to read and write. Only a few
+       chunks per worker are in flight at once, so a long input isn't read
+       all at once while the workers catch up.
+    """
+
+    if not workers:
+        for chunk in chunks:
+            yield process_chunk(chunk, **kw)
+        return
+
+    # The pool is only imported when it's used, it's slow to load.
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(profiles_path,)) as pool:
+        pending = collections.deque()
+
+        for chunk in chunks:
+            pending.append(pool.submit(process_chunk, chunk, **kw))
+
+            if len(pending) >= workers*2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+################################
+# STATISTICS
+################################
+
+class Stats:
+    """Keeps track of the throughput and reports it on stderr."""
+
+    def __init__(self, interval=0):
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.records = 0
+        self.errors = 0
+
+    def add(self, records, errors):
+        self.records += records
+        self.errors += errors
+
+        now = time.perf_counter()
+        if self.interval and now-self.last >= self.interval:
+            self.last = now
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter()-self.start
+        rate = self.records/elapsed if elapsed else 0
+
+        print("{:,} records, {:,} errors in {:.2f}s ({:,.0f} records/s)".format(
+            self.records, self.errors, elapsed, rate), file=sys.stderr)
+
+################################
+# MAIN
+################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calculate firing data for gun and target records.")
+    parser.add_argument("files", nargs="*",
+                        help="CSV or JSON lines files to read, or - for stdin (default: stdin)")
+    parser.add_argument("--format", choices=("auto", "csv", "jsonl"), default="auto",
+                        help="format of the input (default: by file extension, or sniffed on stdin)")
+    parser.add_argument("--output-format", choices=("csv", "jsonl"), default="csv",
+                        help="format of the output (default: csv)")
+    parser.add_argument("--center", action="store_true",
+                        help="use the center of each grid instead of its northwest corner")
+    parser.add_argument("--profile", help="ballistic profile to use (default: {})".format(smt_lib.default_profile))
+    parser.add_argument("--profiles", help="JSON file of extra ballistic profiles to load")
+    parser.add_argument("--chunk", type=int, default=chunk_size,
+                        help="number of records per chunk (default: {})".format(chunk_size))
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes, 0 to calculate in this process (default: 0)")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="seconds between throughput reports on stderr, 0 for only a final one")
+    parser.add_argument("--quiet", action="store_true", help="don't report throughput")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.profiles:
+            smt_lib.load_profiles(args.profiles)
+        smt_lib.get_profile(args.profile)
+    except (OSError, ValueError, smt_lib.ProfileError) as e:
+        parser.error(str(e))
+
+    if args.workers < 0 or args.chunk < 1:
+        parser.error("--workers can't be negative and --chunk must be at least 1.")
+
+    stats = Stats(0 if args.quiet else args.stats_interval)
+    out = sys.stdout
+
+    try:
+        parts = chunks(read_records(args.files, args.format), args.chunk)
+
+        # The first chunk decides the CSV columns.
+        first = next(parts, None)
+        fields = _fields(first) if first else None
+        if first and args.output_format == "csv":
+            csv.writer(out, lineterminator="\n").writerow(fields)
+
+        for text, records, errors in process_chunks(itertools.chain([first] if first else [], parts),
+                                                    workers=args.workers, profiles_path=args.profiles,
+                                                    center=args.center, profile=args.profile,
+                                                    fmt=args.output_format, fields=fields):
+            out.write(text)
+            stats.add(records, errors)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+
+    sys.stdout.flush()
+
+    if not args.quiet:
+        stats.report()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,419 @@
+"""An arithmetic codec for converting between Squad grids and vector points.
+
+A Squad grid is a zone designator (a letter for the easting and a number for
+the southing, 300m square) followed by keypad digits. Each keypad digit splits
+the current square into a 3x3 block, numbered like a computer's number pad:
+
+    7 8 9
+    4 5 6
+    1 2 3
+
+Internally positions are kept as whole numbers of fixed size units, so every
+keypad level down to MAX_DEPTH is an exact base-3 division with divmod. The
+centre of any cell encodes back to the same grid at the same depth.
+
+Grids can also be packed into small integer keys. From the highest bits down
+a key holds the zone number, the zone letter, the keypad path as base-9 digits
+(most significant first, padded to MAX_DEPTH) and the keypad depth. Keys sort
+zone by zone and then in base-3 Morton order inside a zone, so nearby cells
+tend to have nearby keys.
+"""
+
+import re
+import math
+
+# NumPy is slow to import, so it's only loaded by the array functions.
+np = None
+
+__all__ = [
+    "decode",
+    "decode_array",
+    "depth",
+    "encode",
+    "encode_array",
+    "grid_to_key",
+    "key_cell",
+    "key_depth",
+    "key_dist",
+    "key_neighbours",
+    "key_to_grid",
+    "key_to_vec",
+    "key_truncate",
+    "MAX_DEPTH",
+    "valid_grid",
+    "valid_key",
+    "vec_to_key"
+    ]
+
+################################
+# CODEC VARIABLES
+################################
+
+# The deepest keypad level the codec works with exactly (about 5mm).
+MAX_DEPTH = 10
+
+# Size of a grid zone in meters.
+ZONE_SIZE = 300
+
+# Units per meter. Vector points are rounded to the millimeter and every
+# keypad level down to MAX_DEPTH divides a zone into whole units.
+SCALE = 1000*3**MAX_DEPTH
+
+# Size of a grid zone and a meter in units.
+_ZONE = ZONE_SIZE*SCALE
+_METER = SCALE
+
+# Keypad digit for a (row, column) inside a 3x3 block.
+_KEYPAD = (("7", "8", "9"),
+           ("4", "5", "6"),
+           ("1", "2", "3"))
+
+# Reverse of the keypad for decoding.
+_DIGITS = {_KEYPAD[r][c]: (r, c) for r in range(3) for c in range(3)}
+
+# Bit layout of a grid key.
+_DEPTH_BITS = 4
+_PATH_BITS = 32
+_COL_BITS = 5
+
+# A zone designator followed by any number of keypad digits.
+_GRID_RE = re.compile(r"([A-Za-z])([0-9]+)((?:-[1-9])*)\Z")
+
+################################
+# VALIDATION FUNCTIONS
+################################
+
+def valid_grid(grid):
+    """Checks to see if a valid grid was passed."""
+
+    return isinstance(grid, str) and _GRID_RE.match(grid) is not None
+
+def depth(grid):
+    """Returns the number of keypad digits in a grid."""
+
+    m = _GRID_RE.match(grid) if isinstance(grid, str) else None
+
+    if not m:
+        raise ValueError("Invalid grid format: \"{}\"".format(grid))
+
+    return len(m.group(3))//2
+
+################################
+# CODEC FUNCTIONS
+################################
+
+def _units(v):
+    """Turns meters into whole units, rounded to the millimeter."""
+
+    return round(round(v, 3)*1000)*(SCALE//1000)
+
+def decode(grid, center=False):
+    """Converts a Squad grid into an exact vector point. Based on Northwest.
+
+       Keypad digits past MAX_DEPTH are smaller than a centimeter and ignored.
+    """
+
+    m = _GRID_RE.match(grid) if isinstance(grid, str) else None
+
+    if not m:
+        raise ValueError("Invalid grid format: \"{}\"".format(grid))
+
+    # Grid zone designators.
+    x = (ord(m.group(1).upper())-ord("A"))*_ZONE
+    y = (int(m.group(2))-1)*_ZONE
+
+    # Each keypad level is a third of the one before.
+    d = _ZONE
+    for n in m.group(3)[1::2][:MAX_DEPTH]:
+        d //= 3
+        r, c = _DIGITS[n]
+        x += c*d
+        y += r*d
+
+    if center:
+        x += d//2
+        y += d//2
+
+    return (x/SCALE, -y/SCALE)
+
+def _split(cords, precision=None):
+    """Splits a vector point into its zone column, zone row and keypad digits."""
+
+    if precision is not None and not 0 <= precision <= MAX_DEPTH:
+        raise ValueError("Precision must be between 0 and {}.".format(MAX_DEPTH))
+
+    x = _units(cords[0])
+    y = abs(_units(cords[1]))
+
+    # Grid zone designators.
+    col, x = divmod(x, _ZONE)
+    row, y = divmod(y, _ZONE)
+
+    if not 0 <= col < 26:
+        raise ValueError("Vector point is off the map: {}".format(tuple(cords)))
+
+    # Each keypad digit is a base-3 column and row.
+    digits = []
+    d = _ZONE
+    for level in range(MAX_DEPTH):
+        if precision is None:
+            if x <= _METER and y <= _METER:
+                break
+        elif level >= precision:
+            break
+
+        d //= 3
+        c, x = divmod(x, d)
+        r, y = divmod(y, d)
+        digits.append((r, c))
+
+    return (col, row, digits)
+
+def encode(cords, precision=None):
+    """Converts a vector point into a Squad grid.
+
+       The precision is the number of keypad digits. If it's None, digits are
+       added until the point is within a meter of the cell's northwest corner.
+    """
+
+    col, row, digits = _split(cords, precision)
+
+    return "-".join([chr(65+col)+str(row+1)]+[_KEYPAD[r][c] for r, c in digits])
+
+################################
+# KEY FUNCTIONS
+################################
+
+def _pack(col, row, digits):
+    """Packs a zone and keypad digits into a grid key."""
+
+    path = 0
+    for r, c in digits:
+        path = path*9 + r*3 + c
+    path *= 9**(MAX_DEPTH-len(digits))
+
+    return (((row << _COL_BITS | col) << _PATH_BITS | path) << _DEPTH_BITS) | len(digits)
+
+def _cell(key):
+    """Unpacks a grid key into a cell column, cell row and depth.
+       Cells are counted from the northwest corner of the map.
+    """
+
+    n = key & (1 << _DEPTH_BITS)-1
+    key >>= _DEPTH_BITS
+    path = (key & (1 << _PATH_BITS)-1)//9**(MAX_DEPTH-n)
+    key >>= _PATH_BITS
+    col = key & (1 << _COL_BITS)-1
+    row = key >> _COL_BITS
+
+    # Undo the base-9 path one trit pair at a time.
+    cx = 0
+    cy = 0
+    for i in range(n):
+        r, c = divmod(path//9**(n-1-i) % 9, 3)
+        cx = cx*3 + c
+        cy = cy*3 + r
+
+    return (col*3**n + cx, row*3**n + cy, n)
+
+def _from_cell(cx, cy, n):
+    """Packs a cell column, cell row and depth into a grid key."""
+
+    col, cx = divmod(cx, 3**n)
+    row, cy = divmod(cy, 3**n)
+
+    if not 0 <= col < 26 or row < 0:
+        raise ValueError("Cell is off the map: {}".format((cx, cy, n)))
+
+    digits = []
+    for i in range(n):
+        p = 3**(n-1-i)
+        digits.append((cy//p % 3, cx//p % 3))
+
+    return _pack(col, row, digits)
+
+def grid_to_key(grid):
+    """Packs a Squad grid into an integer key."""
+
+    m = _GRID_RE.match(grid) if isinstance(grid, str) else None
+
+    if not m or int(m.group(2)) < 1:
+        raise ValueError("Invalid grid format: \"{}\"".format(grid))
+
+    col = ord(m.group(1).upper())-ord("A")
+    row = int(m.group(2))-1
+    digits = [_DIGITS[n] for n in m.group(3)[1::2][:MAX_DEPTH]]
+
+    return _pack(col, row, digits)
+
+def valid_key(key):
+    """Checks that an integer is a grid key grid_to_key could have made."""
+
+    if not isinstance(key, int) or isinstance(key, bool) or key < 0:
+        return False
+
+    n = key & (1 << _DEPTH_BITS)-1
+    path = key >> _DEPTH_BITS & (1 << _PATH_BITS)-1
+    col = key >> _DEPTH_BITS+_PATH_BITS & (1 << _COL_BITS)-1
+
+    return n <= MAX_DEPTH and col < 26 and path < 9**MAX_DEPTH and not path % 9**(MAX_DEPTH-n)
+
+def vec_to_key(cords, precision=None):
+    """Packs a vector point into an integer key, see encode for the precision."""
+
+    return _pack(*_split(cords, precision))
+
+def key_to_grid(key):
+    """Unpacks an integer key into a Squad grid."""
+
+    cx, cy, n = _cell(key)
+    col, cx = divmod(cx, 3**n)
+    row, cy = divmod(cy, 3**n)
+
+    grid = [chr(65+col)+str(row+1)]
+    for i in range(n):
+        p = 3**(n-1-i)
+        grid.append(_KEYPAD[cy//p % 3][cx//p % 3])
+
+    return "-".join(grid)
+
+def key_to_vec(key, center=False):
+    """Converts an integer key into an exact vector point. Based on Northwest."""
+
+    cx, cy, n = _cell(key)
+    d = _ZONE//3**n
+
+    x = cx*d
+    y = cy*d
+
+    if center:
+        x += d//2
+        y += d//2
+
+    return (x/SCALE, -y/SCALE)
+
+def key_cell(key):
+    """Returns the cell column, cell row and depth of an integer key.
+       Cells are counted from the northwest corner of the map at that depth.
+    """
+
+    return _cell(key)
+
+def key_depth(key):
+    """Returns the number of keypad digits in an integer key."""
+
+    return key & (1 << _DEPTH_BITS)-1
+
+def key_truncate(key, depth):
+    """Returns the key of the cell at a shallower depth that contains a key."""
+
+    cx, cy, n = _cell(key)
+
+    if not 0 <= depth <= n:
+        raise ValueError("Depth must be between 0 and {}.".format(n))
+
+    p = 3**(n-depth)
+    return _from_cell(cx//p, cy//p, depth)
+
+def key_neighbours(key):
+    """Returns the keys of the cells around a key at the same depth."""
+
+    cx, cy, n = _cell(key)
+    keys = []
+
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dx or dy:
+                try:
+                    keys.append(_from_cell(cx+dx, cy+dy, n))
+                except ValueError:
+                    pass
+
+    return keys
+
+def key_dist(key1, key2, center=False):
+    """Returns the distance in meters between two integer keys."""
+
+    x1, y1 = key_to_vec(key1, center=center)
+    x2, y2 = key_to_vec(key2, center=center)
+
+    return math.dist((x1, y1), (x2, y2))
+
+################################
+# ARRAY FUNCTIONS
+################################
+
+def _require_numpy():
+    """Imports NumPy the first time an array function needs it."""
+
+    global np
+
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("NumPy is required for array conversions.")
+        np = numpy
+
+    return np
+
+def decode_array(grids, center=False):
+    """Converts an array of Squad grids into a float array of shape (..., 2)."""
+
+    _require_numpy()
+
+    grids = np.asarray(grids, dtype=object)
+    cords = np.empty((grids.size, 2))
+
+    for i, grid in enumerate(grids.flat):
+        cords[i] = decode(grid, center=center)
+
+    return cords.reshape(grids.shape+(2,))
+
+def encode_array(cords, precision=None):
+    """Converts an array of vector points of shape (..., 2) into Squad grids.
+
+       Returns an object array of strings, see encode for the precision.
+    """
+
+    _require_numpy()
+
+    if precision is not None and not 0 <= precision <= MAX_DEPTH:
+        raise ValueError("Precision must be between 0 and {}.".format(MAX_DEPTH))
+
+    cords = np.asarray(cords, dtype=float)
+    shape = cords.shape[:-1]
+    cords = cords.reshape(-1, 2)
+
+    x = np.rint(np.round(cords[:, 0], 3)*1000).astype(np.int64)*(SCALE//1000)
+    y = np.abs(np.rint(np.round(cords[:, 1], 3)*1000).astype(np.int64)*(SCALE//1000))
+
+    # Grid zone designators.
+    col, x = np.divmod(x, _ZONE)
+    row, y = np.divmod(y, _ZONE)
+
+    if np.any((col < 0) | (col >= 26)):
+        raise ValueError("Vector points are off the map.")
+
+    # Work out every keypad digit and how many of them each point needs.
+    levels = MAX_DEPTH if precision is None else precision
+    digits = np.empty((len(x), levels), dtype=np.int64)
+    need = np.full(len(x), levels)
+
+    d = _ZONE
+    for level in range(levels):
+        if precision is None:
+            done = (x <= _METER) & (y <= _METER) & (need == levels)
+            need[done] = level
+
+        d //= 3
+        c, x = np.divmod(x, d)
+        r, y = np.divmod(y, d)
+        digits[:, level] = 7 + c - 3*r
+
+    out = np.empty(len(col), dtype=object)
+    for i in range(len(col)):
+        out[i] = "-".join([chr(65+col[i])+str(row[i]+1)]
+                          + [str(n) for n in digits[i, :need[i]]])
+
+    return out.reshape(shape)
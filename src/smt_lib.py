@@ -1,29 +1,57 @@
 """A collection of functions and algorithms for calculating mortar data."""
 
+import json
 import math
+import bisect
+import functools
+from array import array
+
+import smt_grid
+
+# NumPy is slow to import, so it's only loaded once a batch function needs it.
+np = None
 
 __version__ = "1.2b"
 
 __all__ = [
     "aimpoint_offset",
     "calc_data",
+    "calc_data_batch",
+    "calc_sheaf",
     "correction_offset",
+    "default_profile",
+    "find_profile",
+    "Coverage",
     "InvalidAzimuthError",
     "InvalidCorrectionError",
     "InvalidGridError",
+    "key_to_grid",
+    "load_profiles",
     "getBurst",
     "getBurstHE",
     "getBurstSMK",
     "getCard",
     "getMax",
     "getMin",
+    "get_profile",
+    "grid_cache_clear",
+    "grid_cache_info",
+    "grid_to_key",
     "get_az",
     "get_el",
     "get_rn",
     "get_tof",
     "grid_to_vec",
+    "GunIndex",
     "half_round",
     "OutOfRangeError",
+    "Profile",
+    "ProfileError",
+    "profiles",
+    "register_profile",
+    "register_sheaf",
+    "sheaf_aimpoints",
+    "sheaf_shapes",
     "ShellError",
     "SMTLIB_Error",
     "valid_grid",
@@ -73,6 +101,16 @@ max_range = 1250
 he_burst = 10
 smk_burst = 20
 
+# Maximum number of parsed grids to remember. A new size takes effect the
+# next time a grid is parsed, which starts the cache over.
+grid_cache_size = 1024
+
+# Name of the ballistic profile used when none is given.
+default_profile = "MORTAR-HE"
+
+# Registered ballistic profiles by name.
+_profiles = {}
+
 ################################
 # LIBRARY EXCEPTIONS
 ################################
@@ -118,6 +156,16 @@ class OutOfRangeError(SMTLIB_Error):
     def __str__(self):
         return "Out of range for mortar: {}m".format(self.rn)
 
+class ProfileError(SMTLIB_Error):
+    """Exception for an unknown or invalid ballistic profile."""
+
+    def __init__(self, profile, reason="Unknown"):
+        self.profile = profile
+        self.reason = reason
+
+    def __str__(self):
+        return "{} ballistic profile: \"{}\"".format(self.reason, self.profile)
+
 class ShellError(SMTLIB_Error):
     """Exception for an unknown shell type."""
 
@@ -147,12 +195,7 @@ def getBurstSMK():
     return smk_burst
 
 def getBurst(shell):
-    if shell.upper() == "HE":
-        return he_burst
-    elif shell.upper() == "SMK":
-        return smk_burst
-    else:
-        raise ShellError(shell)
+    return find_profile("MORTAR", shell).burst
 
 ################################
 # MISC FUNCTIONS
@@ -175,124 +218,100 @@ def half_round(num):
 def valid_grid(grid):
     """Checks to see if a valid grid was passed."""
 
-    # Make sure something was passed.
-    if not grid:
-        return False
-
-    # Make sure the grid is long enough.
-    if len(grid) < 2:
-        return False
-
-    # Split the grid up.
-    grid = grid.split("-")
-
-    # Make sure we have an easting.
-    if not grid[0][0].isalpha():
-        return False
-
-    # Make sure we have a southing.
-    if not grid[0][1:].isdigit():
-        return False
-
-    del grid[0]
-
-    # Check for numbers between the dashes.
-    while grid:
-        if len(grid[0]) == 1 and grid[0].isdigit():
-            del grid[0]
-        else:
-            return False
-
-    return True
+    return smt_grid.valid_grid(grid)
 
-def grid_to_vec(grid, center=False):
-    """Converts a Squad grid into a vector point. Based on Northwest. """
+def _grid_to_vec(grid, center):
+    """Parses a Squad grid or grid key into a vector point."""
 
-    x = 0
-    y = 0
+    # Grid keys don't need any parsing.
+    if isinstance(grid, int):
+        x, y = smt_grid.key_to_vec(grid, center=center)
 
     # Make sure the grid is valid!
-    if not valid_grid(grid):
+    elif not smt_grid.valid_grid(grid):
         raise InvalidGridError(grid)
 
-    grid = grid.split("-")
+    else:
+        x, y = smt_grid.decode(grid, center=center)
 
-    # Distance adjuster in meters.
-    # Gets smaller as the grid gets more precise.
-    d = 300
+    return (round(x), round(y))
 
-    for i in range(len(grid)):
+# The cached _grid_to_vec and the size it was made with.
+_grid_cache = (None, None)
 
-        # Grid zone designators.
-        if i == 0:
-            x = (ord(grid[0][0].upper())-ord("A"))*d
-            y = (int(grid[0][1:])-1)*-d
-            continue
+def _grid_parser():
+    """Returns the cached grid parser, making it again if grid_cache_size changed."""
 
-        d /= 3
+    global _grid_cache
 
-        if grid[i] in ("4", "5", "6"):
-            y -= d
+    size, parse = _grid_cache
 
-        if grid[i] in ("1", "2", "3"):
-            y -= 2*d
+    if parse is None or size != grid_cache_size:
+        parse = functools.lru_cache(maxsize=grid_cache_size)(_grid_to_vec)
+        _grid_cache = (grid_cache_size, parse)
 
-        if grid[i] in ("2", "5", "8"):
-            x += d
+    return parse
 
-        if grid[i] in ("3", "6", "9"):
-            x += 2*d
+def grid_to_vec(grid, center=False):
+    """Converts a Squad grid into a vector point. Based on Northwest.
+       Integer grid keys from grid_to_key are accepted as well.
+    """
 
-    if center:
-        print(d)
-        x += d/2
-        y -= d/2
+    # Anything else can't be a grid, and might not even fit in the cache.
+    # Subclasses like numpy.str_ are fine, but a bool isn't a grid key.
+    if isinstance(grid, int) and not isinstance(grid, bool):
+        if not smt_grid.valid_key(grid):
+            raise InvalidGridError(grid)
+    elif not isinstance(grid, str):
+        raise InvalidGridError(grid)
 
-    return (round(x), round(y))
+    size, parse = _grid_cache
+    if parse is None or size != grid_cache_size:
+        parse = _grid_parser()
 
-def vec_to_grid(cords):
-    """Takes a vector point and converts it into a Squad grid."""
+    return parse(grid, bool(center))
 
-    grid = ""
+def grid_cache_info():
+    """Returns the hits, misses and size of the parsed grid cache."""
 
-    # For a more accurate conversion, round to the thousands place.
-    x = round(cords[0], 3)
-    y = abs(round(cords[1], 3))
+    return _grid_parser().cache_info()
 
-    d = 300
+def grid_cache_clear():
+    """Empties the parsed grid cache."""
 
-    grid += chr(65+int(x//d))
-    x -= (x//d)*d
+    _grid_parser().cache_clear()
 
-    grid += "{:.0f}".format(y//d+1)
-    y -= (y//d)*d
+def grid_to_key(grid):
+    """Packs a Squad grid into a small integer key for hashing and lookups."""
 
-    while x > 1 or y > 1:
-        d /= 3
-        g = 55
+    try:
+        return smt_grid.grid_to_key(grid)
+    except ValueError:
+        raise InvalidGridError(grid)
 
-        while x >= d:
-                x -= d
-                g += 1
+def key_to_grid(key):
+    """Unpacks an integer key from grid_to_key back into a Squad grid."""
 
-        while y >= d:
-                y -= d
-                g -= 3
+    return smt_grid.key_to_grid(key)
 
+def vec_to_grid(cords, precision=None):
+    """Takes a vector point and converts it into a Squad grid.
 
-        grid += "-{}".format(chr(g))
+       The precision is the number of keypad digits. By default digits are
+       added until the grid is accurate to a meter.
+    """
 
-    return grid
+    try:
+        return smt_grid.encode(cords, precision=precision)
+    except ValueError:
+        raise InvalidGridError(cords)
 
 ################################
 # OFFSET FUNCTIONS
 ################################
 
-def aimpoint_offset(grid, di, rn):
-    """Calculates a new location based on grid, direction, and distance."""
-
-    # Turn the grid into a vector point.
-    cords = grid_to_vec(grid)
+def _offset(cords, di, rn):
+    """Moves a vector point based on direction and distance."""
 
     # Make sure the direction is correct.
     if not 0 <= di <= 360:
@@ -302,12 +321,27 @@ def aimpoint_offset(grid, di, rn):
     y = math.cos(math.radians(di))*rn
     x = math.sin(math.radians(di))*rn
 
+    return (cords[0]+x, cords[1]+y)
+
+def aimpoint_offset(grid, di, rn):
+    """Calculates a new location based on grid, direction, and distance."""
+
+    # Turn the grid into a vector point.
+    cords = grid_to_vec(grid)
+
     # Return the new location as a grid.
-    return vec_to_grid((cords[0]+x, cords[1]+y))
+    return vec_to_grid(_offset(cords, di, rn))
 
 def correction_offset(grid, di, dev_cor="0", rn_cor="0"):
     """Adjusts a grid based on the observer's azimuth and corrections."""
 
+    # Nothing to correct.
+    if dev_cor == "0" and rn_cor == "0":
+        return grid
+
+    # Stay as a vector point until both corrections are made.
+    cords = grid_to_vec(grid)
+
     # Try to do a deviation correction.
     if dev_cor != "0":
         temp_di = di
@@ -322,7 +356,7 @@ def correction_offset(grid, di, dev_cor="0", rn_cor="0"):
         if temp_di >= 360:
                 temp_di -= 360
 
-        grid = aimpoint_offset(grid, temp_di, int(dev_cor[1:]))
+        cords = _offset(cords, temp_di, int(dev_cor[1:]))
 
     # Try to do a range correction.
     if rn_cor != "0":
@@ -338,27 +372,194 @@ def correction_offset(grid, di, dev_cor="0", rn_cor="0"):
         if temp_di >= 360:
                 temp_di -= 360
 
-        grid = aimpoint_offset(grid, temp_di, int(rn_cor[1:]))
+        cords = _offset(cords, temp_di, int(rn_cor[1:]))
 
-    return grid
+    return vec_to_grid(cords)
+
+################################
+# BALLISTIC PROFILES
+################################
+
+class Profile:
+    """A named ballistic profile of a weapon and shell.
+
+       The range card is a sequence of (range, elevation, TOF) rows sorted by
+       range. It's compiled into per meter lookup tables the first time it's
+       used, and again whenever the card or range limits are replaced.
+    """
+
+    def __init__(self, name, weapon, shell, card, burst, min_range=None, max_range=None):
+        self.name = name.upper()
+        self.weapon = weapon.upper()
+        self.shell = shell.upper()
+        self.card = tuple(tuple(row) for row in card)
+        self.burst = burst
+        self.min_range = self.card[0][0] if min_range is None else min_range
+        self.max_range = self.card[-1][0] if max_range is None else max_range
+
+        # (range card, minimum range, maximum range, elevations, times of flight)
+        self._tables = None
+
+    def __repr__(self):
+        return "Profile({!r})".format(self.name)
+
+    def _compile(self):
+        """Interpolates the range card for every meter within range."""
+
+        card = self.card
+        ranges = [row[0] for row in card]
+
+        if not ranges[0] <= self.min_range <= self.max_range <= ranges[-1]:
+            raise ProfileError(self.name, "Invalid")
+
+        el = array("d")
+        tof = array("d")
+
+        for rn in range(self.min_range, self.max_range+1):
+            i = bisect.bisect_right(ranges, rn)-1
+
+            # Try and find the exact elevation and time of flight.
+            if card[i][0] == rn:
+                el.append(card[i][1])
+                tof.append(card[i][2])
+                continue
+
+            # Interpolate if the range isn't exact.
+            step = card[i+1][0] - card[i][0]
+            r = rn - card[i][0]
+            e = (card[i+1][1] - card[i][1])/step
+            t = (card[i+1][2] - card[i][2])/step
+            el.append(half_round(card[i][1]+e*r))
+            tof.append(round(card[i][2]+t*r))
+
+        return (el, tof)
+
+    def tables(self):
+        """Returns the per meter lookup tables, rebuilding them if the card changed."""
+
+        tables = self._tables
+
+        if (tables is None or tables[0] is not self.card
+                or tables[1] != self.min_range or tables[2] != self.max_range):
+
+            tables = (self.card, self.min_range, self.max_range) + self._compile()
+            self._tables = tables
+
+        return tables
+
+    def _lookup(self, rn, col):
+        """Looks up a column of the per meter tables for a range."""
+
+        tables = self.tables()
+
+        # Make sure the target is within range.
+        if not tables[1] <= rn <= tables[2]:
+            raise OutOfRangeError(rn)
+
+        # Keep whole numbers as integers like the range card does.
+        v = tables[col][rn-tables[1]]
+        return int(v) if v.is_integer() else v
+
+    def el(self, rn):
+        """Returns the elevation for a range."""
+
+        return self._lookup(rn, 3)
+
+    def tof(self, rn):
+        """Returns the time of flight for a range."""
+
+        return self._lookup(rn, 4)
+
+class _MortarProfile(Profile):
+    """The built-in Squad mortar profiles, which follow the library variables."""
+
+    def __init__(self, shell):
+        self.name = "MORTAR-{}".format(shell)
+        self.weapon = "MORTAR"
+        self.shell = shell
+        self._tables = None
+
+    card = property(lambda self: range_card)
+    min_range = property(lambda self: min_range)
+    max_range = property(lambda self: max_range)
+    burst = property(lambda self: he_burst if self.shell == "HE" else smk_burst)
+
+def register_profile(profile):
+    """Adds a ballistic profile to the registry, replacing any with the same name."""
+
+    _profiles[profile.name] = profile
+
+    return profile
+
+def profiles():
+    """Returns the names of the registered ballistic profiles."""
+
+    return list(_profiles)
+
+def get_profile(profile=None):
+    """Returns a registered ballistic profile by name.
+       Profiles are passed through and None gives the default profile.
+    """
+
+    if isinstance(profile, Profile):
+        return profile
+
+    name = default_profile if profile is None else profile
+
+    try:
+        return _profiles[name.upper()]
+    except (KeyError, AttributeError):
+        raise ProfileError(name)
+
+def find_profile(weapon, shell):
+    """Returns the registered ballistic profile of a weapon and shell."""
+
+    for profile in _profiles.values():
+        if profile.weapon == weapon.upper() and profile.shell == shell.upper():
+            return profile
+
+    raise ShellError(shell)
+
+def load_profiles(path):
+    """Loads ballistic profiles from a JSON file and registers them.
+
+       The file holds a list of objects with a name, weapon, shell, card
+       and burst, and optionally a min_range and max_range.
+    """
+
+    with open(path) as f:
+        data = json.load(f)
+
+    loaded = []
+
+    for i in data if isinstance(data, list) else [data]:
+        try:
+            profile = Profile(**i)
+
+            # Make sure the card can be compiled before replacing anything.
+            profile.tables()
+        except (ProfileError, TypeError, IndexError, AttributeError, ValueError, ZeroDivisionError):
+            raise ProfileError(path, "Invalid")
+
+        loaded.append(profile)
+
+    return [register_profile(i) for i in loaded]
+
+register_profile(_MortarProfile("HE"))
+register_profile(_MortarProfile("SMK"))
 
 ################################
 # MORTAR FUNCTIONS
 ################################
 
-def get_rn(grid1, grid2, center=False):
-    """Returns the range between two grids."""
+def _rn(g, t):
+    """Returns the range between two vector points."""
 
     # Lose of precision due to rounding, might remove later.
-    return round(math.dist(grid_to_vec(grid1, center=center),
-                           grid_to_vec(grid2, center=center)))
+    return round(math.dist(g, t))
 
-def get_az(grid1, grid2, center=False):
-    """Returns the azimuth between two grids."""
-
-    # Turn both grids into vector points.
-    g = grid_to_vec(grid1, center=center)
-    t = grid_to_vec(grid2, center=center)
+def _az(g, t):
+    """Returns the azimuth between two vector points."""
 
     # Get the angle of the tangent in radians.
     az = math.atan2(t[0]-g[0], t[1]-g[1])
@@ -379,61 +580,610 @@ def get_az(grid1, grid2, center=False):
 
     return az
 
-def get_el(gun, tgt, center=False):
-    """Gets the elevation of the gun based on the gun and target grids."""
+def get_rn(grid1, grid2, center=False):
+    """Returns the range between two grids."""
 
-    # Get the range between the gun and target.
-    # Range is needed for determining elevation.
-    rn = get_rn(gun, tgt, center=center)
-    rn50 = rn//50-1
+    return _rn(grid_to_vec(grid1, center=center),
+               grid_to_vec(grid2, center=center))
 
-    # Make sure the target is within range.
-    if min_range <= rn <= max_range:
+def get_az(grid1, grid2, center=False):
+    """Returns the azimuth between two grids."""
 
-        # Try and find the exact elevation.
-        if rn % 50 == 0:
-            return range_card[rn50][1]
+    return _az(grid_to_vec(grid1, center=center),
+               grid_to_vec(grid2, center=center))
 
-        # Interpolate if the range isn't exact.
-        e = (range_card[rn50+1][1] - range_card[rn50][1])/50
-        r = abs(range_card[rn50][0] - rn)
-        return half_round(range_card[rn50][1]+e*r)
+def get_el(gun, tgt, center=False, profile=None):
+    """Gets the elevation of the gun based on the gun and target grids."""
 
-    # At this point we were unable to calculate for elevation.
-    raise OutOfRangeError(rn)
+    # Range is needed for determining elevation.
+    return get_profile(profile).el(get_rn(gun, tgt, center=center))
 
-def get_tof(gun, tgt, center=False):
+def get_tof(gun, tgt, center=False, profile=None):
     """Gets the time of flight of the round based on the gun and target grids."""
 
-    # Get the range between the gun and target.
     # Range is needed for determining time of flight.
-    rn = get_rn(gun, tgt, center=center)
-    rn50 = rn//50-1
+    return get_profile(profile).tof(get_rn(gun, tgt, center=center))
 
-    # Make sure the target is within range.
-    if min_range <= rn <= max_range:
-
-        # Try and find the exact time of flight.
-        if rn % 50 == 0:
-            return range_card[rn50][2]
-
-        # Interpolate if the range isn't exact.
-        t = (range_card[rn50+1][2] - range_card[rn50][2])/50
-        r = abs(range_card[rn50][0] - rn)
-        return round(range_card[rn50][2]+t*r)
-
-    # At this point we were unable to calculate for time of flight.
-    raise OutOfRangeError(rn)
-
-def calc_data(gun, tgt, center=False):
+def calc_data(gun, tgt, center=False, profile=None):
     """Takes two grids, a gun and target, and returns a tuple of firing data.
        (range, azimuth, elevation, time of flight)
+
+       The profile is a Profile or the name of one, by default the mortar's HE.
     """
 
+    profile = get_profile(profile)
+
+    # Parse both grids once and share them between the calculations.
+    g = grid_to_vec(gun, center=center)
+    t = grid_to_vec(tgt, center=center)
+
     # Calculate the firing data.
-    rn = get_rn(gun, tgt, center=center)
-    az = get_az(gun, tgt, center=center)
-    el = get_el(gun, tgt, center=center)
-    tof = get_tof(gun, tgt, center=center)
+    rn = _rn(g, t)
+    az = _az(g, t)
+    el = profile.el(rn)
+    tof = profile.tof(rn)
 
     return (rn, az, el, tof)
+
+################################
+# BATCH FUNCTIONS
+################################
+
+def _require_numpy():
+    """Imports NumPy the first time a batch function needs it."""
+
+    global np
+
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("NumPy is required for batch calculations.")
+        np = numpy
+
+    return np
+
+def _as_cords(grids, center=False):
+    """Turns an array of grids or vector points into a float array of shape (..., 2)."""
+
+    _require_numpy()
+
+    arr = np.asarray(grids)
+
+    # An empty list comes out as floats, but it's an empty list of grids.
+    if arr.size == 0 and arr.shape[-1:] != (2,):
+        return np.empty(arr.shape+(2,))
+
+    # Already parsed vector points.
+    if arr.dtype.kind in "iuf":
+        if arr.shape[-1:] != (2,):
+            raise ValueError("Vector points must have a last dimension of 2.")
+        return arr.astype(float)
+
+    # Grids need to be parsed one at a time.
+    arr = np.asarray(grids, dtype=object)
+    cords = np.empty(arr.shape+(2,))
+    for i, grid in enumerate(arr.flat):
+        cords.reshape(-1, 2)[i] = grid_to_vec(grid, center=center)
+
+    return cords
+
+def _half_round_array(num):
+    """Array version of half_round that matches the scalar results exactly."""
+
+    _require_numpy()
+
+    num = np.asarray(num, dtype=float)
+    tenths = num*10
+    out = np.rint(tenths)/10
+
+    # Round to a whole number, unless the tenths place is half.
+    whole = np.mod(out, 1) != .5
+    out[whole] = np.rint(out[whole])
+
+    # Python's round() works on the exact decimal value, so anything close
+    # to a hundredths tie may round differently. Let half_round settle those.
+    near = np.abs(tenths - np.floor(tenths) - .5) < 1e-6
+    for i in np.flatnonzero(near):
+        out.flat[i] = half_round(float(num.flat[i]))
+
+    return out
+
+def _lookup_batch(rn, col, mask, profile):
+    """Looks up a column of the per meter tables for an array of ranges."""
+
+    tables = profile.tables()
+    out = np.full(rn.shape, np.nan)
+    out[mask] = np.frombuffer(tables[col])[rn[mask].astype(int)-tables[1]]
+
+    return out
+
+def calc_data_batch(guns, tgts, center=False, profile=None):
+    """Takes arrays of gun and target grids and returns arrays of firing data.
+       (range, azimuth, elevation, time of flight, in range)
+
+       Grids may be given as strings or as vector points of shape (..., 2).
+       Gun and target arrays are broadcast against each other, so a battery
+       can be solved against a target list with guns[:, None] and tgts[None, :].
+       Elevation and time of flight are NaN wherever the in range mask is False.
+    """
+
+    _require_numpy()
+
+    profile = get_profile(profile)
+
+    g = _as_cords(guns, center=center)
+    t = _as_cords(tgts, center=center)
+
+    dx = t[..., 0] - g[..., 0]
+    dy = t[..., 1] - g[..., 1]
+
+    # Get the range between the guns and targets.
+    rn = np.rint(np.sqrt(dx*dx + dy*dy))
+
+    # Get the azimuth in cardinal degrees.
+    az = _half_round_array(np.degrees(np.arctan2(dx, dy)))
+    az[az < 0] += 360
+    az[az == 360] = 0
+
+    # Make sure the targets are within range.
+    mask = (profile.min_range <= rn) & (rn <= profile.max_range)
+
+    el = _lookup_batch(rn, 3, mask, profile)
+    tof = _lookup_batch(rn, 4, mask, profile)
+
+    return (rn, az, el, tof, mask)
+
+################################
+# SHEAF FUNCTIONS
+################################
+
+# Sheaf shapes by name. Each one is called with the number of guns, the
+# burst radius of the shell and any options, and returns an (N, 2) array of
+# east and north offsets in meters from the target.
+sheaf_shapes = {}
+
+def register_sheaf(name, shape):
+    """Adds a sheaf shape, replacing any with the same name."""
+
+    sheaf_shapes[name.upper()] = shape
+
+    return shape
+
+def _rotate(along, across, attitude):
+    """Turns offsets along and across an attitude into east and north offsets."""
+
+    a = np.radians(attitude)
+
+    return np.stack((along*np.sin(a) + across*np.cos(a),
+                     along*np.cos(a) - across*np.sin(a)), axis=-1)
+
+def _sheaf_converged(n, burst, **opts):
+    """Every gun aims at the target."""
+
+    return np.zeros((n, 2))
+
+def _sheaf_circle(n, burst, **opts):
+    """Guns are spread evenly around a circle of the burst radius."""
+
+    a = np.radians(np.arange(n)*360/n)
+
+    return np.stack((np.sin(a)*burst, np.cos(a)*burst), axis=-1)
+
+def _sheaf_linear(n, burst, attitude=0, length=None, **opts):
+    """Guns are spread evenly along a line through the target at an attitude.
+       The line is a burst wide for each gun by default.
+    """
+
+    step = burst if length is None else length/n
+    along = (n-1)*step/2 - np.arange(n)*step
+
+    return _rotate(along, np.zeros(n), attitude)
+
+def _sheaf_open(n, burst, **opts):
+    """Guns are spread a burst apart along a line from east to west."""
+
+    return _sheaf_linear(n, burst, attitude=90)
+
+def _sheaf_rectangle(n, burst, attitude=0, length=None, width=None, **opts):
+    """Guns are spread over the rows and columns of a rectangle centered on
+       the target, with its length along the attitude.
+    """
+
+    side = math.ceil(math.sqrt(n))*burst
+    length = side if length is None else length
+    width = side if width is None else width
+
+    # Pick rows and columns that keep the spacing roughly square.
+    rows = max(1, min(n, round(math.sqrt(n*length/width))))
+    cols = math.ceil(n/rows)
+
+    i = np.arange(n)
+    along = length/rows*((rows-1)/2 - i//cols)
+    across = width/cols*(i % cols - (cols-1)/2)
+
+    return _rotate(along, across, attitude)
+
+register_sheaf("CONVERGED", _sheaf_converged)
+register_sheaf("CIRCLE", _sheaf_circle)
+register_sheaf("OPEN", _sheaf_open)
+register_sheaf("LINEAR", _sheaf_linear)
+register_sheaf("RECTANGLE", _sheaf_rectangle)
+
+def sheaf_aimpoints(tgt, n, sheaf="CONVERGED", profile=None, center=False, **opts):
+    """Returns an (N, 2) array of the vector points N guns should aim at.
+       Options such as attitude, length and width are passed to the shape.
+    """
+
+    _require_numpy()
+
+    try:
+        shape = sheaf_shapes[sheaf.upper()]
+    except KeyError:
+        raise SMTLIB_Error("Unknown sheaf type: \"{}\"".format(sheaf))
+
+    # Make sure not to shoot a sheaf if there's only one gun.
+    if n == 1:
+        shape = _sheaf_converged
+
+    t = np.asarray(grid_to_vec(tgt, center=center), dtype=float)
+
+    return t + shape(n, get_profile(profile).burst, **opts)
+
+def calc_sheaf(guns, tgt, sheaf="CONVERGED", profile=None, center=False, **opts):
+    """Takes N gun grids and a target, and returns the aim point and firing
+       data of each gun in one pass.
+       (aim point grids, range, azimuth, elevation, time of flight, in range)
+
+       The aim points are worked out as vector points and turned into grids
+       at the end. The firing data is for those grids, so a gun that's sent
+       a grid and its data gets the same answer from either. See
+       calc_data_batch for the firing data arrays.
+    """
+
+    g = _as_cords(guns, center=center)
+    aim = sheaf_aimpoints(tgt, len(g), sheaf, profile=profile, center=center, **opts)
+
+    try:
+        grids = list(smt_grid.encode_array(aim))
+    except ValueError:
+        raise InvalidGridError(tgt)
+
+    # Guns aiming right at the target keep the target's grid.
+    if isinstance(tgt, str):
+        t = grid_to_vec(tgt, center=center)
+        grids = [tgt if tuple(a) == t else i for a, i in zip(aim, grids)]
+
+    return (grids,)+calc_data_batch(g, _as_cords(grids, center=center), profile=profile)
+
+################################
+# SPATIAL INDEX
+################################
+
+class GunIndex:
+    """A uniform bucket grid of gun positions for answering range queries.
+
+       Guns are bucketed by their vector point, so a query only has to look
+       at the buckets that overlap the mortar's range annulus.
+    """
+
+    def __init__(self, bucket=300, center=False):
+        self.bucket = bucket
+        self.center = center
+
+        # Gun names in each bucket with their vector points.
+        self._buckets = {}
+
+        # Vector point and bucket of each gun.
+        self._guns = {}
+
+        # The order guns were first added in, so queries are stable.
+        self._order = {}
+        self._added = 0
+
+    def __len__(self):
+        return len(self._guns)
+
+    def __contains__(self, name):
+        return name in self._guns
+
+    def _bucket(self, cords):
+        return (int(cords[0]//self.bucket), int(cords[1]//self.bucket))
+
+    def update(self, name, grid):
+        """Adds a gun or moves it to a new grid or grid key.
+           A gun with an invalid grid is removed and False is returned.
+        """
+
+        try:
+            cords = grid_to_vec(grid, center=self.center)
+        except InvalidGridError:
+            self.remove(name)
+            return False
+
+        # Nothing to do if the gun hasn't moved.
+        if name in self._guns:
+            if self._guns[name][0] == cords:
+                return True
+            self._unbucket(name)
+
+        b = self._bucket(cords)
+        self._buckets.setdefault(b, {})[name] = cords
+        self._guns[name] = (cords, b)
+
+        if name not in self._order:
+            self._order[name] = self._added
+            self._added += 1
+
+        return True
+
+    def _unbucket(self, name):
+        b = self._guns.pop(name)[1]
+        del self._buckets[b][name]
+
+        if not self._buckets[b]:
+            del self._buckets[b]
+
+    def remove(self, name):
+        """Removes a gun from the index. If it's added again, it goes last."""
+
+        if name not in self._guns:
+            return
+
+        self._unbucket(name)
+        del self._order[name]
+
+    def query(self, tgt, min_rn=None, max_rn=None, where=None, profile=None):
+        """Returns the names of the guns within range of a target grid or key,
+           in the order they were first added. Ranges default to the profile's.
+           If given, where is called with each gun name to filter them further.
+        """
+
+        t = grid_to_vec(tgt, center=self.center)
+        profile = get_profile(profile)
+        lo = profile.min_range if min_rn is None else min_rn
+        hi = profile.max_range if max_rn is None else max_rn
+
+        # Ranges are rounded to the meter, so allow for half a meter.
+        near = hi+.5
+        far = lo-.5
+
+        x0, y0 = self._bucket((t[0]-near, t[1]-near))
+        x1, y1 = self._bucket((t[0]+near, t[1]+near))
+
+        # Only walk the occupied buckets if there's fewer of them.
+        if len(self._buckets) < (x1-x0+1)*(y1-y0+1):
+            buckets = [b for b in self._buckets if x0 <= b[0] <= x1 and y0 <= b[1] <= y1]
+        else:
+            buckets = [(bx, by) for bx in range(x0, x1+1) for by in range(y0, y1+1)
+                       if (bx, by) in self._buckets]
+
+        guns = []
+        for bx, by in buckets:
+
+            # Skip buckets that are entirely inside the minimum range.
+            dx = max(abs(t[0]-bx*self.bucket), abs(t[0]-(bx+1)*self.bucket))
+            dy = max(abs(t[1]-by*self.bucket), abs(t[1]-(by+1)*self.bucket))
+            if math.hypot(dx, dy) < far:
+                continue
+
+            for name, g in self._buckets[(bx, by)].items():
+                if lo <= _rn(g, t) <= hi and (where is None or where(name)):
+                    guns.append(name)
+
+        guns.sort(key=self._order.__getitem__)
+
+        return guns
+
+################################
+# COVERAGE MAPS
+################################
+
+class Coverage:
+    """Bitmaps of the keypad cells on a map that are within range of each gun.
+
+       The map is split into cells at a keypad depth. Bit cy*width+cx of a
+       bitmap is set if the center of that cell is within the mortar's range
+       of the gun, so battery coverage is just a bitwise OR or AND.
+    """
+
+    def __init__(self, zones=(15, 15), depth=3, center=False, profile=None):
+        self.depth = depth
+        self.center = center
+        self.profile = get_profile(profile)
+
+        # Size of a cell in meters and the map size in cells.
+        self.size = 300/3**depth
+        self.width = zones[0]*3**depth
+        self.height = zones[1]*3**depth
+
+        # Vector point of each gun.
+        self._guns = {}
+
+        # Bitmaps of every occupied vector point.
+        self._bitmaps = {}
+
+    def __len__(self):
+        return len(self._guns)
+
+    def __contains__(self, name):
+        return name in self._guns
+
+    def _row(self, g, cy, lo, hi):
+        """Returns the bits of a row of cells that are within range of a gun."""
+
+        s = self.size
+        dy = -(cy+.5)*s - g[1]
+
+        # Rounds a cell's range like get_rn does.
+        def rn(cx):
+            return round(math.hypot((cx+.5)*s - g[0], dy))
+
+        # Finds the first and last cells whose centers are within a distance,
+        # then nudges them to agree with the rounded range.
+        def span(d, inside):
+            if abs(dy) > d:
+                return (0, -1)
+
+            w = math.sqrt(d*d - dy*dy)
+            left = max(math.ceil((g[0]-w)/s - .5), 0)
+            right = min(math.floor((g[0]+w)/s - .5), self.width-1)
+
+            while left <= right and not inside(rn(left)):
+                left += 1
+            while left > 0 and inside(rn(left-1)):
+                left -= 1
+            while right >= left and not inside(rn(right)):
+                right -= 1
+            while right < self.width-1 and inside(rn(right+1)):
+                right += 1
+
+            return (left, right)
+
+        left, right = span(hi+.5, lambda r: r <= hi)
+        if left > right:
+            return 0
+
+        bits = ((1 << (right-left+1))-1) << left
+
+        # Take out the cells that are too close.
+        left, right = span(lo+.5, lambda r: r < lo)
+        if left <= right:
+            bits &= ~(((1 << (right-left+1))-1) << left)
+
+        return bits
+
+    def _build(self, g):
+        """Builds the coverage bitmap of a gun at a vector point."""
+
+        bitmap = 0
+
+        # Only the rows within maximum range can have any bits.
+        lo = self.profile.min_range
+        hi = self.profile.max_range
+        top = max(int((-g[1]-hi)//self.size)-1, 0)
+        bottom = min(int((-g[1]+hi)//self.size)+1, self.height-1)
+
+        for cy in range(top, bottom+1):
+            row = self._row(g, cy, lo, hi)
+            if row:
+                bitmap |= row << (cy*self.width)
+
+        return bitmap
+
+    def update(self, name, grid):
+        """Adds a gun or moves it to a new grid or grid key.
+           A gun with an invalid grid is removed and False is returned.
+        """
+
+        try:
+            cords = grid_to_vec(grid, center=self.center)
+        except InvalidGridError:
+            self.remove(name)
+            return False
+
+        # Nothing to do if the gun hasn't moved.
+        if self._guns.get(name) == cords:
+            return True
+
+        self.remove(name)
+        self._guns[name] = cords
+
+        if cords not in self._bitmaps:
+            self._bitmaps[cords] = self._build(cords)
+
+        return True
+
+    def remove(self, name):
+        """Removes a gun and drops its bitmap if no other gun shares it."""
+
+        cords = self._guns.pop(name, None)
+
+        if cords is not None and cords not in self._guns.values():
+            del self._bitmaps[cords]
+
+    def bitmap(self, name):
+        """Returns the coverage bitmap of a gun."""
+
+        return self._bitmaps[self._guns[name]]
+
+    def _cells(self, grid):
+        """Returns the first cell column and row of a grid and how many cells wide it is."""
+
+        if not isinstance(grid, int) or isinstance(grid, bool):
+            grid = grid_to_key(grid)
+
+        cx, cy, n = smt_grid.key_cell(grid)
+
+        # Deeper grids fall inside a single cell.
+        if n >= self.depth:
+            p = 3**(n-self.depth)
+            return (cx//p, cy//p, 1)
+
+        p = 3**(self.depth-n)
+        return (cx*p, cy*p, p)
+
+    def area(self, grid):
+        """Returns a bitmap of the cells covered by a grid or grid key."""
+
+        cx, cy, w = self._cells(grid)
+        bitmap = 0
+
+        for row in range(cy, min(cy+w, self.height)):
+            if cx < self.width:
+                bitmap |= ((1 << min(w, self.width-cx))-1) << (row*self.width+cx)
+
+        return bitmap
+
+    def who_can_hit(self, grid):
+        """Returns the names of the guns that can hit the center of a grid or grid key."""
+
+        cx, cy, w = self._cells(grid)
+        cx += w//2
+        cy += w//2
+
+        # Nothing can hit a grid that's off the map.
+        if cx >= self.width or cy >= self.height:
+            return []
+
+        bit = 1 << (cy*self.width + cx)
+
+        return [name for name, cords in self._guns.items() if self._bitmaps[cords] & bit]
+
+    def count(self, grid):
+        """Returns how many guns can reach every cell of a grid or grid key."""
+
+        area = self.area(grid)
+
+        if not area:
+            return 0
+
+        return sum(1 for cords in self._guns.values() if self._bitmaps[cords] & area == area)
+
+    def union(self, names=None):
+        """Returns a bitmap of the cells that any of the guns can hit."""
+
+        bitmap = 0
+        for name in self._guns if names is None else names:
+            bitmap |= self.bitmap(name)
+
+        return bitmap
+
+    def intersection(self, names=None):
+        """Returns a bitmap of the cells that all of the guns can hit."""
+
+        names = list(self._guns if names is None else names)
+        if not names:
+            return 0
+
+        bitmap = self.bitmap(names[0])
+        for name in names[1:]:
+            bitmap &= self.bitmap(name)
+
+        return bitmap
+
+    @staticmethod
+    def cell_count(bitmap):
+        """Returns the number of cells set in a bitmap."""
+
+        return bin(bitmap).count("1")
@@ -0,0 +1,342 @@
+"""Messages sent between the MC and FDC programs.
+
+Every message starts with an 8 byte header: the magic bytes b"SM", the
+protocol version, the message type and the length of the body as a big
+endian 32 bit number. The body is a fixed list of fields for its type.
+
+    strings    a 1 byte length, with the UTF-8 bytes after the fixed part
+    statuses   a 1 byte code from a table, or 255 for a status sent as a string
+    numbers    8 byte big endian doubles (the firing data)
+
+A gun that stays connected opens with a PING carrying its name, which tells
+the FDC to push its missions down the connection as soon as they're queued.
+After that, PING messages keep the connection alive between gun reports.
+
+A Decoder can be fed bytes as they arrive and hands back every whole
+message, no matter how the messages were split up or joined together by
+the network. This module has no side effects and only needs the standard
+library, so the message logic can be used without a GUI.
+"""
+
+import sys
+import struct
+
+__all__ = [
+    "Decoder",
+    "eom_message",
+    "gun_report",
+    "HEADER_SIZE",
+    "mission_message",
+    "pack",
+    "ping_message",
+    "PROTOCOL_VERSION",
+    "ProtocolError",
+    "status_message",
+    "TYPES",
+    "unpack"
+    ]
+
+################################
+# PROTOCOL VARIABLES
+################################
+
+PROTOCOL_VERSION = 1
+
+MAGIC = b"SM"
+
+# Header of every message: magic, version, type and body length.
+_HEADER = struct.Struct(">2sBBI")
+HEADER_SIZE = _HEADER.size
+
+# Largest body a message can have.
+MAX_BODY = 65536
+
+# Message types and their codes.
+TYPES = {"GUN": 1,
+         "TGT": 2,
+         "STATUS": 3,
+         "EOM": 4,
+         "PING": 5}
+
+# Reverse of the message types for decoding.
+_KINDS = {v: k for k, v in TYPES.items()}
+
+# Status codes. Values that aren't in a table are sent as strings.
+GUN_STATUSES = ("", "OUT OF ACTION", "MOVING", "EMPLACING", "EMPLACED")
+CAPABLE = ("", "YES", "NO")
+MISSION_STATUSES = ("", "WAITING", "SENDING", "RECEIVED", "SHOT", "COMPLETE", "EOM")
+
+# Code of a status that is sent as a string.
+_OTHER = 255
+
+################################
+# EXCEPTIONS
+################################
+
+class ProtocolError(Exception):
+    """Exception for a message that can't be read."""
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return "Invalid message: {}".format(self.reason)
+
+################################
+# MESSAGE LAYOUTS
+################################
+
+class _Layout:
+    """The fields of a message type.
+
+       A body starts with a fixed part holding the length of every string
+       field, the status codes and the firing data, all read with a single
+       struct call. The bytes of the strings follow, then any statuses that
+       weren't in their table, as a length and the bytes.
+    """
+
+    def __init__(self, strs, ids, enums, firing=()):
+        self.strs = strs
+        self.ids = ids
+        self.enums = enums
+        self.codes = [{v: n for n, v in enumerate(table)} for key, table in enums]
+        self.firing = firing
+        self.fixed = struct.Struct(">{}B{}B{}d".format(len(strs), len(enums), len(firing)))
+
+# The string fields, the ones of those that are names or IDs, the status
+# fields with their code tables, and the firing data fields of each type.
+_LAYOUTS = {
+    "GUN": _Layout(("NAME", "GRID", "AMMO", "MISSION"), ("NAME", "MISSION"),
+                   (("STATUS", GUN_STATUSES), ("CAPABLE", CAPABLE))),
+    "TGT": _Layout(("GUN", "ID", "GRID", "MOC", "SHELL", "ROUNDS"), ("GUN", "ID"),
+                   (("STATUS", MISSION_STATUSES),), ("RANGE", "AZIMUTH", "ELEVATION", "TOF")),
+    "STATUS": _Layout(("ID", "GUN"), ("ID", "GUN"), (("STATUS", MISSION_STATUSES),)),
+    "EOM": _Layout(("GUN", "ID"), ("GUN", "ID"), (("STATUS", MISSION_STATUSES),)),
+    "PING": _Layout(("NAME",), ("NAME",), ()),
+    }
+
+# The start of the header of each message type.
+_PREFIX = {kind: MAGIC+bytes((PROTOCOL_VERSION, code)) for kind, code in TYPES.items()}
+_LENGTH = struct.Struct(">I")
+
+################################
+# ENCODING FUNCTIONS
+################################
+
+def pack(kind, data):
+    """Turns a message into bytes. The kind is a key of TYPES."""
+
+    try:
+        layout = _LAYOUTS[kind]
+    except KeyError:
+        raise ProtocolError("unknown message type {!r}".format(kind))
+
+    strs = [str(data.get(key, "")).encode() for key in layout.strs]
+    values = [len(b) for b in strs]
+
+    for (key, table), codes in zip(layout.enums, layout.codes):
+        v = data.get(key, "")
+        n = codes.get(v)
+
+        # Statuses that aren't in the table are sent as strings at the end.
+        if n is None:
+            n = _OTHER
+            b = str(v).encode()
+            if len(b) > 255:
+                raise ProtocolError("{} field {} is too long".format(kind, key))
+            strs.append(bytes((len(b),)))
+            strs.append(b)
+
+        values.append(n)
+
+    try:
+        values += [data[key] for key in layout.firing]
+        fixed = layout.fixed.pack(*values)
+    except KeyError as e:
+        raise ProtocolError("missing {} field {}".format(kind, e))
+    except struct.error as e:
+        raise ProtocolError("bad {} field: {}".format(kind, e))
+
+    body = fixed+b"".join(strs)
+
+    return _PREFIX[kind]+_LENGTH.pack(len(body))+body
+
+################################
+# DECODING FUNCTIONS
+################################
+
+def _header(buf, i=0):
+    """Reads a message header.
+       (kind, body length)
+    """
+
+    magic, version, code, size = _HEADER.unpack_from(buf, i)
+
+    if magic != MAGIC:
+        raise ProtocolError("bad magic {!r}".format(magic))
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError("unsupported version {}".format(version))
+    if code not in _KINDS:
+        raise ProtocolError("unknown message type {}".format(code))
+    if size > MAX_BODY:
+        raise ProtocolError("body too large ({} bytes)".format(size))
+
+    return (_KINDS[code], size)
+
+def _body(kind, buf):
+    """Reads the fields of a message body."""
+
+    layout = _LAYOUTS[kind]
+    strs = layout.strs
+    data = {}
+
+    try:
+        values = layout.fixed.unpack_from(buf)
+        i = layout.fixed.size
+
+        for key, n in zip(strs, values):
+            data[key] = buf[i:i+n].decode()
+            i += n
+
+        for (key, table), n in zip(layout.enums, values[len(strs):]):
+            if n == _OTHER:
+                j = i+1+buf[i]
+                data[key] = buf[i+1:j].decode()
+                i = j
+            elif n < len(table):
+                data[key] = table[n]
+            else:
+                raise ProtocolError("unknown status code {}".format(n))
+
+        # Keep whole numbers as integers like the range card does.
+        for key, v in zip(layout.firing, values[len(strs)+len(layout.enums):]):
+            data[key] = int(v) if v.is_integer() else v
+
+    except (IndexError, UnicodeDecodeError, struct.error) as e:
+        raise ProtocolError("bad {} body: {}".format(kind, e))
+
+    if i != len(buf):
+        raise ProtocolError("{} body is {} bytes, expected {}".format(kind, len(buf), i))
+
+    # Names and IDs repeat in every message, so share a single copy of each.
+    for key in layout.ids:
+        data[key] = sys.intern(data[key])
+
+    # End of mission messages from the FDC don't have a status.
+    if kind == "EOM" and not data["STATUS"]:
+        del data["STATUS"]
+
+    return data
+
+def unpack(data):
+    """Turns the bytes of exactly one message back into a message.
+       (kind, data)
+    """
+
+    if len(data) < HEADER_SIZE:
+        raise ProtocolError("truncated header")
+
+    kind, size = _header(data)
+
+    if len(data) != HEADER_SIZE+size:
+        raise ProtocolError("expected {} bytes, got {}".format(HEADER_SIZE+size, len(data)))
+
+    return (kind, _body(kind, data[HEADER_SIZE:]))
+
+class Decoder:
+    """Turns a stream of bytes back into messages.
+
+       Feed it data as it's read from a socket and it returns the messages
+       that are complete so far. Anything left over is kept for next time.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def __len__(self):
+        """Returns the number of bytes waiting for the rest of a message."""
+
+        return len(self._buf)
+
+    def feed(self, data):
+        """Adds bytes to the stream and returns a list of (kind, data) messages."""
+
+        buf = self._buf
+        buf += data
+        out = []
+        i = 0
+
+        while len(buf)-i >= HEADER_SIZE:
+            kind, size = _header(buf, i)
+            end = i+HEADER_SIZE+size
+
+            if end > len(buf):
+                break
+
+            out.append((kind, _body(kind, buf[i+HEADER_SIZE:end])))
+            i = end
+
+        if i:
+            del buf[:i]
+
+        return out
+
+################################
+# MESSAGE FUNCTIONS
+################################
+
+def gun_report(name, grid="", ammo="", status="", capable="", mission=""):
+    """Returns the report a gun sends the FDC every update.
+       Missing fields are filled in the same way the MC does.
+    """
+
+    return {"NAME": name,
+            "GRID": grid or "N/A",
+            "AMMO": ammo or "N/A",
+            "STATUS": status or "OUT OF ACTION",
+            "CAPABLE": "NO" if not capable or mission else capable,
+            "MISSION": mission}
+
+def mission_message(gun, mission, data):
+    """Returns the message that sends a mission and its firing data to a gun.
+       data is a (range, azimuth, elevation, time of flight) tuple.
+    """
+
+    return {"GUN": gun,
+            "ID": mission["ID"],
+            "GRID": mission["GRID"],
+            "MOC": mission["MOC"],
+            "SHELL": mission["SHELL"],
+            "ROUNDS": mission["ROUNDS"],
+            "STATUS": mission["STATUS"],
+            "RANGE": data[0],
+            "AZIMUTH": data[1],
+            "ELEVATION": data[2],
+            "TOF": data[3]}
+
+def status_message(mission, gun, status):
+    """Returns the message a gun sends when its mission status changes."""
+
+    return {"ID": mission,
+            "GUN": gun,
+            "STATUS": status}
+
+def eom_message(mission, gun, status=None):
+    """Returns an end of mission message. The FDC sends these without a
+       status, and the gun sends one back with an EOM status.
+    """
+
+    data = {"GUN": gun,
+            "ID": mission}
+
+    if status:
+        data["STATUS"] = status
+
+    return data
+
+def ping_message(name=""):
+    """Returns a keep alive message. A gun sends its name, the FDC's replies
+       leave it empty.
+    """
+
+    return {"NAME": name}
@@ -0,0 +1,375 @@
+"""Terrain heightmaps and altitude corrected mortar data.
+
+Heightmaps are memory mapped from local NumPy or raw files, so only the
+parts of a map that are actually used get read. Heights are looked up
+through a small LRU cache of tiles copied out of the file.
+
+Trajectory clearance checks sample the arc of each shot against the
+heightmap, many shots at a time.
+
+Altitude corrections use a vacuum trajectory with the muzzle velocity that
+reaches the profile's maximum range at 45 degrees. Only the difference that
+the altitude makes is added to the range card, so the card stays the
+reference when the gun and target are level.
+"""
+
+import os
+import json
+import math
+import collections
+
+import numpy as np
+
+import smt_lib
+
+__all__ = [
+    "alt_correction",
+    "calc_data_alt",
+    "calc_data_terrain",
+    "check_clearance",
+    "Heightmap",
+    "load_heightmap"
+    ]
+
+################################
+# TERRAIN VARIABLES
+################################
+
+# Gravity in meters per second squared.
+gravity = 9.81
+
+# NATO mils in a radian, which the range card elevations use.
+MILS = 6400/(2*math.pi)
+
+# Default size of a heightmap tile in pixels.
+tile_size = 256
+
+# Default number of heightmap tiles to keep in memory.
+tile_cache_size = 64
+
+# Default number of points sampled along each trajectory.
+clearance_samples = 64
+
+################################
+# HEIGHTMAPS
+################################
+
+class Heightmap:
+    """A heightmap of a Squad map backed by a memory mapped array.
+
+       Row 0 is the north edge and column 0 the west edge. Each pixel is a
+       height sample resolution meters apart, and origin is the vector point
+       of pixel (0, 0). Heights are data*scale+offset meters.
+    """
+
+    def __init__(self, data, resolution=1.0, origin=(0, 0), scale=1.0, offset=0.0,
+                 tile=None, cache_tiles=None):
+        if np.ndim(data) != 2:
+            raise ValueError("Heightmaps must be two dimensional.")
+
+        self.data = data
+        self.resolution = resolution
+        self.origin = tuple(origin)
+        self.scale = scale
+        self.offset = offset
+        self.tile = tile_size if tile is None else tile
+        self.cache_tiles = tile_cache_size if cache_tiles is None else cache_tiles
+
+        # Tiles that have been read, least recently used first.
+        self._tiles = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def cache_info(self):
+        """Returns the hits, misses and number of tiles in the tile cache."""
+
+        return {"hits": self.hits, "misses": self.misses, "tiles": len(self._tiles)}
+
+    def cache_clear(self):
+        """Empties the tile cache."""
+
+        self._tiles.clear()
+
+    def _get_tile(self, ty, tx):
+        """Returns a tile of heights in meters, reading it if it isn't cached."""
+
+        key = (ty, tx)
+
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return self._tiles[key]
+
+        self.misses += 1
+
+        t = self.tile
+        tile = np.asarray(self.data[ty*t:(ty+1)*t, tx*t:(tx+1)*t], dtype=np.float32)
+        tile = tile*self.scale+self.offset
+
+        self._tiles[key] = tile
+        if len(self._tiles) > self.cache_tiles:
+            self._tiles.popitem(last=False)
+
+        return tile
+
+    def _samples(self, iy, ix):
+        """Gathers the heights of whole pixels, one tile at a time."""
+
+        t = self.tile
+        out = np.empty(iy.shape, dtype=np.float32)
+        ty = iy//t
+        tx = ix//t
+
+        # Sort the pixels by tile so each tile is fetched once.
+        ids = ty*(self.shape[1]//t+1) + tx
+        order = np.argsort(ids, kind="stable")
+        starts = np.flatnonzero(np.diff(ids[order], prepend=-1))
+        ends = np.append(starts[1:], len(order))
+
+        for a, b in zip(starts, ends):
+            sel = order[a:b]
+            y = int(ty[sel[0]])
+            x = int(tx[sel[0]])
+            out[sel] = self._get_tile(y, x)[iy[sel]-y*t, ix[sel]-x*t]
+
+        return out
+
+    def heights(self, cords):
+        """Returns the heights of an array of vector points of shape (..., 2).
+           Heights between pixels are interpolated and points off the map
+           take the height of the nearest edge.
+        """
+
+        cords = np.asarray(cords, dtype=float)
+        shape = cords.shape[:-1]
+        cords = cords.reshape(-1, 2)
+        rows, cols = self.shape
+
+        px = np.clip((cords[..., 0]-self.origin[0])/self.resolution, 0, cols-1)
+        py = np.clip((self.origin[1]-cords[..., 1])/self.resolution, 0, rows-1)
+
+        x0 = np.minimum(px.astype(np.int64), cols-2) if cols > 1 else np.zeros(px.shape, np.int64)
+        y0 = np.minimum(py.astype(np.int64), rows-2) if rows > 1 else np.zeros(py.shape, np.int64)
+        x1 = np.minimum(x0+1, cols-1)
+        y1 = np.minimum(y0+1, rows-1)
+        fx = px-x0
+        fy = py-y0
+
+        # Gather all four corners together so each tile is only fetched once.
+        s = self._samples(np.concatenate((y0, y0, y1, y1)),
+                          np.concatenate((x0, x1, x0, x1))).reshape(4, -1)
+
+        top = s[0]*(1-fx) + s[1]*fx
+        bottom = s[2]*(1-fx) + s[3]*fx
+
+        return (top*(1-fy) + bottom*fy).reshape(shape)
+
+    def height(self, grid, center=False):
+        """Returns the height of a grid, grid key or vector point."""
+
+        if isinstance(grid, (str, int)):
+            grid = smt_lib.grid_to_vec(grid, center=center)
+
+        return float(self.heights(grid))
+
+# Settings a heightmap can be loaded with.
+_SETTINGS = ("dtype", "shape", "resolution", "origin", "scale", "offset", "tile", "cache_tiles")
+
+def load_heightmap(path, **kw):
+    """Memory maps a heightmap from a .npy file or a raw file.
+
+       Settings come from a JSON file next to the heightmap with the same
+       name (map.npy and map.json), and are overridden by keyword arguments.
+       Raw files also need a dtype (16 bit unsigned by default) and a shape,
+       unless they're square. Raises ValueError for settings that aren't
+       known or a raw file that isn't square and has no shape.
+    """
+
+    meta = {}
+    side = os.path.splitext(path)[0]+".json"
+
+    if os.path.exists(side):
+        with open(side) as f:
+            meta = json.load(f)
+
+        if not isinstance(meta, dict):
+            raise ValueError("{} must be a JSON object.".format(side))
+
+    meta.update(kw)
+
+    unknown = set(meta)-set(_SETTINGS)
+    if unknown:
+        raise ValueError("Unknown heightmap settings: {}".format(", ".join(sorted(unknown))))
+
+    try:
+        dtype = np.dtype(meta.pop("dtype", "<u2"))
+    except TypeError as e:
+        raise ValueError("Bad heightmap dtype: {}".format(e))
+    shape = meta.pop("shape", None)
+
+    if path.lower().endswith(".npy"):
+        data = np.load(path, mmap_mode="r")
+    else:
+        if shape is None:
+            size = os.path.getsize(path)
+            n = math.isqrt(size//dtype.itemsize)
+            if n*n*dtype.itemsize != size:
+                raise ValueError("{} isn't square, give its shape.".format(path))
+            shape = (n, n)
+        data = np.memmap(path, dtype=dtype, mode="r", shape=tuple(shape))
+
+    return Heightmap(data, **meta)
+
+################################
+# ALTITUDE FUNCTIONS
+################################
+
+def _angle(rn, dh, v2):
+    """Returns the high angle in radians to hit a target rn meters away and
+       dh meters above the gun, or NaN if it can't be reached.
+    """
+
+    rn = np.maximum(rn, 1e-9)
+    disc = v2*v2 - gravity*(gravity*rn*rn + 2*dh*v2)
+
+    with np.errstate(invalid="ignore"):
+        return np.arctan((v2 + np.sqrt(disc))/(gravity*rn))
+
+def _tof(rn, theta, v2):
+    """Returns the vacuum time of flight of a round."""
+
+    return rn/(np.sqrt(v2)*np.cos(theta))
+
+def alt_correction(rn, dh, profile=None):
+    """Returns the changes to elevation in mils and time of flight in seconds
+       for a target dh meters above the gun. Works on scalars or arrays.
+       The changes are NaN if the target can't be reached.
+    """
+
+    profile = smt_lib.get_profile(profile)
+
+    # Muzzle velocity squared, from the maximum range at 45 degrees.
+    v2 = gravity*profile.max_range
+
+    level = _angle(rn, 0, v2)
+    theta = _angle(rn, dh, v2)
+
+    return ((theta-level)*MILS, _tof(rn, theta, v2)-_tof(rn, level, v2))
+
+def _add_tof(tof, dt):
+    """Adds a change to times of flight, rounded the way calc_data rounds
+       them: tenths for the ones straight off the range card, otherwise
+       whole seconds. A time of flight of zero means there's no data to
+       correct, so it's left alone.
+    """
+
+    tof = np.asarray(tof, dtype=float)
+    new = tof+np.nan_to_num(dt)
+    new = np.where(tof % 1, np.round(new, 1), np.rint(new))
+
+    return np.where(tof != 0, new, tof)
+
+def calc_data_alt(gun, tgt, heightmap=None, gun_alt=None, tgt_alt=None, center=False, profile=None):
+    """Takes two grids, a gun and target, and returns a tuple of firing data
+       corrected for altitude.
+       (range, azimuth, elevation, time of flight, altitude difference)
+
+       Altitudes that aren't given are looked up on the heightmap.
+    """
+
+    rn, az, el, tof = smt_lib.calc_data(gun, tgt, center=center, profile=profile)
+
+    if gun_alt is None:
+        gun_alt = heightmap.height(gun, center=center)
+    if tgt_alt is None:
+        tgt_alt = heightmap.height(tgt, center=center)
+
+    dh = tgt_alt-gun_alt
+    de, dt = alt_correction(rn, dh, profile=profile)
+
+    if math.isnan(de):
+        raise smt_lib.OutOfRangeError(rn)
+
+    tof = float(_add_tof(tof, dt))
+    tof = int(tof) if tof.is_integer() else tof
+
+    return (rn, az, smt_lib.half_round(el+float(de)), tof, dh)
+
+def calc_data_terrain(guns, tgts, heightmap, center=False, profile=None):
+    """Array version of calc_data_alt, see calc_data_batch for the arguments.
+       (range, azimuth, elevation, time of flight, altitude difference, in range)
+    """
+
+    g = smt_lib._as_cords(guns, center=center)
+    t = smt_lib._as_cords(tgts, center=center)
+
+    rn, az, el, tof, mask = smt_lib.calc_data_batch(g, t, profile=profile)
+
+    # Look up the guns and targets together so tiles are only fetched once.
+    h = heightmap.heights(np.concatenate((g.reshape(-1, 2), t.reshape(-1, 2))))
+    dh = h[g.size//2:].reshape(t.shape[:-1]) - h[:g.size//2].reshape(g.shape[:-1])
+    de, dt = alt_correction(rn, dh, profile=profile)
+
+    mask = mask & ~np.isnan(de)
+    el = np.where(mask, smt_lib._half_round_array(el+np.nan_to_num(de)), np.nan)
+    tof = np.where(mask, _add_tof(tof, dt), tof)
+
+    return (rn, az, el, tof, dh, mask)
+
+################################
+# CLEARANCE FUNCTIONS
+################################
+
+def check_clearance(guns, tgts, el, heightmap, samples=None, margin=0.0, center=False):
+    """Checks if shots clear the terrain on their way to the target.
+       (clear, strike points, strike distances)
+
+       Guns and targets are grids or vector points, broadcast like in
+       calc_data_batch, and el is the firing elevation of each shot in mils.
+       The arc of a shot leaves the gun at its elevation and comes down on the
+       target. Shots that dip below the terrain plus a margin aren't clear,
+       and their strike point is the first sample under the terrain. Clear
+       shots strike the target. Shots with a NaN elevation are never clear.
+    """
+
+    samples = clearance_samples if samples is None else samples
+
+    g = smt_lib._as_cords(guns, center=center)
+    t = smt_lib._as_cords(tgts, center=center)
+    el = np.asarray(el, dtype=float)
+
+    shape = np.broadcast_shapes(g.shape[:-1], t.shape[:-1], el.shape)
+    g = np.broadcast_to(g, shape+(2,)).reshape(-1, 2)
+    t = np.broadcast_to(t, shape+(2,)).reshape(-1, 2)
+    theta = np.broadcast_to(el, shape).reshape(-1)/MILS
+
+    # Fractions of the way along each shot, leaving out the gun and target.
+    f = np.arange(1, samples)/samples
+    pts = g[:, None, :] + (t-g)[:, None, :]*f[None, :, None]
+
+    # Look up everything in one go so each tile is only fetched once.
+    n = len(g)
+    h = heightmap.heights(np.concatenate((g, t, pts.reshape(-1, 2))))
+    hg = h[:n]
+    ht = h[n:2*n]
+    terrain = h[2*n:].reshape(n, samples-1)
+
+    # A parabola that leaves the gun at its elevation and lands on the target.
+    rn = np.maximum(np.hypot(*(t-g).T), 1e-9)
+    s = rn[:, None]*f[None, :]
+    k = (rn*np.tan(theta) - (ht-hg))/rn**2
+    z = hg[:, None] + s*np.tan(theta)[:, None] - k[:, None]*s*s
+
+    below = z < terrain+margin
+    hit = below.any(axis=1)
+    first = np.argmax(below, axis=1)
+
+    clear = ~hit & ~np.isnan(theta)
+    strike = np.where(hit[:, None], pts[np.arange(n), first], t)
+    dist = np.where(hit, s[np.arange(n), first], rn)
+
+    return (clear.reshape(shape), strike.reshape(shape+(2,)), dist.reshape(shape))
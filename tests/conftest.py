@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules aren't installed, they're run straight out of src.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
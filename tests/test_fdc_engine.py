@@ -0,0 +1,267 @@
+import json
+
+from fdc_engine import DispatchQueue, FdcEngine, MissionTracker
+from smt_proto import *
+
+def engine_with_guns(*grids):
+    engine = FdcEngine()
+
+    for n, grid in enumerate(grids):
+        engine.handle_message("GUN", gun_report("1-{}".format(n+1), grid, "10", "EMPLACED", "YES"))
+
+    return engine
+
+def test_retarget_drops_old_firing_data():
+    engine = engine_with_guns("A1-1-1", "A1-1-2")
+    engine.create_mission("T1", "A2-3-4", "2")
+    engine.tick()
+
+    assert engine.mission_queue.depths() == {"1-1": 1, "1-2": 1}
+
+    engine.correct_mission("T1", 90, "R50")
+
+    # The guns are told to stop, and nothing for the old grid is left to send.
+    assert len(engine.mission_queue) == 0
+    assert engine.eom_queue.depths() == {"1-1": 1, "1-2": 1}
+    assert Decoder().feed(engine.handle_message("PING", ping_message("1-1"))) == [("EOM", eom_message("T1", "1-1"))]
+    assert engine.missions["T1"]["STATUS"] == "WAITING"
+
+def test_center_setting_rebuilds_gun_index():
+    from smt_lib import grid_to_vec
+
+    engine = engine_with_guns("A1-1-1", "B2-3-4")
+    assert engine.gun_index.center is False
+
+    engine.center = True
+
+    assert engine.gun_index.center is True
+    assert list(engine.gun_index.query("A1-1-1", 0, 2000)) == ["1-1", "1-2"]
+    assert engine.gun_index._guns["1-1"][0] == grid_to_vec("A1-1-1", center=True)
+
+    # A restore keeps the setting too.
+    engine.restore(engine.state())
+    assert engine.gun_index.center is True
+    assert len(engine.gun_index) == 2
+
+################################
+# DISPATCH QUEUES
+################################
+
+def test_dispatch_queue_order():
+    q = DispatchQueue()
+    q.put("1-1", "T1", "a")
+    q.put("1-1", "T2", "b")
+    q.put("1-2", "T1", "c")
+
+    assert len(q) == 3
+    assert q.peek("1-1") == "a"
+    assert q.pending("1-1") == ["a", "b"]
+    assert list(q.items()) == [("1-1", "T1", "a"), ("1-1", "T2", "b"), ("1-2", "T1", "c")]
+    assert q.depths() == {"1-1": 2, "1-2": 1}
+
+    # Queueing the same mission again replaces it and sends it to the back.
+    q.put("1-1", "T1", "d")
+    assert q.pending("1-1") == ["b", "d"]
+    assert len(q) == 3
+
+def test_dispatch_queue_ack():
+    q = DispatchQueue()
+    q.put("1-1", "T1", "a")
+    q.put("1-1", "T2", "b")
+
+    assert q.ack("1-1", "T3") is None
+    assert q.ack("1-2", "T1") is None
+    assert q.ack("1-1", "T1") == "a"
+    assert q.ack("1-1", "T1") is None
+    assert ("1-1", "T1") not in q and ("1-1", "T2") in q
+    assert q.peek("1-1") == "b"
+
+    assert q.ack("1-1", "T2") == "b"
+    assert q.peek("1-1") is None
+    assert q.depths() == {} and q.depth("1-1") == 0
+
+def test_dispatch_queue_drop():
+    q = DispatchQueue()
+    for gun in ("1-1", "1-2", "1-3"):
+        q.put(gun, "T1", gun+"/T1")
+    q.put("1-2", "T2", "1-2/T2")
+
+    q.drop("T1")
+    q.drop("T9")
+
+    assert list(q.items()) == [("1-2", "T2", "1-2/T2")]
+
+    # Dropping a mission doesn't stop it being queued again.
+    q.put("1-1", "T1", "again")
+    assert q.pending("1-1") == ["again"]
+
+################################
+# MISSION STATUS
+################################
+
+def tracked(*guns):
+    changes = []
+    tracker = MissionTracker(lambda *args: changes.append(args))
+    mission = {"ID": "T1", "STATUS": "WAITING", "GUN_STATUS": {}}
+    tracker.add(mission)
+    tracker.assign("T1", list(guns))
+
+    return (tracker, mission, changes)
+
+def test_tracker_statuses():
+    tracker, mission, changes = tracked("1-1", "1-2")
+    assert mission["STATUS"] == "SENDING"
+
+    # Every gun has to receive the mission, but any gun firing counts.
+    assert tracker.update("T1", "1-1", "RECEIVED") is None
+    assert tracker.update("T1", "1-2", "RECEIVED") == "RECEIVED"
+    assert tracker.update("T1", "1-1", "SHOT") == "SHOT"
+    assert tracker.update("T1", "1-1", "COMPLETE") is None
+    assert tracker.update("T1", "1-2", "COMPLETE") == "COMPLETE"
+
+    # A complete mission stays that way.
+    assert tracker.update("T1", "1-2", "SENDING") is None
+    assert mission["STATUS"] == "COMPLETE"
+
+    assert changes == [("T1", "WAITING", "SENDING"), ("T1", "SENDING", "RECEIVED"),
+                       ("T1", "RECEIVED", "SHOT"), ("T1", "SHOT", "COMPLETE")]
+
+def test_tracker_ignores_other_guns():
+    tracker, mission, changes = tracked("1-1")
+
+    assert tracker.update("T1", "1-2", "RECEIVED") is None
+    assert tracker.update("T9", "1-1", "RECEIVED") is None
+    assert tracker.update("T1", "1-1", "SENDING") is None
+    assert mission["GUN_STATUS"] == {"1-1": "SENDING"}
+
+def test_tracker_reset():
+    tracker, mission, changes = tracked("1-1", "1-2")
+    tracker.update("T1", "1-1", "RECEIVED")
+
+    tracker.reset("T1")
+    assert mission["STATUS"] == "WAITING" and mission["GUN_STATUS"] == {}
+
+    # A mission without guns is left alone, and the old counts are gone.
+    assert tracker.update("T1", "1-1", "COMPLETE") is None
+    tracker.assign("T1", ["1-3"])
+    assert tracker.update("T1", "1-3", "RECEIVED") == "RECEIVED"
+
+    tracker.remove("T1")
+    assert "T1" not in tracker and len(tracker) == 0
+
+################################
+# MISSIONS
+################################
+
+def test_mission_lifecycle():
+    changes = []
+    engine = engine_with_guns("A1-1-1", "A1-1-2")
+    engine.on_change = lambda *args: changes.append(args)
+    engine.create_mission("T1", "A2-3-4", "2")
+
+    assert engine.tick() == ["T1"]
+    assert engine.missions["T1"]["GUN_LIST"] == ["1-1", "1-2"]
+    assert all(gun["CAPABLE"] == "NO" for gun in engine.guns.values())
+
+    # Nothing's waiting, so the next tick has nothing to do.
+    assert engine.tick() == []
+
+    for gun in ("1-1", "1-2"):
+        engine.handle_message("STATUS", status_message("T1", gun, "RECEIVED"))
+
+    assert len(engine.mission_queue) == 0
+    assert engine.missions["T1"]["STATUS"] == "RECEIVED"
+
+    engine.end_mission("T1")
+
+    assert "T1" not in engine.missions and "T1" not in engine.tracker
+    assert engine.eom_queue.depths() == {"1-1": 1, "1-2": 1}
+
+    # The guns are told the mission is over the next time they report.
+    reply = engine.handle_message("GUN", gun_report("1-1", "A1-1-1", "10", "EMPLACED", "YES"))
+    assert Decoder().feed(reply) == [("EOM", eom_message("T1", "1-1"))]
+
+    engine.handle_message("EOM", eom_message("T1", "1-1", "EOM"))
+    assert engine.eom_queue.depths() == {"1-2": 1}
+
+    assert changes == [("T1", "WAITING", "SENDING"), ("T1", "SENDING", "RECEIVED")]
+
+def test_received_needs_queued_message():
+    engine = engine_with_guns("A1-1-1")
+    engine.create_mission("T1", "A2-3-4", "1")
+    engine.tick()
+
+    # A gun that wasn't sent the mission can't receive it.
+    engine.handle_message("STATUS", status_message("T1", "1-2", "RECEIVED"))
+    assert engine.missions["T1"]["STATUS"] == "SENDING"
+
+    engine.handle_message("STATUS", status_message("T1", "1-1", "RECEIVED"))
+    engine.handle_message("STATUS", status_message("T1", "1-1", "RECEIVED"))
+    assert engine.missions["T1"]["STATUS"] == "RECEIVED"
+
+def test_end_unsent_mission():
+    engine = engine_with_guns("A1-1-1")
+    engine.create_mission("T1", "A2-3-4", "1")
+    engine.tick()
+
+    # A gun that never got the mission doesn't get sent its firing data afterwards.
+    engine.end_mission("T1")
+
+    assert len(engine.mission_queue) == 0
+    assert engine.eom_queue.depths() == {"1-1": 1}
+
+def test_not_enough_guns():
+    engine = engine_with_guns("A1-1-1", "Z30")
+    engine.create_mission("T1", "A2-3-4", "2")
+
+    assert engine.tick() == []
+    assert engine.missions["T1"]["STATUS"] == "WAITING"
+    assert len(engine.mission_queue) == 0
+
+################################
+# STATE
+################################
+
+def busy_engine():
+    engine = engine_with_guns("A1-1-1", "A1-1-2", "A1-1-3")
+    engine.create_mission("T1", "A2-3-4", "2", sheaf="OPEN")
+    engine.create_mission("T2", "A2-3-5", "1")
+    engine.create_mission("T3", "A2-3-6", "2")
+    engine.tick()
+    engine.handle_message("STATUS", status_message("T1", "1-1", "RECEIVED"))
+    engine.end_mission("T2")
+
+    return engine
+
+def test_state_round_trip():
+    engine = busy_engine()
+    state = engine.state()
+
+    again = FdcEngine()
+    again.restore(state)
+
+    assert again.state() == state
+    assert list(again.mission_queue.items()) == list(engine.mission_queue.items())
+    assert list(again.eom_queue.items()) == list(engine.eom_queue.items())
+    assert again.gun_index.query("A2-3-4") == engine.gun_index.query("A2-3-4")
+
+    # The tracker carries on from the restored counts.
+    again.handle_message("STATUS", status_message("T1", "1-2", "RECEIVED"))
+    assert again.missions["T1"]["STATUS"] == "RECEIVED"
+
+def test_state_is_a_copy():
+    engine = busy_engine()
+    state = engine.state()
+    before = json.loads(json.dumps(state))
+
+    engine.handle_message("STATUS", status_message("T1", "1-2", "RECEIVED"))
+    engine.guns["1-1"]["AMMO"] = "0"
+    engine.create_mission("T4", "A2-3-7", "1")
+
+    assert json.loads(json.dumps(state)) == before
+
+    # A restored engine doesn't share anything with the state either.
+    again = FdcEngine()
+    again.restore(state)
+    again.handle_message("STATUS", status_message("T1", "1-2", "RECEIVED"))
+    assert json.loads(json.dumps(state)) == before
@@ -0,0 +1,139 @@
+import os
+import json
+
+import pytest
+
+import fdc_journal
+from fdc_engine import FdcEngine
+from fdc_journal import Journal, JournalError
+from smt_proto import gun_report, status_message
+
+def start(path):
+    engine = FdcEngine()
+    journal = Journal(str(path))
+    count = journal.load(engine)
+
+    return (engine, journal, count)
+
+def fill(engine):
+    for name, grid in (("1-1", "A1-1-1"), ("1-2", "A1-1-2")):
+        engine.handle_message("GUN", gun_report(name, grid, "10", "EMPLACED", "YES"))
+
+    engine.create_mission("T1", "A2-3-4", "2")
+    engine.tick()
+    engine.handle_message("STATUS", status_message("T1", "1-1", "RECEIVED"))
+
+def test_empty(tmp_path):
+    engine, journal, count = start(tmp_path)
+    journal.close()
+
+    assert count == 0
+    assert engine.state() == FdcEngine().state()
+
+def test_restart(tmp_path):
+    engine, journal, count = start(tmp_path)
+    fill(engine)
+    journal.close()
+
+    again, journal, count = start(tmp_path)
+    journal.close()
+
+    assert count > 0
+    assert again.state() == engine.state()
+
+def test_restart_twice(tmp_path):
+    engine, journal, count = start(tmp_path)
+    fill(engine)
+    journal.close()
+
+    engine, journal, count = start(tmp_path)
+    engine.create_mission("T2", "A3-1-1", "1")
+    journal.close()
+
+    again, journal, count = start(tmp_path)
+    journal.close()
+
+    assert set(again.missions) == {"T1", "T2"}
+    assert again.state() == engine.state()
+
+def test_snapshot(tmp_path):
+    engine, journal, count = start(tmp_path)
+    fill(engine)
+    journal.snapshot(engine)
+    engine.create_mission("T2", "A3-1-1", "1")
+    journal.close()
+
+    with open(journal.snapshot_path) as f:
+        assert set(json.load(f)["state"]["missions"]) == {"T1"}
+
+    again, journal, count = start(tmp_path)
+    journal.close()
+
+    # Only the change after the snapshot is replayed.
+    assert count == 1
+    assert again.state() == engine.state()
+
+def test_snapshot_every(tmp_path, monkeypatch):
+    monkeypatch.setattr(fdc_journal, "snapshot_every", 3)
+
+    engine, journal, count = start(tmp_path)
+    fill(engine)
+    journal.close()
+
+    again, journal, count = start(tmp_path)
+    journal.close()
+
+    assert count < 3
+    assert again.state() == engine.state()
+
+def test_torn_line_then_restart_twice(tmp_path):
+    engine, journal, count = start(tmp_path)
+    fill(engine)
+    journal.close()
+
+    # The FDC died partway through writing a change.
+    with open(journal.journal_path, "a") as f:
+        f.write('{"op": "create", "tgt": "T9"')
+
+    engine, journal, count = start(tmp_path)
+    engine.create_mission("T2", "A3-1-1", "1")
+    journal.close()
+
+    # Changes made after the torn line survive the next restart.
+    again, journal, count = start(tmp_path)
+    journal.close()
+
+    assert set(again.missions) == {"T1", "T2"}
+    assert again.state() == engine.state()
+
+def test_bad_lines_skipped(tmp_path):
+    engine, journal, count = start(tmp_path)
+    fill(engine)
+    journal.close()
+
+    with open(journal.journal_path, "a") as f:
+        f.write('{"op": "create"}\n[1, 2]\nnot json\n')
+
+    engine, journal, count = start(tmp_path)
+    engine.create_mission("T2", "A3-1-1", "1")
+    journal.close()
+
+    again, journal, count = start(tmp_path)
+    journal.close()
+
+    assert set(again.missions) == {"T1", "T2"}
+
+@pytest.mark.parametrize("snapshot", ["[1, 2]", '{"state": {}}', '{"seq": "x", "state": {}}', "not json"])
+def test_bad_snapshot(tmp_path, snapshot):
+    with open(os.path.join(str(tmp_path), fdc_journal.SNAPSHOT_FILE), "w") as f:
+        f.write(snapshot)
+
+    with pytest.raises(JournalError):
+        start(tmp_path)
+
+def test_unreadable_snapshot(tmp_path):
+    # A snapshot that can't be opened at all.
+    os.makedirs(os.path.join(str(tmp_path), fdc_journal.SNAPSHOT_FILE))
+
+    with pytest.raises(JournalError):
+        start(tmp_path)
@@ -0,0 +1,57 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import smt_ballistics
+import smt_lib
+
+# What fit gives for the default range card, so the tests don't have to fit it.
+PARAMS = (127.5573, 0.00016072, 11.04023)
+
+@pytest.fixture(scope="module")
+def table():
+    return smt_ballistics.solve(params=PARAMS, dh=(0,), cache=False)
+
+def test_filled_card_carries_on_from_measured_rows(table):
+    card = smt_lib.getCard()
+    filled = smt_ballistics.fill_card(card, table)
+
+    # Measured rows are kept.
+    for row, new in zip(card, filled):
+        if row[2]:
+            assert new == row
+
+    # Where the measured rows stop and the solved ones start, the times of
+    # flight don't jump by more than they change between solved rows.
+    solved = [n for n, row in enumerate(card) if not row[2]]
+    tofs = [row[2] for row in filled]
+    steps = [tofs[n]-tofs[n+1] for n in solved[:-1]]
+
+    assert all(0 <= step < 1 for step in steps)
+    assert 0 <= tofs[solved[0]-1]-tofs[solved[0]] <= min(steps)+.1
+    assert 0 <= tofs[solved[-1]]-tofs[solved[-1]+1] <= max(steps)*1.5
+
+def test_solved_profile_agrees_with_measured_rows():
+    profile = smt_ballistics.solved_profile(step=50, register=False, params=PARAMS,
+                                            dh=(0,), cache=False)
+    solved = {row[0]: row for row in profile.card}
+
+    for rn, el, tof in smt_lib.getCard():
+        assert abs(solved[rn][1]-el) <= .5
+        if tof:
+            assert abs(solved[rn][2]-tof) <= .1
+
+@pytest.mark.parametrize("params", [(0, 0, 9.81), (-10, 0, 9.81), (100, 0, 0),
+                                    (100, 0, -9.81), (100, -1e-4, 9.81)])
+def test_integrate_rejects_rounds_that_never_land(params):
+    with pytest.raises(ValueError):
+        smt_ballistics.integrate([800], *params)
+
+def test_integrate_stops_at_max_time(monkeypatch):
+    monkeypatch.setattr(smt_ballistics, "max_time", 5.0)
+
+    # A round that's still in the air when time runs out never comes down.
+    rn, tof, apex = smt_ballistics.integrate([1500], 200, 0, dt=.05)
+
+    assert np.isnan(rn).all() and np.isnan(tof).all()
+    assert apex[0] > 0
@@ -0,0 +1,117 @@
+import csv
+import json
+
+import pytest
+
+import smt_cli
+import smt_lib
+
+RECORDS = [{"id": 1, "gun": "A1-1-1", "tgt": "B2-3-4"},
+           {"id": 2, "gun": "A1-1-1", "tgt": "Z30"},         # Out of range.
+           {"id": 3, "gun": "A1-1-1", "tgt": "not a grid"},
+           {"id": 4, "gun": "A1-1-1"},                       # No target.
+           {"id": 5, "gun": 12, "tgt": "B2-3-4"},            # Not a string.
+           {"id": 6, "gun": "A2-5", "tgt": "B2-3-4"}]
+
+def write_jsonl(path, records):
+    path.write_text("".join(json.dumps(i)+"\n" for i in records))
+    return str(path)
+
+def run(capsys, *argv):
+    code = smt_cli.main(list(argv))
+    out, err = capsys.readouterr()
+
+    return (code, out, err)
+
+def expected(record, profile=None):
+    try:
+        return list(smt_lib.calc_data(record["gun"], record["tgt"], profile=profile))
+    except Exception:
+        return None
+
+def test_csv_output(tmp_path, capsys):
+    path = write_jsonl(tmp_path/"in.jsonl", RECORDS)
+    code, out, err = run(capsys, path)
+
+    assert code == 0
+    rows = list(csv.DictReader(out.splitlines()))
+
+    assert [r["id"] for r in rows] == ["1", "2", "3", "4", "5", "6"]
+    assert list(rows[0]) == ["id", "gun", "tgt", "rn", "az", "el", "tof", "error"]
+    assert [bool(r["error"]) for r in rows] == [False, True, True, True, True, False]
+
+    # Every record is counted, and so is every error.
+    assert "6 records, 4 errors" in err
+
+def test_bad_json_lines(tmp_path, capsys):
+    path = tmp_path/"in.jsonl"
+    path.write_text('{"gun": "A1-1-1", "tgt": "B2-3-4"}\nnot json\n[1]\n\n{"gun": "A1-1-1", "tgt": "B2-3-5"}\n')
+
+    code, out, err = run(capsys, str(path), "--output-format", "jsonl")
+    results = [json.loads(i) for i in out.splitlines()]
+
+    # Bad lines keep their place in the output.
+    assert len(results) == 4
+    assert [bool(r["error"]) for r in results] == [False, True, True, False]
+    assert "line 2" in results[1]["error"]
+    assert "4 records, 2 errors" in err
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_workers_match(tmp_path, capsys, workers):
+    records = [dict(i, id=n) for n in range(40) for i in RECORDS]
+    path = write_jsonl(tmp_path/"in.jsonl", records)
+
+    code, out, err = run(capsys, path, "--output-format", "jsonl", "--chunk", "7",
+                         "--workers", str(workers))
+    results = [json.loads(i) for i in out.splitlines()]
+
+    # Results come out in input order, whichever process worked them out.
+    assert code == 0
+    assert [(r["id"], r.get("tgt")) for r in results] == [(r["id"], r.get("tgt")) for r in records]
+    for record, result in zip(records, results):
+        data = expected(record) if isinstance(record.get("gun"), str) and record.get("tgt") else None
+        assert (result["error"] == "") == (data is not None)
+        if data:
+            assert [result[k] for k in smt_cli.DATA_FIELDS] == data
+
+    assert "240 records, 160 errors" in err
+
+def test_workers_load_profiles(tmp_path, capsys):
+    # A card that only reaches 100 m, so the profile is easy to tell apart.
+    profiles = tmp_path/"profiles.json"
+    profiles.write_text(json.dumps([{"name": "CLI-SHORT", "weapon": "CLI", "shell": "HE",
+                                     "card": [[50, 1500, 20], [100, 1400, 19]], "burst": 10}]))
+    path = write_jsonl(tmp_path/"in.jsonl", [{"gun": "A1", "tgt": "A1-8"}, {"gun": "A1", "tgt": "C1"}])
+
+    code, out, err = run(capsys, path, "--output-format", "jsonl", "--workers", "2",
+                         "--profiles", str(profiles), "--profile", "CLI-SHORT")
+    results = [json.loads(i) for i in out.splitlines()]
+
+    assert code == 0
+    assert results[0]["error"] == "" and results[0]["rn"] == 100
+    assert results[0]["el"] == 1400
+    assert results[1]["error"]
+
+@pytest.mark.parametrize("contents", [None, "not json", '[{"name": "CLI-BAD", "card": []}]'])
+def test_bad_profiles(tmp_path, capsys, contents):
+    profiles = tmp_path/"profiles.json"
+    if contents is not None:
+        profiles.write_text(contents)
+
+    with pytest.raises(SystemExit) as e:
+        smt_cli.main([write_jsonl(tmp_path/"in.jsonl", RECORDS), "--profiles", str(profiles)])
+
+    assert e.value.code == 2
+    assert capsys.readouterr().out == ""
+
+def test_unknown_profile(tmp_path, capsys):
+    with pytest.raises(SystemExit) as e:
+        smt_cli.main([write_jsonl(tmp_path/"in.jsonl", RECORDS), "--profile", "NO-SUCH-PROFILE"])
+
+    assert e.value.code == 2
+
+def test_missing_input(tmp_path, capsys):
+    code, out, err = run(capsys, str(tmp_path/"missing.csv"))
+
+    assert code == 1
+    assert "missing.csv" in err
@@ -0,0 +1,149 @@
+import math
+import random
+
+import pytest
+
+import smt_grid
+
+def random_grid(rng, depth):
+    keypad = "".join("-{}".format(rng.randint(1, 9)) for _ in range(depth))
+    return "{}{}{}".format(rng.choice("ABCXYZ"), rng.randint(1, 20), keypad)
+
+@pytest.mark.parametrize("depth", range(smt_grid.MAX_DEPTH+1))
+def test_center_round_trip(depth):
+    rng = random.Random(depth)
+
+    for _ in range(200):
+        grid = random_grid(rng, depth)
+
+        # The centre of a cell is inside it, so it encodes back to the same grid.
+        assert smt_grid.encode(smt_grid.decode(grid, center=True), depth) == grid
+        assert smt_grid.depth(grid) == depth
+
+def test_decode_examples():
+    assert smt_grid.decode("A1") == (0, 0)
+    assert smt_grid.decode("A1", center=True) == (150, -150)
+    assert smt_grid.decode("B2-7") == (300, -300)
+    assert smt_grid.decode("B2-3", center=True) == (550, -550)
+
+    # Lower case letters are the same grid.
+    assert smt_grid.decode("c4-5-5") == smt_grid.decode("C4-5-5")
+
+@pytest.mark.parametrize("precision", [-1, smt_grid.MAX_DEPTH+1])
+def test_precision_bounds(precision):
+    with pytest.raises(ValueError):
+        smt_grid.encode((100, -100), precision)
+    with pytest.raises(ValueError):
+        smt_grid.vec_to_key((100, -100), precision)
+
+def test_precision():
+    assert smt_grid.encode((100, -100), 0) == "A1"
+    assert smt_grid.encode((100, -100), smt_grid.MAX_DEPTH).count("-") == smt_grid.MAX_DEPTH
+
+    # Without a precision, digits are added until the point is within a meter.
+    assert smt_grid.encode((300, -300)) == "B2"
+    assert smt_grid.encode((400, -400)) == "B2-5"
+    assert smt_grid.encode((401, -400.5)) == "B2-5"
+    assert smt_grid.encode((350, -350)).startswith("B2-7-5-")
+
+@pytest.mark.parametrize("cords", [(-1, 0), (26*300, 0)])
+def test_off_the_map(cords):
+    with pytest.raises(ValueError):
+        smt_grid.encode(cords)
+
+@pytest.mark.parametrize("bad", ["", "A", "A1-0", "A1-", "A1-12", "1A", None, 17])
+def test_invalid_grids(bad):
+    assert not smt_grid.valid_grid(bad)
+
+    with pytest.raises(ValueError):
+        smt_grid.grid_to_key(bad)
+
+def test_zone_zero_has_no_key():
+    with pytest.raises(ValueError):
+        smt_grid.grid_to_key("A0-1")
+
+def test_array_parity():
+    np = pytest.importorskip("numpy")
+
+    rng = random.Random(4)
+    grids = [random_grid(rng, rng.randint(0, 6)) for _ in range(300)]
+
+    for center in (False, True):
+        cords = smt_grid.decode_array(np.array(grids, dtype=object).reshape(30, 10), center=center)
+
+        assert cords.shape == (30, 10, 2)
+        assert [tuple(i) for i in cords.reshape(-1, 2)] == [smt_grid.decode(g, center=center) for g in grids]
+
+    points = [(rng.uniform(0, 26*300), -rng.uniform(0, 6000)) for _ in range(300)]
+    for precision in (None, 0, 3, smt_grid.MAX_DEPTH):
+        assert list(smt_grid.encode_array(points, precision)) == [smt_grid.encode(p, precision) for p in points]
+
+    with pytest.raises(ValueError):
+        smt_grid.encode_array(points, smt_grid.MAX_DEPTH+1)
+
+def test_key_round_trip():
+    rng = random.Random(5)
+
+    for _ in range(500):
+        grid = random_grid(rng, rng.randint(0, smt_grid.MAX_DEPTH))
+        key = smt_grid.grid_to_key(grid)
+
+        assert smt_grid.valid_key(key)
+        assert smt_grid.key_to_grid(key) == grid
+        assert smt_grid.key_depth(key) == smt_grid.depth(grid)
+        assert smt_grid.key_to_vec(key) == smt_grid.decode(grid)
+        assert smt_grid.key_to_vec(key, center=True) == smt_grid.decode(grid, center=True)
+        assert smt_grid.vec_to_key(smt_grid.decode(grid, center=True), smt_grid.depth(grid)) == key
+
+def test_keys_sort_by_zone():
+    keys = [smt_grid.grid_to_key(g) for g in ("A1", "B1", "A2", "A1-7", "A1-3")]
+
+    assert smt_grid.grid_to_key("A1") < smt_grid.grid_to_key("A1-7") < smt_grid.grid_to_key("A1-3")
+    assert max(keys[:2]+keys[3:]) < keys[2]
+
+@pytest.mark.parametrize("key", [-1, 1 << 4 | 15, 26 << 36, True, 1.0, "A1"])
+def test_invalid_keys(key):
+    assert not smt_grid.valid_key(key)
+
+def test_invalid_key_path():
+    # A path digit below the key's depth can't come from grid_to_key.
+    key = smt_grid.grid_to_key("A1-5")
+    assert not smt_grid.valid_key(key+(1 << 4))
+
+def test_key_truncate():
+    key = smt_grid.grid_to_key("C3-5-7-9")
+
+    assert smt_grid.key_to_grid(smt_grid.key_truncate(key, 1)) == "C3-5"
+    assert smt_grid.key_truncate(key, 3) == key
+
+    with pytest.raises(ValueError):
+        smt_grid.key_truncate(key, 4)
+
+def neighbours(grid):
+    return sorted(smt_grid.key_to_grid(k) for k in smt_grid.key_neighbours(smt_grid.grid_to_key(grid)))
+
+def test_key_neighbours():
+    assert neighbours("B2-5") == sorted(["B2-1", "B2-2", "B2-3", "B2-4", "B2-6", "B2-7", "B2-8", "B2-9"])
+    assert neighbours("B2-6") == sorted(["B2-2", "B2-3", "B2-5", "B2-8", "B2-9", "C2-1", "C2-4", "C2-7"])
+
+def test_key_neighbours_map_edges():
+    # Nothing west of A or north of 1.
+    assert neighbours("A1") == ["A2", "B1", "B2"]
+    assert neighbours("A1-7") == ["A1-4", "A1-5", "A1-8"]
+    assert neighbours("A3-4") == ["A3-1", "A3-2", "A3-5", "A3-7", "A3-8"]
+
+    # Nothing east of Z.
+    assert neighbours("Z1-9") == ["Z1-5", "Z1-6", "Z1-8"]
+
+def test_key_dist():
+    a = smt_grid.grid_to_key("A1")
+    b = smt_grid.grid_to_key("B2")
+
+    assert smt_grid.key_dist(a, a) == 0
+    assert smt_grid.key_dist(a, b) == pytest.approx(300*math.sqrt(2))
+    assert smt_grid.key_dist(a, b, center=True) == pytest.approx(300*math.sqrt(2))
+
+    # Centres move by half of each cell.
+    c = smt_grid.grid_to_key("A1-7")
+    assert smt_grid.key_dist(a, c) == 0
+    assert smt_grid.key_dist(a, c, center=True) == pytest.approx(100*math.sqrt(2))
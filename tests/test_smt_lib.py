@@ -0,0 +1,213 @@
+import json
+import math
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import smt_grid
+import smt_lib
+
+def random_grid(rng, depth):
+    keypad = "-".join(str(rng.randint(1, 9)) for _ in range(depth))
+    return "{}{}-{}".format(rng.choice("ABCD"), rng.randint(1, 4), keypad)
+
+def solve(gun, tgt, center=False):
+    """Returns calc_data's answer, or None if it's out of range."""
+
+    try:
+        return smt_lib.calc_data(gun, tgt, center=center)
+    except smt_lib.OutOfRangeError:
+        return None
+
+@pytest.mark.parametrize("center", [False, True])
+def test_batch_matches_calc_data(center):
+    rng = random.Random(1)
+    guns = [random_grid(rng, rng.randint(1, 4)) for _ in range(300)]
+    tgts = [random_grid(rng, rng.randint(1, 4)) for _ in range(300)]
+
+    rn, az, el, tof, ok = smt_lib.calc_data_batch(guns, tgts, center=center)
+
+    assert ok.any() and not ok.all()
+
+    for n, (gun, tgt) in enumerate(zip(guns, tgts)):
+        data = solve(gun, tgt, center)
+
+        if data is None:
+            assert not ok[n]
+            assert np.isnan(el[n]) and np.isnan(tof[n])
+        else:
+            assert ok[n]
+            assert (rn[n], az[n], el[n], tof[n]) == data
+
+def test_batch_broadcast():
+    rng = random.Random(2)
+    guns = np.array([random_grid(rng, 3) for _ in range(4)], dtype=object)
+    tgts = np.array([random_grid(rng, 3) for _ in range(5)], dtype=object)
+
+    rn, az, el, tof, ok = smt_lib.calc_data_batch(guns[:, None], tgts[None, :])
+
+    assert rn.shape == (4, 5)
+    for i, gun in enumerate(guns):
+        for j, tgt in enumerate(tgts):
+            data = solve(gun, tgt)
+            assert ok[i, j] == (data is not None)
+            if data is not None:
+                assert (rn[i, j], az[i, j], el[i, j], tof[i, j]) == data
+
+def test_batch_vector_points():
+    gun = smt_lib.grid_to_vec("A1-1-1")
+    tgt = smt_lib.grid_to_vec("B2-3-4")
+
+    rn, az, el, tof, ok = smt_lib.calc_data_batch(np.array([gun]), np.array([tgt]))
+
+    assert (rn[0], az[0], el[0], tof[0]) == smt_lib.calc_data("A1-1-1", "B2-3-4")
+
+@pytest.mark.parametrize("guns, tgts, shape", [
+    ([], ["A1-1-1"], (0,)),
+    (["A1-1-1"], [], (0,)),
+    ([], [], (0,)),
+    (np.empty((0, 2)), "B2-3-4", (0,)),
+    (np.array(["A1-1-1", "A1-1-2"], dtype=object)[:, None], np.array([], dtype=object)[None, :], (2, 0)),
+    ])
+def test_batch_empty(guns, tgts, shape):
+    rn, az, el, tof, ok = smt_lib.calc_data_batch(guns, tgts)
+
+    for a in (rn, az, el, tof, ok):
+        assert a.shape == shape
+    assert ok.dtype == bool
+
+def test_batch_bad_grid():
+    with pytest.raises(smt_lib.InvalidGridError):
+        smt_lib.calc_data_batch(["A1-1-1"], ["not a grid"])
+
+def test_grid_subclasses():
+    # Grids out of NumPy string arrays come through as numpy.str_.
+    grid = np.array(["B2-3-4"])[0]
+    key = smt_lib.grid_to_key("B2-3-4")
+
+    assert smt_lib.grid_to_vec(grid) == smt_lib.grid_to_vec("B2-3-4")
+    assert smt_lib.calc_data("A1-1-1", grid) == smt_lib.calc_data("A1-1-1", "B2-3-4")
+    assert smt_lib.grid_to_vec(key) == smt_lib.grid_to_vec("B2-3-4")
+
+    for bad in (True, False, 1.5, None, b"B2-3-4"):
+        with pytest.raises(smt_lib.InvalidGridError):
+            smt_lib.grid_to_vec(bad)
+
+@pytest.mark.parametrize("card", [
+    [[50, 1579], [100, 1558]],                  # No times of flight.
+    [[50, 1579, 22.6], [50, 1558, 22.7]],       # The same range twice.
+    [[50, "high", 22.6], [100, 1558, 22.7]],
+    [[100, 1558, 22.7], [50, 1579, 22.6]],      # Not sorted.
+    ])
+def test_load_profiles_bad_card(tmp_path, card):
+    path = tmp_path/"profiles.json"
+    path.write_text(json.dumps({"name": "TEST-BAD", "weapon": "TEST", "shell": "HE",
+                                "card": card, "burst": 10, "min_range": 50, "max_range": 100}))
+
+    with pytest.raises(smt_lib.ProfileError):
+        smt_lib.load_profiles(str(path))
+
+    assert "TEST-BAD" not in smt_lib.profiles()
+
+def test_load_profiles(tmp_path):
+    path = tmp_path/"profiles.json"
+    path.write_text(json.dumps([{"name": "TEST-GOOD", "weapon": "TEST", "shell": "HE",
+                                 "card": [[50, 1579, 22.6], [100, 1558, 22.7]], "burst": 10}]))
+
+    profile, = smt_lib.load_profiles(str(path))
+
+    assert smt_lib.get_profile("TEST-GOOD") is profile
+    assert profile.el(75) == 1568.5
+
+def test_load_profiles_all_or_nothing(tmp_path):
+    path = tmp_path/"profiles.json"
+    path.write_text(json.dumps([{"name": "TEST-FIRST", "weapon": "TEST", "shell": "HE",
+                                 "card": [[50, 1579, 22.6], [100, 1558, 22.7]], "burst": 10},
+                                {"name": "TEST-SECOND", "weapon": "TEST", "shell": "HE",
+                                 "card": [[50, 1579], [100, 1558]], "burst": 10}]))
+
+    with pytest.raises(smt_lib.ProfileError):
+        smt_lib.load_profiles(str(path))
+
+    assert "TEST-FIRST" not in smt_lib.profiles()
+
+def ring_grids(rng, tgt, count):
+    """Returns grids of points around a target, many of them near its maximum range."""
+
+    t = smt_lib.grid_to_vec(tgt)
+    hi = smt_lib.get_profile().max_range
+    grids = []
+
+    for _ in range(count):
+        a = rng.uniform(0, 2*math.pi)
+        d = rng.choice([rng.uniform(0, hi*1.5), hi+rng.uniform(-1.5, 1.5)])
+        x = round(t[0]+d*math.sin(a))
+        y = round(t[1]+d*math.cos(a))
+        if 0 <= x < 26*300 and y <= 0:
+            grids.append(smt_grid.encode((x, y), smt_grid.MAX_DEPTH))
+
+    return grids
+
+def in_range(gun, tgt, center=False, lo=None, hi=None):
+    profile = smt_lib.get_profile()
+    lo = profile.min_range if lo is None else lo
+    hi = profile.max_range if hi is None else hi
+
+    return lo <= smt_lib.get_rn(gun, tgt, center=center) <= hi
+
+@pytest.mark.parametrize("center", [False, True])
+def test_gun_index_matches_brute_force(center):
+    rng = random.Random(6)
+    index = smt_lib.GunIndex(center=center)
+    tgt = "E5-5-5"
+
+    # Guns right on bucket edges, and exactly at maximum range.
+    grids = ["E5", "F5", "E6", "D4-3", "E5-5-5", "B5", "E1-1", "E9-9"]
+    grids += [smt_grid.encode(p) for p in [(1200+750, -1200-1000), (1200, -1200+1250), (1200, -1200-1250)]]
+    grids += ring_grids(rng, tgt, 400)
+
+    guns = {"G{}".format(n): grid for n, grid in enumerate(grids)}
+    for name, grid in guns.items():
+        assert index.update(name, grid)
+
+    for t in [tgt, "E5", "A1", "C3-7-7"]:
+        for lo, hi in [(None, None), (0, 300), (299, 301), (600, 600)]:
+            expected = [n for n, g in guns.items() if in_range(g, t, center, lo, hi)]
+            assert index.query(t, lo, hi) == expected
+
+    # Guns that moved or were removed are only found where they are now.
+    for name in rng.sample(sorted(guns), 100):
+        if rng.random() < .5:
+            index.remove(name)
+            del guns[name]
+        else:
+            guns[name] = rng.choice(grids)
+            index.update(name, guns[name])
+
+    assert sorted(index.query(tgt)) == sorted(n for n, g in guns.items() if in_range(g, tgt, center))
+
+@pytest.mark.parametrize("center", [False, True])
+def test_coverage_matches_brute_force(center):
+    rng = random.Random(7)
+    coverage = smt_lib.Coverage(zones=(10, 10), depth=2, center=center)
+    profile = smt_lib.get_profile()
+    size = coverage.size
+
+    # Guns in corners, on cell edges, and off the side of the map.
+    grids = ["A1", "J10-9-9", "J1", "A10", "E5", "E5-5", "E5-7-7", "L3"] + ring_grids(rng, "E5", 6)
+
+    for n, grid in enumerate(grids):
+        name = "G{}".format(n)
+        coverage.update(name, grid)
+        g = smt_lib.grid_to_vec(grid, center=center)
+
+        bitmap = 0
+        for cy in range(coverage.height):
+            for cx in range(coverage.width):
+                rn = round(math.dist(g, ((cx+.5)*size, -(cy+.5)*size)))
+                if profile.min_range <= rn <= profile.max_range:
+                    bitmap |= 1 << (cy*coverage.width+cx)
+
+        assert coverage.bitmap(name) == bitmap, grid
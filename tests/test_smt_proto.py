@@ -0,0 +1,62 @@
+import pytest
+
+from smt_proto import *
+
+MESSAGES = [("GUN", gun_report("1-1", "A1-2-3", "42", "EMPLACED", "YES")),
+            ("TGT", mission_message("1-1", {"ID": "T1", "GRID": "B2-3-4", "MOC": "FFE", "SHELL": "HE",
+                                           "ROUNDS": "3", "STATUS": "SENDING"}, (512, 96.5, 1432, 23))),
+            ("STATUS", status_message("T1", "1-1", "RECEIVED")),
+            ("EOM", eom_message("T1", "1-1")),
+            ("PING", ping_message("1-1"))]
+
+def test_round_trip():
+    for kind, data in MESSAGES:
+        assert unpack(pack(kind, data)) == (kind, data)
+
+def test_other_status_round_trip():
+    data = status_message("T1", "1-1", "REPACKING")
+    assert unpack(pack("STATUS", data)) == ("STATUS", data)
+
+def test_decoder_joined():
+    stream = b"".join(pack(kind, data) for kind, data in MESSAGES)
+
+    assert Decoder().feed(stream) == MESSAGES
+
+def test_decoder_split_every_byte():
+    stream = b"".join(pack(kind, data) for kind, data in MESSAGES)
+    decoder = Decoder()
+    out = []
+
+    for i in range(len(stream)):
+        out += decoder.feed(stream[i:i+1])
+
+    assert out == MESSAGES
+    assert len(decoder) == 0
+
+def test_decoder_split_across_messages():
+    a = pack(*MESSAGES[0])
+    b = pack(*MESSAGES[1])
+    decoder = Decoder()
+
+    # The first message and part of the header of the second.
+    assert decoder.feed(a+b[:5]) == [MESSAGES[0]]
+    assert len(decoder) == 5
+    assert decoder.feed(b[5:]) == [MESSAGES[1]]
+
+def test_decoder_bad_magic():
+    with pytest.raises(ProtocolError):
+        Decoder().feed(b"XX"+pack(*MESSAGES[0])[2:])
+
+def test_decoder_body_too_large():
+    header = pack(*MESSAGES[0])[:4]
+
+    with pytest.raises(ProtocolError):
+        Decoder().feed(header+(1 << 20).to_bytes(4, "big"))
+
+def test_unpack_truncated():
+    with pytest.raises(ProtocolError):
+        unpack(pack(*MESSAGES[0])[:-1])
+
+def test_pack_long_other_status():
+    with pytest.raises(ProtocolError):
+        pack("STATUS", status_message("T1", "1-1", "X"*256))
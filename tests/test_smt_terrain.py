@@ -0,0 +1,180 @@
+import json
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import smt_grid
+import smt_lib
+import smt_terrain
+
+def flat(height=0.0, size=64, resolution=50.0):
+    return smt_terrain.Heightmap(np.full((size, size), height, dtype=np.float32), resolution=resolution)
+
+def east(rn):
+    """Returns a grid rn meters east of A1."""
+
+    return smt_grid.encode((rn, 0), smt_grid.MAX_DEPTH)
+
+################################
+# HEIGHTMAPS
+################################
+
+def test_load_npy(tmp_path):
+    path = str(tmp_path/"map.npy")
+    np.save(path, np.arange(16, dtype=np.uint16).reshape(4, 4))
+    with open(str(tmp_path/"map.json"), "w") as f:
+        json.dump({"resolution": 10, "scale": 2, "offset": 5}, f)
+
+    hm = smt_terrain.load_heightmap(path, offset=1)
+
+    assert hm.shape == (4, 4)
+    assert hm.resolution == 10 and hm.offset == 1
+    assert hm.heights([[10, -10]]) == [5*2+1]
+
+def test_load_raw(tmp_path):
+    path = str(tmp_path/"map.raw")
+    np.arange(12, dtype="<u2").tofile(path)
+
+    # A raw file that isn't square needs its shape.
+    with pytest.raises(ValueError):
+        smt_terrain.load_heightmap(path)
+
+    hm = smt_terrain.load_heightmap(path, shape=(3, 4))
+    assert hm.shape == (3, 4)
+    assert hm.heights([[3, -2]]) == [11]
+
+    np.arange(9, dtype="<f4").tofile(path)
+    assert smt_terrain.load_heightmap(path, dtype="<f4").shape == (3, 3)
+
+@pytest.mark.parametrize("settings", [{"colour": "red"}, {"dtype": "nothing"}, {"dtype": 12.5}])
+def test_load_bad_settings(tmp_path, settings):
+    path = str(tmp_path/"map.raw")
+    np.zeros(16, dtype="<u2").tofile(path)
+
+    with pytest.raises(ValueError):
+        smt_terrain.load_heightmap(path, **settings)
+
+def test_load_bad_sidecar(tmp_path):
+    path = str(tmp_path/"map.raw")
+    np.zeros(16, dtype="<u2").tofile(path)
+    with open(str(tmp_path/"map.json"), "w") as f:
+        f.write("[1, 2]")
+
+    with pytest.raises(ValueError):
+        smt_terrain.load_heightmap(path)
+
+def test_heights_interpolate_and_clamp():
+    hm = smt_terrain.Heightmap(np.array([[0, 10], [20, 30]], dtype=np.float32), resolution=10, tile=1)
+
+    assert hm.heights([[5, 0], [0, -5], [5, -5]]).tolist() == [5, 10, 15]
+
+    # Points off the map take the height of the nearest edge.
+    assert hm.heights([[-100, 100], [100, -100]]).tolist() == [0, 30]
+
+################################
+# ALTITUDE CORRECTIONS
+################################
+
+def test_alt_correction_level():
+    de, dt = smt_terrain.alt_correction(np.array([100, 600, 1200]), 0)
+
+    assert (de == 0).all() and (dt == 0).all()
+
+def test_alt_correction_direction():
+    # A target above the gun is hit higher on the way down, so sooner.
+    de, dt = smt_terrain.alt_correction(800, np.array([-50, 50]))
+
+    assert de[0] > 0 > de[1]
+    assert dt[0] > 0 > dt[1]
+
+    # The corrections grow with the altitude difference.
+    de2, dt2 = smt_terrain.alt_correction(800, np.array([-100, 100]))
+    assert (abs(de2) > abs(de)).all() and (abs(dt2) > abs(dt)).all()
+
+def test_alt_correction_out_of_reach():
+    de, dt = smt_terrain.alt_correction(1250, 5000)
+
+    assert math.isnan(de) and math.isnan(dt)
+
+    with pytest.raises(smt_lib.OutOfRangeError):
+        smt_terrain.calc_data_alt("A1", east(1250), gun_alt=0, tgt_alt=5000)
+
+@pytest.mark.parametrize("rn", [50, 450, 460, 777, 1200, 1250])
+def test_level_matches_calc_data(rn):
+    # Level shots get exactly the range card's data, rounded the same way.
+    assert smt_terrain.calc_data_alt("A1", east(rn), flat(120.0))[:4] == smt_lib.calc_data("A1", east(rn))
+
+    rn_, az, el, tof, dh, ok = smt_terrain.calc_data_terrain(["A1"], east(rn), flat(120.0))
+    assert (rn_[0], az[0], el[0], tof[0]) == smt_lib.calc_data("A1", east(rn))
+
+def test_calc_data_alt_rounding():
+    # Times of flight off the card keep their tenths, interpolated ones are whole.
+    assert smt_terrain.calc_data_alt("A1", east(450), gun_alt=0, tgt_alt=30)[3] == 22.1
+    assert smt_terrain.calc_data_alt("A1", east(777), gun_alt=0, tgt_alt=30)[3] % 1 == 0
+
+def test_terrain_matches_calc_data_alt():
+    hm = smt_terrain.Heightmap(np.random.default_rng(8).uniform(0, 80, (64, 64)).astype(np.float32),
+                               resolution=50.0, tile=16)
+    guns = ["A1-5", "B2-7-3", "C1-1"]
+    tgts = [east(rn) for rn in (300, 450, 700, 1000)] + ["D3-5-5"]
+
+    for center in (False, True):
+        rn, az, el, tof, dh, ok = smt_terrain.calc_data_terrain(np.array(guns)[:, None], tgts, hm,
+                                                                center=center)
+
+        for i, gun in enumerate(guns):
+            for j, tgt in enumerate(tgts):
+                try:
+                    expected = smt_terrain.calc_data_alt(gun, tgt, hm, center=center)
+                except smt_lib.OutOfRangeError:
+                    assert not ok[i, j]
+                    continue
+
+                assert ok[i, j]
+                assert (rn[i, j], az[i, j], el[i, j], tof[i, j]) == expected[:4]
+                assert dh[i, j] == pytest.approx(expected[4], abs=1e-3)
+
+################################
+# CLEARANCE
+################################
+
+def test_clear_on_flat_ground():
+    clear, strike, dist = smt_terrain.check_clearance(["A1"], [east(800)], [1200], flat())
+
+    assert clear.tolist() == [True]
+    assert strike[0].tolist() == [800, 0]
+    assert dist[0] == pytest.approx(800)
+
+def test_wall_blocks_low_shots():
+    data = np.zeros((64, 64), dtype=np.float32)
+    data[:, 8:10] = 100
+    hm = smt_terrain.Heightmap(data, resolution=50.0)
+
+    # A wall 400 m away stops a flat shot, but a high angle one goes over.
+    clear, strike, dist = smt_terrain.check_clearance("A1", east(800), [50, 1200], hm)
+
+    assert clear.tolist() == [False, True]
+    assert 350 <= strike[0][0] <= 500
+    assert 350 <= dist[0] <= 500
+    assert dist[1] == pytest.approx(800)
+
+def test_margin_and_nan():
+    hm = flat(10.0)
+
+    # The gun and target are on the ground, so any margin is too much low down.
+    clear, strike, dist = smt_terrain.check_clearance("A1", east(600), [1, np.nan], hm, margin=0.0)
+    assert clear.tolist() == [True, False]
+
+    clear, strike, dist = smt_terrain.check_clearance("A1", east(600), [1], hm, margin=50.0)
+    assert clear.tolist() == [False]
+
+def test_clearance_broadcasts():
+    clear, strike, dist = smt_terrain.check_clearance(np.array(["A1", "A2"])[:, None],
+                                                      [east(300), east(600), east(900)],
+                                                      np.full((2, 3), 1200.0), flat())
+
+    assert clear.shape == dist.shape == (2, 3)
+    assert strike.shape == (2, 3, 2)
+    assert clear.all()